@@ -0,0 +1,433 @@
+import argparse
+from collections import Counter
+from dataclasses import asdict, dataclass
+from functools import lru_cache
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import multiprocessing
+import random
+import threading
+import time
+from urllib.parse import parse_qs, urlsplit
+import urllib.request
+
+"""
+    A stand in for the bits of the spotify api spex uses (the token endpoint, /playlists, /playlists/{id}/tracks and /albums?ids=) so the client can be run
+    against playlists of any size without going near the real api. Every playlist id gives back the same synthetic playlist, built from the settings, apart from
+    ids starting with missing which get a 404. The responses can be slowed down or made to fail some of the time to see how the client copes. Tracks and albums
+    carry the same bulky extras the real ones do (markets, images, urls) and the playlist endpoints honour fields= like spotify does, so response sizes are close
+    to the real thing.
+
+    Run it on its own to point the cli or the web app at it:
+        python -m benchmarks.mock_spotify --tracks 5000 --port 8080
+        SPEX_API_URL=http://127.0.0.1:8080/v1 SPEX_TOKEN_URL=http://127.0.0.1:8080/api/token spex ...
+"""
+
+@dataclass
+class MockSettings:
+
+    tracks: int = 1000
+    album_reuse: float = 0.5 # share of tracks that are on an album an earlier track was already on
+    page_size: int = 100 # spotify's largest page
+    latency: float = 0.0 # seconds added to every response
+    throttle_rate: float = 0.0 # chance of a 429
+    unauthorized_rate: float = 0.0 # chance of a 401
+    server_error_rate: float = 0.0 # chance of a 503
+    retry_after: int = 0 # what the 429s say in Retry-After
+    seed: int = 0
+
+    @property
+    def album_count(self) -> int:
+
+        return max(1, round(self.tracks * (1 - self.album_reuse)))
+
+# spotify lists every market a track is available in, for most tracks that's all of them
+MARKETS = [f"{first}{second}" for first in "ABCDEFGHIJKLMNOPQRSTUVWXYZ" for second in "ABCDEFG"][:185]
+
+def make_links(kind: str, item_id: str) -> dict:
+
+    return {
+        "external_urls": {"spotify": f"https://open.spotify.com/{kind}/{item_id}"},
+        "href": f"https://api.spotify.com/v1/{kind}s/{item_id}",
+        "uri": f"spotify:{kind}:{item_id}"
+    }
+
+def make_artist(artist_id: str, name: str) -> dict:
+
+    return {"id": artist_id, "name": name, "type": "artist", **make_links(kind="artist", item_id=artist_id)}
+
+def make_images(item_id: str) -> list[dict]:
+
+    return [{"height": size, "width": size, "url": f"https://i.scdn.co/image/{item_id}{size}"} for size in (640, 300, 64)]
+
+""" Albums are handed out in turn, so once every album has been used once the rest of the tracks reuse them (spread over every page, not bunched up). """
+def make_album(settings: MockSettings, album_number: int) -> dict:
+
+    return {
+        "album_type": "single" if album_number % 3 == 0 else "album",
+        "artists": [make_artist(artist_id=f"artist{album_number % 500}", name=f"Release Artist {album_number % 500}")],
+        "available_markets": MARKETS,
+        "id": f"album{album_number}",
+        "images": make_images(item_id=f"album{album_number}"),
+        "name": f"Album {album_number}",
+        "release_date": "1999" if album_number % 10 == 0 else f"20{album_number % 25:02}-{album_number % 12 + 1:02}-{album_number % 28 + 1:02}",
+        "release_date_precision": "year" if album_number % 10 == 0 else "day",
+        "total_tracks": 10,
+        "type": "album",
+        **make_links(kind="album", item_id=f"album{album_number}")
+    }
+
+def make_item(settings: MockSettings, track_number: int) -> dict:
+
+    return {
+        "added_at": "2024-01-01T00:00:00Z",
+        "added_by": {"id": "bench", "type": "user", **make_links(kind="user", item_id="bench")},
+        "is_local": False,
+        "track": {
+            "album": make_album(settings=settings, album_number=track_number % settings.album_count),
+            "artists": [make_artist(artist_id=f"artist{(track_number + n) % 2000}", name=f"Artist {(track_number + n) % 2000}") for n in range(1 + track_number % 3)],
+            "available_markets": MARKETS,
+            "disc_number": 1,
+            "duration_ms": 120_000 + (track_number * 7919) % 240_000,
+            "explicit": track_number % 5 == 0,
+            "external_ids": {"isrc": f"GBXXX{track_number:07}"},
+            "id": f"track{track_number}",
+            "is_local": False,
+            "name": f"Track {track_number}",
+            "popularity": track_number % 100,
+            "preview_url": f"https://p.scdn.co/mp3-preview/track{track_number}",
+            "track_number": 1 + track_number % 10,
+            "type": "track",
+            **make_links(kind="track", item_id=f"track{track_number}")
+        }
+    }
+
+def make_full_album(settings: MockSettings, album_id: str) -> dict | None:
+
+    if not album_id.startswith("album") or not album_id[5:].isdigit() or int(album_id[5:]) >= settings.album_count:
+        return None # spotify gives null for ids it doesn't know
+
+    album_number = int(album_id[5:])
+    album = make_album(settings=settings, album_number=album_number)
+    album["copyrights"] = [{"text": f"(C) {album_number} Records", "type": "C"}, {"text": f"(P) {album_number} Records", "type": "P"}]
+    album["external_ids"] = {"upc": f"{album_number:012}"}
+    album["label"] = f"Label {album_number % 50}"
+    # the full album object embeds its first page of tracks, which spex never reads
+    album["tracks"] = {
+        "href": f"https://api.spotify.com/v1/albums/{album_id}/tracks?offset=0&limit=50",
+        "items": [{key: value for key, value in make_item(settings=settings, track_number=album_number * 10 + n)["track"].items() if key != "album"} for n in range(10)],
+        "limit": 50,
+        "next": None,
+        "offset": 0,
+        "previous": None,
+        "total": 10
+    }
+
+    return album
+
+"""
+    Parses a spotify fields filter like name,tracks(items(track(id,name))) into nested dicts, a field that isn't followed by brackets maps to None (keep all of it).
+"""
+def parse_fields(fields: str) -> dict:
+
+    tree = {}
+    stack = [tree]
+    name = ""
+    for character in fields + ",":
+        if character == "(":
+            subtree = {}
+            stack[-1][name.strip()] = subtree
+            stack.append(subtree)
+            name = ""
+        elif character in ",)":
+            if name.strip():
+                stack[-1][name.strip()] = None
+            name = ""
+            if character == ")":
+                stack.pop()
+        else:
+            name += character
+
+    return tree
+
+""" Keeps only the fields in tree, filters on a list apply to each thing in it the same as spotify's do. """
+def project(value, tree: dict | None):
+
+    if tree is None:
+        return value
+    if isinstance(value, list):
+        return [project(value=element, tree=tree) for element in value]
+    if isinstance(value, dict):
+        return {key: project(value=value[key], tree=subtree) for key, subtree in tree.items() if key in value}
+
+    return value
+
+class MockSpotifyServer(ThreadingHTTPServer):
+
+    daemon_threads = True
+
+    def __init__(self, address: tuple[str, int], settings: MockSettings):
+
+        super().__init__(address, MockSpotifyHandler)
+        self.settings = settings
+        self.random = random.Random(settings.seed)
+        self.lock = threading.Lock()
+        self.requests = Counter()
+        self.statuses = Counter()
+        self.bytes = Counter()
+        self.tokens = 0
+
+        # pages are the same every time they're asked for, so they're only made once
+        self.page_body = lru_cache(maxsize=1024)(self.make_page_body)
+
+    def base_url(self) -> str:
+
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def make_page_body(self, offset: int, limit: int, fields: str | None = None) -> bytes:
+
+        settings = self.settings
+        end = min(offset + limit, settings.tracks)
+        href = f"{self.base_url()}/v1/playlists/bench/tracks?offset={offset}&limit={limit}"
+
+        page = {
+            "href": href,
+            "items": [make_item(settings=settings, track_number=n) for n in range(offset, end)],
+            "limit": limit,
+            "next": f"{self.base_url()}/v1/playlists/bench/tracks?offset={end}&limit={limit}" if end < settings.tracks else None,
+            "offset": offset,
+            "previous": None,
+            "total": settings.tracks
+        }
+
+        return json.dumps(project(value=page, tree=parse_fields(fields=fields) if fields else None)).encode()
+
+    """ Picks whether this request fails and how. Only one roll is made so the rates add up rather than overlap. """
+    def pick_failure(self) -> int | None:
+
+        settings = self.settings
+        with self.lock:
+            roll = self.random.random()
+
+        if roll < settings.throttle_rate:
+            return 429
+        if roll < settings.throttle_rate + settings.unauthorized_rate:
+            return 401
+        if roll < settings.throttle_rate + settings.unauthorized_rate + settings.server_error_rate:
+            return 503
+
+        return None
+
+    def count(self, endpoint: str, status: int, size: int = 0) -> None:
+
+        with self.lock:
+            self.requests[endpoint] += 1
+            self.statuses[status] += 1
+            self.bytes[endpoint] += size
+
+    def stats(self, reset: bool = False) -> dict:
+
+        with self.lock:
+            stats = {"requests": dict(self.requests), "statuses": {str(status): count for status, count in self.statuses.items()}, "total": sum(self.requests.values()),
+                     "bytes": dict(self.bytes)}
+            if reset:
+                self.requests.clear()
+                self.statuses.clear()
+                self.bytes.clear()
+
+        return stats
+
+class MockSpotifyHandler(BaseHTTPRequestHandler):
+
+    protocol_version = "HTTP/1.1" # keep alive, like the real api
+    disable_nagle_algorithm = True # headers and body are separate writes, without this every response on a kept alive connection waits for a delayed ack
+
+    def log_message(self, format, *args) -> None:
+
+        pass
+
+    def send_json(self, status: int, body: bytes, headers: dict | None = None) -> None:
+
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_error_json(self, status: int, message: str, headers: dict | None = None) -> None:
+
+        self.send_json(status=status, body=json.dumps({"error": {"status": status, "message": message}}).encode(), headers=headers)
+
+    def do_POST(self) -> None:
+
+        server = self.server
+        self.rfile.read(int(self.headers.get("Content-Length", 0)))
+
+        if urlsplit(self.path).path != "/api/token":
+            server.count(endpoint="other", status=404)
+            return self.send_error_json(status=404, message="Not found")
+
+        with server.lock:
+            server.tokens += 1
+            access_token = f"token{server.tokens}"
+        server.count(endpoint="token", status=200)
+        self.send_json(status=200, body=json.dumps({"access_token": access_token, "token_type": "Bearer", "expires_in": 3600}).encode())
+
+    def do_GET(self) -> None:
+
+        server = self.server
+        settings = server.settings
+        url = urlsplit(self.path)
+        query = parse_qs(url.query)
+        parts = url.path.strip("/").split("/")
+
+        if url.path == "/_stats":
+            return self.send_json(status=200, body=json.dumps(server.stats(reset="reset" in query)).encode())
+
+        if parts[:2] == ["v1", "playlists"] and len(parts) == 3:
+            endpoint = "playlist"
+        elif parts[:2] == ["v1", "playlists"] and len(parts) == 4 and parts[3] == "tracks":
+            endpoint = "tracks"
+        elif parts == ["v1", "albums"]:
+            endpoint = "albums"
+        else:
+            server.count(endpoint="other", status=404)
+            return self.send_error_json(status=404, message="Not found")
+
+        if settings.latency:
+            time.sleep(settings.latency)
+
+        failure = server.pick_failure()
+        if not self.headers.get("Authorization", "").startswith("Bearer "):
+            failure = 401
+
+        if failure is not None:
+            server.count(endpoint=endpoint, status=failure)
+            if failure == 429:
+                return self.send_error_json(status=429, message="API rate limit exceeded", headers={"Retry-After": str(settings.retry_after)})
+            if failure == 401:
+                return self.send_error_json(status=401, message="The access token expired")
+            return self.send_error_json(status=503, message="Service unavailable")
+
+        if endpoint != "albums" and parts[2].startswith("missing"):
+            server.count(endpoint=endpoint, status=404)
+            return self.send_error_json(status=404, message="Resource not found")
+
+        if endpoint == "albums" and len(query.get("ids", [""])[0].split(",")) > 20:
+            server.count(endpoint=endpoint, status=400)
+            return self.send_error_json(status=400, message="Too many ids requested")
+
+        fields = query.get("fields", [None])[0]
+        if endpoint == "playlist":
+            first_page = json.loads(server.page_body(offset=0, limit=settings.page_size))
+            playlist = {
+                "description": "",
+                "followers": {"href": None, "total": 0},
+                "id": parts[2],
+                "images": make_images(item_id=parts[2]),
+                "name": f"Benchmark {settings.tracks}",
+                "owner": {"id": "bench", "type": "user", **make_links(kind="user", item_id="bench")},
+                "public": True,
+                "snapshot_id": f"snapshot{settings.tracks}",
+                "tracks": first_page,
+                **make_links(kind="playlist", item_id=parts[2])
+            }
+            body = json.dumps(project(value=playlist, tree=parse_fields(fields=fields) if fields else None)).encode()
+        elif endpoint == "tracks":
+            offset = int(query.get("offset", ["0"])[0])
+            limit = min(int(query.get("limit", [str(settings.page_size)])[0]), settings.page_size)
+            body = server.page_body(offset=offset, limit=limit, fields=fields)
+        else:
+            album_ids = query.get("ids", [""])[0].split(",")
+            body = json.dumps({"albums": [make_full_album(settings=settings, album_id=album_id) for album_id in album_ids]}).encode()
+
+        server.count(endpoint=endpoint, status=200, size=len(body))
+        self.send_json(status=200, body=body)
+
+def serve(settings: MockSettings, host: str, port: int, ready=None) -> None:
+
+    server = MockSpotifyServer(address=(host, port), settings=settings)
+    if ready is not None:
+        ready.put(server.server_address[1])
+    server.serve_forever()
+
+"""
+    Runs the server in its own process so making the responses doesn't fight the client being measured for the GIL, and so the client's peak memory doesn't
+    include the server's. Use it as a context manager.
+"""
+class MockSpotify:
+
+    def __init__(self, settings: MockSettings, host: str = "127.0.0.1", port: int = 0):
+
+        self.settings = settings
+        self.host = host
+        self.port = port
+        self.process = None
+
+    def __enter__(self) -> "MockSpotify":
+
+        self.start()
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+
+        self.stop()
+
+    def start(self) -> None:
+
+        ready = multiprocessing.Queue()
+        self.process = multiprocessing.Process(target=serve, kwargs={"settings": self.settings, "host": self.host, "port": self.port, "ready": ready}, daemon=True)
+        self.process.start()
+        self.port = ready.get(timeout=30)
+
+    def stop(self) -> None:
+
+        if self.process is not None:
+            self.process.terminate()
+            self.process.join()
+            self.process = None
+
+    @property
+    def base_url(self) -> str:
+
+        return f"http://{self.host}:{self.port}/v1"
+
+    @property
+    def token_url(self) -> str:
+
+        return f"http://{self.host}:{self.port}/api/token"
+
+    """ Request counts since the last reset, by endpoint and by status. """
+    def stats(self, reset: bool = False) -> dict:
+
+        url = f"http://{self.host}:{self.port}/_stats" + ("?reset=1" if reset else "")
+        with urllib.request.urlopen(url) as response:
+            return json.loads(response.read())
+
+def main() -> None:
+
+    defaults = MockSettings()
+    parser = argparse.ArgumentParser(description="Serve a synthetic spotify playlist for benchmarking")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--tracks", type=int, default=defaults.tracks)
+    parser.add_argument("--album-reuse", type=float, default=defaults.album_reuse)
+    parser.add_argument("--page-size", type=int, default=defaults.page_size)
+    parser.add_argument("--latency", type=float, default=defaults.latency)
+    parser.add_argument("--throttle-rate", type=float, default=defaults.throttle_rate)
+    parser.add_argument("--unauthorized-rate", type=float, default=defaults.unauthorized_rate)
+    parser.add_argument("--server-error-rate", type=float, default=defaults.server_error_rate)
+    parser.add_argument("--retry-after", type=int, default=defaults.retry_after)
+    parser.add_argument("--seed", type=int, default=defaults.seed)
+    args = parser.parse_args()
+
+    settings = MockSettings(tracks=args.tracks, album_reuse=args.album_reuse, page_size=args.page_size, latency=args.latency, throttle_rate=args.throttle_rate,
+                            unauthorized_rate=args.unauthorized_rate, server_error_rate=args.server_error_rate, retry_after=args.retry_after, seed=args.seed)
+    print(f"Serving {json.dumps(asdict(settings))} on http://{args.host}:{args.port}/v1")
+    serve(settings=settings, host=args.host, port=args.port)
+
+if __name__ == "__main__":
+    main()
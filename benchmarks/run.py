@@ -0,0 +1,219 @@
+import argparse
+import asyncio
+from importlib.util import find_spec
+import json
+from pathlib import Path
+import sys
+from tempfile import TemporaryDirectory
+import time
+import tracemalloc
+from typing import Any, Callable
+
+from spex.api_client import create_session
+from spex.api_client import get_playlist
+from spex.api_client import set_client
+from spex.exporter import write_csv
+from spex.exporter import write_ndjson
+from spex.exporter import write_parquet
+from spex.exporter import write_xlsx
+from spex.formatter import iter_rows
+from spex.formatter import playlist_frame_formatter
+from spex.rate_limiter import RateLimiter
+from spex.token_provider import TokenProvider
+
+from benchmarks.mock_spotify import MockSettings
+from benchmarks.mock_spotify import MockSpotify
+
+"""
+    Runs spex end to end against the mock spotify server and reports how long each stage took, how many requests it made, tracks per second and peak memory. Save
+    a run with --save and pass it to --compare on a later run to see what a change did to each stage.
+
+        python -m benchmarks.run --tracks 100 1000 10000 --album-reuse 0.8 --latency 0.01 --throttle-rate 0.01
+        python -m benchmarks.run --tracks 50000 --save before.json
+        python -m benchmarks.run --tracks 50000 --compare before.json
+
+    Peak memory comes from tracemalloc, which slows python down, so pass --no-memory when only the timings matter. The rate limiter is set well above spotify's
+    limit by default so the numbers show the client rather than the limiter, use --rate to put it back.
+"""
+
+EXPORTERS = ["xlsx", "csv", "parquet", "ndjson"]
+
+def measure(stage: str, tracks: int, work: Callable[[], Any], server: MockSpotify | None = None, memory: bool = True) -> tuple[dict, Any]:
+
+    if server is not None:
+        server.stats(reset=True)
+    if memory:
+        tracemalloc.start()
+
+    start = time.perf_counter()
+    result = work()
+    wall_time = time.perf_counter() - start
+
+    peak = None
+    if memory:
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+    stats = server.stats() if server is not None else None
+    record = {
+        "stage": stage,
+        "tracks": tracks,
+        "requests": stats["total"] if stats is not None else None,
+        "response_mb": sum(stats["bytes"].values()) / 1024 / 1024 if stats is not None else None,
+        "statuses": stats["statuses"] if stats is not None else None,
+        "wall_time": wall_time,
+        "tracks_per_second": tracks / wall_time if wall_time > 0 else None,
+        "peak_mb": peak / 1024 / 1024 if peak is not None else None
+    }
+
+    return (record, result)
+
+def fetch_sync(server: MockSpotify, rate_limiter: RateLimiter) -> dict:
+
+    session = create_session(pool_size=rate_limiter.max_concurrency)
+    token_provider = TokenProvider(client_id="bench", client_secret="bench", token_url=server.token_url)
+    client = set_client(client_id="bench", client_secret="bench", token_provider=token_provider, rate_limiter=rate_limiter, session=session,
+                        base_url=server.base_url)
+
+    playlist, client = get_playlist(client=client, playlist_id="bench")
+    session.close()
+    if playlist.data is None:
+        raise RuntimeError(f"get_playlist failed ({playlist.status}): {playlist.error}")
+
+    return playlist.data
+
+""" The web app's client. httpx is only needed for this one so it's imported here. """
+def fetch_async(server: MockSpotify, rate_limiter: RateLimiter) -> dict:
+
+    from spex import async_client
+
+    async def fetch() -> dict:
+
+        http = async_client.create_http_client(max_connections=rate_limiter.max_concurrency)
+        token_provider = TokenProvider(client_id="bench", client_secret="bench", token_url=server.token_url)
+        try:
+            client = await async_client.set_client(http=http, client_id="bench", client_secret="bench", token_provider=token_provider, rate_limiter=rate_limiter,
+                                                   base_url=server.base_url)
+            playlist, client = await async_client.get_playlist(client=client, playlist_id="bench")
+        finally:
+            await http.aclose()
+
+        if playlist.data is None:
+            raise RuntimeError(f"get_playlist failed ({playlist.status}): {playlist.error}")
+
+        return playlist.data
+
+    return asyncio.run(fetch())
+
+def export(export_format: str, tracks: list[dict], folder: Path) -> int:
+
+    save_path = folder / f"bench.{export_format}"
+    if export_format == "xlsx":
+        return write_xlsx(tracks=tracks, file=save_path)
+    elif export_format == "csv":
+        with open(save_path, "w", newline="", encoding="utf-8") as file:
+            return write_csv(rows=iter_rows(playlist_raw=tracks), file=file)
+    elif export_format == "parquet":
+        return write_parquet(tracks=tracks, file=save_path)
+    else:
+        with open(save_path, "w", encoding="utf-8") as file:
+            return write_ndjson(tracks=tracks, file=file)
+
+def run_size(settings: MockSettings, clients: list[str], exporters: list[str], rate: float, max_concurrency: int, memory: bool) -> list[dict]:
+
+    records = []
+    with MockSpotify(settings=settings) as server:
+
+        playlist = None
+        for client in clients:
+            # a fresh limiter per run so one run's throttling doesn't carry over to the next
+            rate_limiter = RateLimiter(rate=rate, burst=max(1, int(rate)), max_concurrency=max_concurrency, base_backoff=0.05)
+            fetch = fetch_sync if client == "sync" else fetch_async
+            record, playlist = measure(stage=f"get_playlist ({client})", tracks=settings.tracks, work=lambda: fetch(server=server, rate_limiter=rate_limiter),
+                                       server=server, memory=memory)
+            records.append(record)
+
+    tracks = playlist["items"]
+    record, _ = measure(stage="playlist_frame_formatter", tracks=len(tracks), work=lambda: playlist_frame_formatter(playlist_raw=tracks), memory=memory)
+    records.append(record)
+
+    with TemporaryDirectory() as folder:
+        for export_format in exporters:
+            record, _ = measure(stage=f"export {export_format}", tracks=len(tracks), work=lambda: export(export_format=export_format, tracks=tracks, folder=Path(folder)),
+                                memory=memory)
+            records.append(record)
+
+    return records
+
+def format_number(value: float | None, digits: int = 2) -> str:
+
+    return "-" if value is None else f"{value:,.{digits}f}"
+
+def print_records(records: list[dict], baseline: list[dict] | None = None) -> None:
+
+    baseline_speeds = {(record["stage"], record["tracks"]): record["tracks_per_second"] for record in baseline or []}
+
+    header = f"{'stage':<28}{'tracks':>8}{'requests':>10}{'resp MB':>10}{'wall s':>10}{'tracks/s':>12}{'peak MB':>10}"
+    if baseline is not None:
+        header += f"{'vs base':>10}"
+    print(header)
+
+    for record in records:
+        line = (f"{record['stage']:<28}{record['tracks']:>8}{record['requests'] if record['requests'] is not None else '-':>10}"
+                f"{format_number(record.get('response_mb'), 1):>10}{format_number(record['wall_time'], 3):>10}"
+                f"{format_number(record['tracks_per_second'], 0):>12}{format_number(record['peak_mb'], 1):>10}")
+
+        if baseline is not None:
+            baseline_speed = baseline_speeds.get((record["stage"], record["tracks"]))
+            change = None
+            if baseline_speed and record["tracks_per_second"]:
+                change = record["tracks_per_second"] / baseline_speed
+            line += f"{format_number(change) + 'x' if change is not None else '-':>10}"
+
+        print(line)
+
+def main() -> None:
+
+    defaults = MockSettings()
+    parser = argparse.ArgumentParser(description="Benchmark spex against a local mock of the spotify api")
+    parser.add_argument("--tracks", type=int, nargs="+", default=[100, 1000, 10000], help="Playlist sizes to run, each one gets its own server")
+    parser.add_argument("--album-reuse", type=float, default=defaults.album_reuse, help="Share of tracks on an album an earlier track was already on")
+    parser.add_argument("--page-size", type=int, default=defaults.page_size)
+    parser.add_argument("--latency", type=float, default=defaults.latency, help="Seconds the server waits before every response")
+    parser.add_argument("--throttle-rate", type=float, default=defaults.throttle_rate, help="Chance of a request getting a 429")
+    parser.add_argument("--unauthorized-rate", type=float, default=defaults.unauthorized_rate, help="Chance of a request getting a 401")
+    parser.add_argument("--server-error-rate", type=float, default=defaults.server_error_rate, help="Chance of a request getting a 503")
+    parser.add_argument("--retry-after", type=int, default=defaults.retry_after)
+    parser.add_argument("--seed", type=int, default=defaults.seed)
+    parser.add_argument("--client", choices=["sync", "async"], nargs="+", default=["sync"], help="Which clients to fetch the playlist with")
+    parser.add_argument("--exporters", choices=EXPORTERS, nargs="*", default=EXPORTERS)
+    parser.add_argument("--rate", type=float, default=1000.0, help="Rate limiter requests per second")
+    parser.add_argument("--max-concurrency", type=int, default=8)
+    parser.add_argument("--no-memory", action="store_true", help="Skip tracemalloc, timings are more accurate without it")
+    parser.add_argument("--save", type=Path, help="Write the results to this json file")
+    parser.add_argument("--compare", type=Path, help="Compare tracks per second with results saved by --save")
+    args = parser.parse_args()
+
+    exporters = args.exporters
+    if "parquet" in exporters and find_spec("pyarrow") is None:
+        print("pyarrow isn't installed, skipping parquet (pip install spex[columnar])", file=sys.stderr)
+        exporters = [export_format for export_format in exporters if export_format != "parquet"]
+
+    if "async" in args.client:
+        import spex.async_client # imported up front so the first async run isn't timed with httpx's import
+
+    records = []
+    for tracks in args.tracks:
+        settings = MockSettings(tracks=tracks, album_reuse=args.album_reuse, page_size=args.page_size, latency=args.latency, throttle_rate=args.throttle_rate,
+                                unauthorized_rate=args.unauthorized_rate, server_error_rate=args.server_error_rate, retry_after=args.retry_after, seed=args.seed)
+        records.extend(run_size(settings=settings, clients=args.client, exporters=exporters, rate=args.rate, max_concurrency=args.max_concurrency,
+                                memory=not args.no_memory))
+
+    baseline = json.loads(args.compare.read_text())["records"] if args.compare is not None else None
+    print_records(records=records, baseline=baseline)
+
+    if args.save is not None:
+        args.save.write_text(json.dumps({"argv": sys.argv[1:], "records": records}, indent=2))
+
+if __name__ == "__main__":
+    main()
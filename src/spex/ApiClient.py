@@ -1,168 +1,126 @@
-import base64
-from dataclasses import dataclass
-import json
-import time
-from typing import Any, Optional
+from typing import Optional
 
 import requests
 
-@dataclass
-class ApiResult:
-    
-    data: Optional[Any]
-    status: Optional[int]
-    error: Optional[str]
+from spex.album_cache import slim_album
+from spex.api_client import ALBUM_BATCH_SIZE
+from spex.api_client import ApiResult
+from spex.api_client import BASE_URL
+from spex.api_client import ClientDetails
+from spex.api_client import create_session
+from spex.api_client import make_request
+from spex.api_client import page_url
+from spex.api_client import playlist_url
+from spex.api_client import read_album
+from spex.api_client import read_track
+from spex.api_client import use_current_token
+from spex.rate_limiter import RateLimiter
+from spex.records import Track
+from spex.records import UNAVAILABLE_ALBUM
+from spex.token_provider import TokenProvider
 
 class ApiClient:
 
-    def __init__(self, client_id: str, client_secret: str):
+    def __init__(self, client_id: str, client_secret: str, token_provider: Optional[TokenProvider] = None, rate_limiter: Optional[RateLimiter] = None,
+                 session: Optional[requests.Session] = None, base_url: str = BASE_URL):
 
         self.client_id = client_id
         self.client_secret = client_secret
         
-        self.access_token = None
         self.refresh_token = None # this isn't available for client credentials flow
-        self.headers = None
+        # pass a shared provider in to reuse one token between clients
+        self.token_provider = token_provider if token_provider is not None else TokenProvider(client_id=client_id, client_secret=client_secret)
+        
+        self.rate_limiter = rate_limiter if rate_limiter is not None else RateLimiter()
+        # keeps connections open between requests so only the first one pays for the handshake
+        self.session = session if session is not None else create_session(pool_size=self.rate_limiter.max_concurrency)
         
-        self.base_url = "http://api.spotify.com/v1"
-        self.wait_time = 0
+        self.base_url = base_url
+
+        # what api_client.make_request works with, so requests go through the same retry loop as the functional client
+        self.details = ClientDetails(id=client_id, secret=client_secret, base_url=base_url, access_token=None, headers=None,
+                                     max_workers=self.rate_limiter.max_concurrency, token_provider=self.token_provider, rate_limiter=self.rate_limiter,
+                                     session=self.session)
 
         self.set_access_tokens()
-        self.set_headers()
 
-    """ Client credentials flow """
+    @property
+    def access_token(self) -> Optional[str]:
+
+        return self.details.access_token
+
+    @property
+    def headers(self) -> Optional[dict]:
+
+        return self.details.headers
+
+    """ Client credentials flow, the provider only does the handshake when the token it has is about to expire """
     def set_access_tokens(self):
 
-        auth_string = self.client_id + ":" + self.client_secret
-        auth_bytes = auth_string.encode("utf-8")
-        auth_base64 = str(base64.b64encode(auth_bytes), "utf-8")
-
-        auth_url = "https://accounts.spotify.com/api/token"
-        auth_headers = {
-            "Authorization": "Basic " + auth_base64,
-            "Content-Type": "application/x-www-form-urlencoded"
-        }
-        body = {"grant_type": "client_credentials"}
-        json_response = requests.post(url=auth_url, headers=auth_headers, data=body)
-        response = json.loads(json_response.content) # could do with some error handling here
-        
-        self.access_token = response["access_token"]
+        self.use_current_token()
 
-    def set_headers(self):
+    """ Picks up the providers token if it has been refreshed since the last request """
+    def use_current_token(self):
 
-        self.headers = {
-            "Authorization": "Bearer " + self.access_token
-        }
+        self.details = use_current_token(client=self.details)
 
+    """ api_client.make_request does the work, the rate limiter spaces requests out and decides how long to back off after a 429 or 5xx """
     def request(self, url: str) -> ApiResult:
 
-        time.sleep(self.wait_time)
-
-        try:
-            json_response = requests.get(url=url, headers=self.headers)
-            json_response.raise_for_status()
-            response = json.loads(json_response.content)
-
-            return ApiResult(data=response, status=json_response.status_code, error=None)
-
-        except requests.exceptions.HTTPError as reqerr:
-            
-            if reqerr.response.status_code == 401:
-
-                self.set_access_tokens()
-                try:
-                    
-                    json_retry_response = requests.get(url=url, headers=self.headers)
-                    json_retry_response.raise_for_status()
-                    retry_response = json.loads(json_retry_response.content)
-
-                    return ApiResult(data=retry_response, status=json_retry_response.status_code, error=None)
-                
-                except requests.exceptions.HTTPError as retry_reqerr:
-                
-                    return ApiResult(data=None, status=retry_reqerr.response.status_code, error=retry_reqerr.response.json().get("error", {}).get("message", "No error message provided"))
-                
-                except json.decoder.JSONDecodeError as retry_jsonerr:
-                
-                    return ApiResult(data=None, status=json_retry_response.status_code, error="")
-            
-            elif reqerr.response.status_code == 429:
-
-                if self.wait_time == 0:
-                    self.wait_time = 0.2
-                else:
-                    self.wait_time *= 2
-
-                time.sleep(self.wait_time)
-
-                try:
-                    
-                    json_retry_response = requests.get(url=url, headers=self.headers)
-                    json_retry_response.raise_for_status()
-                    retry_response = json.loads(json_retry_response.content)
-
-                    return ApiResult(data=retry_response, status=json_retry_response.status_code, error=None)
-
-                except requests.exceptions.HTTPError as retry_reqerr:
-                    
-                    return ApiResult(data=None, status=retry_reqerr.response.status_code, error=retry_reqerr.response.json().get("error", {}).get("message", "No error message provided"))
-                
-                except json.decoder.JSONDecodeError as retry_jsonerr:
-                    
-                    return ApiResult(data=None, status=json_retry_response.status_code, error="")
-            else:
-                return ApiResult(data=None, status=json_response.status_code, error=reqerr.response.json().get("error", {}).get("message", "No error message provided"))
-        
-        except json.decoder.JSONDecodeError as jsonerr:
-            return ApiResult(data=None, status=json_response.status_code, error="")
+        result, self.details = make_request(client=self.details, url=url)
+
+        return result
         
-    def __load_tracks(self, playlist_page: dict) -> list[dict]:
-
-        tracks = []
-        for item in playlist_page["items"]:
-
-            track_dict = {}
-            track_dict["trackRequest"] = {}
-            track_dict["albumRequest"] = {}
-
-            track_dict["trackRequest"]["releaseArtists"] = item["track"]["album"]["artists"]
-            track_dict["trackRequest"]["featuredArtists"] = item["track"]["artists"]
-            track_dict["trackRequest"]["trackTitle"] = item["track"]["name"]
-            track_dict["trackRequest"]["trackId"] = item["track"]["id"]
-            track_dict["trackRequest"]["trackDuration"] = item["track"]["duration_ms"]
-            track_dict["trackRequest"]["isrc"] = item["track"]["external_ids"]["isrc"]
-            track_dict["trackRequest"]["albumTitle"] = item["track"]["album"]["name"]
-            track_dict["trackRequest"]["albumId"] = item["track"]["album"]["id"]
-            track_dict["trackRequest"]["albumType"] = item["track"]["album"]["album_type"]
-            track_dict["trackRequest"]["releaseDate"] = item["track"]["album"]["release_date"]
-
-            item_album = self.request(url=f"{self.base_url}/albums/{track_dict["trackRequest"]["albumId"]}")
-
-            if item_album.data is not None:
-                track_dict["albumRequest"]["upc"] = item_album.data["external_ids"]["upc"]
-                track_dict["albumRequest"]["copyRights"] = item_album.data["copyrights"]
-                track_dict["albumRequest"]["label"] = item_album.data["label"]
-            else:
-                track_dict["albumRequest"]["upc"] = "UNAVAILABLE"
-                track_dict["albumRequest"]["copyRights"] = "UNAVAILABLE"
-                track_dict["albumRequest"]["label"] = "UNAVAILABLE"
-
-            tracks.append(track_dict)
+    """ Loads albums 20 at a time through /albums?ids=, albums that fail are left out of the returned dict """
+    def load_albums(self, album_ids: list[str]) -> dict[str, dict]:
+
+        albums = {}
+        for start in range(0, len(album_ids), ALBUM_BATCH_SIZE):
+
+            chunk = album_ids[start:start + ALBUM_BATCH_SIZE]
+            response = self.request(url=f"{self.base_url}/albums?ids={','.join(chunk)}")
+
+            if response.data is not None:
+                for album in response.data["albums"]:
+                    if album is not None:
+                        albums[album["id"]] = slim_album(album=album)
+
+        return albums
+
+    def __enrich_tracks(self, tracks: list[Track]) -> list[Track]:
+
+        album_ids = list(dict.fromkeys(track.album_id for track in tracks if track.album_id is not None))
+        albums = self.load_albums(album_ids=album_ids)
+
+        album_records = {album_id: read_album(album=albums.get(album_id)) for album_id in album_ids}
+        for track in tracks:
+            track.album = album_records.get(track.album_id, UNAVAILABLE_ALBUM)
+
+        return tracks
+
+    def __load_page_tracks(self, playlist_page: dict) -> list[Track]:
+
+        tracks = [read_track(item=item) for item in playlist_page["items"]]
 
         if playlist_page["next"] is not None:
-            new_page = self.request(url=playlist_page["next"])
+            # next loses the fields filter, page_url puts it back
+            new_page = self.request(url=page_url(href=playlist_page["next"], offset=playlist_page["offset"] + playlist_page["limit"], limit=playlist_page["limit"]))
             if new_page.data is not None:
-                tracks.extend(self.__load_tracks(new_page.data))
+                tracks.extend(self.__load_page_tracks(new_page.data))
         
         return tracks
+
+    def __load_tracks(self, playlist_page: dict) -> list[Track]:
+
+        return self.__enrich_tracks(self.__load_page_tracks(playlist_page))
     
     def get_playlist(self, playlist_id: str) -> dict | None:
 
-        playlist = self.request(url=f"{self.base_url}/playlists/{playlist_id}")
+        playlist = self.request(url=playlist_url(base_url=self.base_url, playlist_id=playlist_id))
         if playlist.data is not None:
             playlist_dict = {
                 "name": playlist.data["name"],
-                "items": self.__load_tracks(playlist_page=playlist.data)
+                "items": self.__load_tracks(playlist_page=playlist.data["tracks"])
             }
             return playlist_dict # could return an ApiResult(data=playlist_dict, ...)
         else:
@@ -0,0 +1,146 @@
+import json
+import os
+from pathlib import Path
+import threading
+import time
+
+from spex.metrics import METRICS
+from spex.sqlite_store import open_database
+
+"""
+    Album metadata (upc, label, copyrights) basically never changes, so rather than asking spotify for it on every run we keep it in a small sqlite database keyed
+    by album id. Entries older than ttl seconds count as misses and get refetched. When the cache grows past max_entries or max_bytes the least recently used
+    albums are dropped first. hits and misses are counted so we can see how well it's doing.
+"""
+class AlbumCache:
+
+    def __init__(self, path: str | Path, ttl: float = 30 * 24 * 60 * 60, max_entries: int | None = 100_000, max_bytes: int | None = 256 * 1024 * 1024):
+
+        self.path = Path(path)
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+
+        self.hits = 0
+        self.misses = 0
+
+        self.lock = threading.Lock()
+        self.connection = open_database(path=self.path, schema=(
+            "CREATE TABLE IF NOT EXISTS albums (id TEXT PRIMARY KEY, data TEXT NOT NULL, fetched_at REAL NOT NULL, used_at REAL NOT NULL)",
+            "CREATE INDEX IF NOT EXISTS albums_used_at ON albums (used_at)"
+        ))
+
+    """ Returns the albums that are in the cache and still fresh, anything missing or expired is left out and counted as a miss. """
+    def get_many(self, album_ids: list[str]) -> dict[str, dict]:
+
+        if not album_ids:
+            return {}
+
+        now = time.time()
+        albums = {}
+        with self.lock:
+
+            # sqlite caps how many variables a statement can take so look them up in chunks
+            for start in range(0, len(album_ids), 500):
+                chunk = album_ids[start:start + 500]
+                placeholders = ",".join("?" * len(chunk))
+                rows = self.connection.execute(f"SELECT id, data FROM albums WHERE id IN ({placeholders}) AND fetched_at >= ?", (*chunk, now - self.ttl))
+                for album_id, data in rows:
+                    albums[album_id] = json.loads(data)
+
+            self.connection.executemany("UPDATE albums SET used_at = ? WHERE id = ?", [(now, album_id) for album_id in albums])
+            self.connection.commit()
+
+        self.hits += len(albums)
+        self.misses += len(album_ids) - len(albums)
+        METRICS.inc(name="spex_album_cache_hits_total", amount=len(albums))
+        METRICS.inc(name="spex_album_cache_misses_total", amount=len(album_ids) - len(albums))
+
+        return albums
+
+    """ Stores only the album fields read_album reads, the rest of spotify's album object (track list, images etc.) isn't worth the disk space. """
+    def put_many(self, albums: dict[str, dict]) -> None:
+
+        if not albums:
+            return
+
+        now = time.time()
+        rows = [(album_id, json.dumps(slim_album(album=album), separators=(",", ":")), now, now) for album_id, album in albums.items()]
+
+        with self.lock:
+            self.connection.executemany("INSERT OR REPLACE INTO albums (id, data, fetched_at, used_at) VALUES (?, ?, ?, ?)", rows)
+            self.evict()
+            self.connection.commit()
+
+    """ Drops expired albums, then the least recently used ones until the cache fits in max_entries and max_bytes. Expects the lock to already be held. """
+    def evict(self) -> None:
+
+        self.connection.execute("DELETE FROM albums WHERE fetched_at < ?", (time.time() - self.ttl,))
+
+        if self.max_entries is not None:
+            self.connection.execute(
+                "DELETE FROM albums WHERE id IN (SELECT id FROM albums ORDER BY used_at DESC LIMIT -1 OFFSET ?)", (self.max_entries,)
+            )
+
+        if self.max_bytes is not None:
+            total_bytes = self.connection.execute("SELECT COALESCE(SUM(LENGTH(data)), 0) FROM albums").fetchone()[0]
+            if total_bytes > self.max_bytes:
+
+                excess = total_bytes - self.max_bytes
+                freed = 0
+                stale_ids = []
+                for album_id, size in self.connection.execute("SELECT id, LENGTH(data) FROM albums ORDER BY used_at ASC"):
+                    if freed >= excess:
+                        break
+                    stale_ids.append((album_id,))
+                    freed += size
+
+                self.connection.executemany("DELETE FROM albums WHERE id = ?", stale_ids)
+
+    def stats(self) -> dict:
+
+        with self.lock:
+            entries, total_bytes = self.connection.execute("SELECT COUNT(*), COALESCE(SUM(LENGTH(data)), 0) FROM albums").fetchone()
+
+        lookups = self.hits + self.misses
+
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "entries": entries,
+            "bytes": total_bytes
+        }
+
+    def close(self) -> None:
+
+        with self.lock:
+            self.connection.close()
+
+""" Just the album fields read_album reads. Spotify's album object also has the album's whole track list, images, markets and so on, none of which we use. """
+def slim_album(album: dict) -> dict:
+
+    return {
+        "id": album["id"],
+        "external_ids": {"upc": album["external_ids"].get("upc")},
+        "copyrights": album["copyrights"],
+        "label": album["label"]
+    }
+
+"""
+    Opens the cache using the settings from the environment (.env works too since main loads it first). SPEX_CACHE_DIR picks the folder, SPEX_ALBUM_CACHE_TTL is in
+    seconds, SPEX_ALBUM_CACHE_MAX_ENTRIES and SPEX_ALBUM_CACHE_MAX_BYTES cap the size. Setting SPEX_ALBUM_CACHE=0 turns it off and returns None.
+"""
+def open_album_cache() -> AlbumCache | None:
+
+    if os.getenv("SPEX_ALBUM_CACHE", "1") == "0":
+        return None
+
+    cache_dir = Path(os.getenv("SPEX_CACHE_DIR", Path.home() / ".cache" / "spex"))
+
+    return AlbumCache(
+        path=cache_dir / "albums.sqlite3",
+        ttl=float(os.getenv("SPEX_ALBUM_CACHE_TTL", 30 * 24 * 60 * 60)),
+        max_entries=int(os.getenv("SPEX_ALBUM_CACHE_MAX_ENTRIES", 100_000)),
+        max_bytes=int(os.getenv("SPEX_ALBUM_CACHE_MAX_BYTES", 256 * 1024 * 1024))
+    )
@@ -1,10 +1,40 @@
-import base64
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass
-import json
+from itertools import islice
 import time
-from typing import Any, Optional, Dict
+from typing import Any, Optional, Dict, Iterator
+from urllib.parse import parse_qsl, urlencode, urlsplit, urlunsplit
 
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from spex.album_cache import AlbumCache
+from spex.album_cache import slim_album
+from spex.cassette import Cassette
+from spex.cassette import CassetteAdapter
+from spex.checkpoints import Crawl
+from spex.checkpoints import CrawlCheckpoints
+from spex.metrics import METRICS
+from spex.rate_limiter import get_retry_after
+from spex.rate_limiter import RateLimiter
+from spex.rate_limiter import RETRY_STATUSES
+from spex.records import Album
+from spex.records import artist_names
+from spex.records import intern
+from spex.records import Track
+from spex.records import UNAVAILABLE_ALBUM
+from spex.token_provider import TokenProvider
+
+ALBUM_BATCH_SIZE = 20
+BASE_URL = "https://api.spotify.com/v1"
+
+# only the fields read_track reads. Left to itself spotify sends every market a track and its album are available in, images, urls and so on, which is most of
+# the page. The fields are nested the same way in the playlist's first page and in every page after it so they're built up from the one track filter
+TRACK_FIELDS = "track(id,name,duration_ms,external_ids(isrc),artists(name),album(id,name,album_type,release_date,release_date_precision,artists(name)))"
+PAGE_FIELDS = f"href,limit,next,offset,total,items({TRACK_FIELDS})"
+PLAYLIST_FIELDS = f"name,snapshot_id,tracks({PAGE_FIELDS})"
 
 @dataclass
 class ClientDetails:
@@ -14,7 +44,12 @@ class ClientDetails:
     base_url: Optional[str]
     access_token: Optional[str]
     headers: Optional[Dict]
-    wait_time: Optional[int]
+    max_workers: int = 8 # how many pages are fetched at once
+    album_cache: Optional[AlbumCache] = None
+    token_provider: Optional[TokenProvider] = None
+    rate_limiter: Optional[RateLimiter] = None
+    session: Optional[requests.Session] = None
+    checkpoints: Optional[CrawlCheckpoints] = None
 
 @dataclass
 class ApiResult:
@@ -23,178 +58,407 @@ class ApiResult:
     status: Optional[int]
     error: Optional[str]
 
+""" Raised by iter_tracks once the last track is out if some pages never loaded, a streamed export has already started by then so it can't be handed an ApiResult. """
+class IncompleteCrawlError(Exception):
+
+    def __init__(self, result: ApiResult):
+
+        super().__init__(result.error)
+        self.result = result
+
 """ 
     Uses client_id and client_secret to request auth info from the api. Function returns access token. This function follows the client credentials flow from
-    spotify web api documentation
+    spotify web api documentation. This is a one off handshake, clients get their tokens through a TokenProvider so they can be reused until they expire.
 """
 def get_access_token(client_id: str, client_secret: str) -> str:
     
-    auth_string = client_id + ":" + client_secret
-    auth_bytes = auth_string.encode("utf-8")
-    auth_base64 = str(base64.b64encode(auth_bytes), "utf-8")
-
-    auth_url = "https://accounts.spotify.com/api/token"
-    auth_headers = {
-        "Authorization": "Basic " + auth_base64,
-        "Content-Type": "application/x-www-form-urlencoded"
-    }
-    auth_body = {"grant_type": "client_credentials"}
-    json_response = requests.post(url=auth_url, headers=auth_headers, data=auth_body) # needs error handling
-    response = json.loads(json_response.content)
-    
-    return response["access_token"]
+    return TokenProvider(client_id=client_id, client_secret=client_secret).get_token()
+
+"""
+    A session keeps its connections open between requests, so after the first request to spotify every page and album request reuses a warm connection instead of
+    doing a new tcp and tls handshake. pool_size should be at least as big as the number of threads making requests or they end up opening throwaway connections.
+    The adapter only retries connection problems, status codes are left to make_request and the rate limiter. With a cassette the session records every
+    response into it, or answers every request from it without going near the network.
+"""
+def create_session(pool_size: int = 8, connect_retries: int = 3, cassette: Cassette | None = None) -> requests.Session:
+
+    # respect_retry_after_header has to be off too, otherwise urllib3 grabs any 429 with a Retry-After header and raises instead of handing it back
+    retries = Retry(total=connect_retries, connect=connect_retries, read=connect_retries, status=0, backoff_factor=0.2, allowed_methods=None,
+                    respect_retry_after_header=False)
+    if cassette is not None:
+        adapter = CassetteAdapter(cassette=cassette, pool_connections=2, pool_maxsize=pool_size, max_retries=retries)
+    else:
+        adapter = HTTPAdapter(pool_connections=2, pool_maxsize=pool_size, max_retries=retries)
+
+    session = requests.Session()
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
 
-def set_client(client_id: str, client_secret: str) -> ClientDetails:
+    return session
 
-    base_url = "http://api.spotify.com/v1"
-    access_token = get_access_token(client_id=client_id, client_secret=client_secret)
+"""
+    If a token_provider, rate_limiter or session isn't passed in the client gets its own. Pass shared ones in to reuse a token, rate budget and connections across
+    clients. base_url is only changed to point the client at a stand in for spotify.
+"""
+def set_client(client_id: str, client_secret: str, album_cache: AlbumCache | None = None, token_provider: TokenProvider | None = None,
+               rate_limiter: RateLimiter | None = None, session: requests.Session | None = None, base_url: str = BASE_URL,
+               checkpoints: CrawlCheckpoints | None = None) -> ClientDetails:
+
+    if token_provider is None:
+        token_provider = TokenProvider(client_id=client_id, client_secret=client_secret)
+    if rate_limiter is None:
+        rate_limiter = RateLimiter()
+    if session is None:
+        session = create_session(pool_size=rate_limiter.max_concurrency)
+
+    access_token = token_provider.get_token(session=session)
     headers = {
         "Authorization": "Bearer " + access_token
     }
-    wait_time = 0
 
-    return ClientDetails(id=client_id, secret=client_secret, base_url=base_url, access_token=access_token, headers=headers, wait_time=wait_time)
+    return ClientDetails(id=client_id, secret=client_secret, base_url=base_url, access_token=access_token, headers=headers, max_workers=rate_limiter.max_concurrency,
+                         album_cache=album_cache, token_provider=token_provider, rate_limiter=rate_limiter, session=session, checkpoints=checkpoints)
 
-def update_client_tokens(client: ClientDetails) -> ClientDetails:
+""" Swaps in the providers current token if it has changed. This is cheap when the token is still fresh, it only does the handshake when it's close to expiring. """
+def use_current_token(client: ClientDetails) -> ClientDetails:
 
-    client.access_token = get_access_token(client_id=client.id, client_secret=client.secret)
-    client.headers = {
-        "Authorization": "Bearer " + client.access_token
-    }
+    access_token = client.token_provider.get_token(session=client.session)
+    if access_token != client.access_token:
+        client.access_token = access_token
+        client.headers = {
+            "Authorization": "Bearer " + client.access_token
+        }
 
     return client
 
+""" Only needed if spotify rejects a token before it was due to expire, normally use_current_token has already swapped it out. """
+def update_client_tokens(client: ClientDetails) -> ClientDetails:
+
+    client.token_provider.invalidate(access_token=client.access_token)
+
+    return use_current_token(client=client)
+
+""" Turns a response into an ApiResult, pulling spotify's error message out of the body when the request failed. Works for requests and httpx responses. """
+def to_result(response) -> ApiResult:
+
+    try:
+        if response.status_code < 400:
+            return ApiResult(data=response.json(), status=response.status_code, error=None)
+
+        return ApiResult(data=None, status=response.status_code, error=response.json().get("error", {}).get("message", "No error message provided"))
+
+    except ValueError: # covers json.decoder.JSONDecodeError
+        return ApiResult(data=None, status=response.status_code, error="") # figure out suitable error
+
 """ 
     The repeat code for when I make a request to the api.
-    - Might need to return new headers if a reauthentication is done. Gonna take some time to figure this out.
+    - Every attempt waits its turn with the rate limiter first, which also holds everyone back while we're waiting out a 429.
+    - A 401 gets one token refresh and another go. 429s and 5xx errors are retried up to rate_limiter.max_retries times, a 429 waits for as long as Retry-After says.
 """
-def make_request(client: ClientDetails, url: str) -> tuple[ApiResult, ClientDetails]: # watch if time.sleep(0) is slower than an if
+def make_request(client: ClientDetails, url: str) -> tuple[ApiResult, ClientDetails]:
 
-    time.sleep(client.wait_time)
+    rate_limiter = client.rate_limiter
+    refreshed = False
+    attempt = 0
 
-    try:
-        json_response = requests.get(url=url, headers=client.headers)
-        json_response.raise_for_status()
-        response = json.loads(json_response.content)
+    while True:
 
-        return (ApiResult(data=response, status=json_response.status_code, error=None), client)
+        with rate_limiter.slot():
+            rate_limiter.acquire()
+            client = use_current_token(client=client)
+            start = time.perf_counter()
+            response = client.session.get(url=url, headers=client.headers)
+            METRICS.observe_request(url=url, status=response.status_code, seconds=time.perf_counter() - start)
 
-    except requests.exceptions.HTTPError as reqerr:
-        
-        if reqerr.response.status_code == 401:
-            
+        if response.status_code == 401 and not refreshed:
+            refreshed = True
+            METRICS.inc(name="spex_retries_total", reason="unauthorized")
             client = update_client_tokens(client=client)
 
-            try:
-
-                json_retry_response = requests.get(url=url, headers=client.headers)
-                json_retry_response.raise_for_status()
-                retry_response = json.loads(json_retry_response.content)
-
-                return (ApiResult(data=retry_response, status=json_retry_response.status_code, error=None), client)
-            
-            except requests.exceptions.HTTPError as retry_reqerr:
-                
-                return (ApiResult(data=None, status=retry_reqerr.response.status_code, error=retry_reqerr.response.json().get("error", {}).get("message", "No error message provided")), client)
-            
-            except json.decoder.JSONDecodeError as retry_jsonerr:
-                
-                return (ApiResult(data=None, status=json_retry_response.status_code, error=""), client) # figure out suitable error
-        
-        elif reqerr.response.status_code == 429:
-
-            if client.wait_time == 0:
-                client.wait_time = 0.2
-            else:
-                client.wait_time *= 2
-
-            time.sleep(client.wait_time)
-
-            try:
-
-                json_retry_response = requests.get(url=url, headers=client.headers)
-                json_retry_response.raise_for_status()
-                retry_response = json.loads(json_retry_response.content)
-
-                return (ApiResult(data=retry_response, status=json_retry_response.status_code, error=None), client)
-
-            except requests.exceptions.HTTPError as retry_reqerr:
-                
-                return (ApiResult(data=None, status=retry_reqerr.response.status_code, error=retry_reqerr.response.json().get("error", {}).get("message", "No error message provided")), client)
-            
-            except json.decoder.JSONDecodeError as retry_jsonerr:
-                
-                return (ApiResult(data=None, status=json_retry_response.status_code, error=""), client)
+        elif response.status_code == 429 and attempt < rate_limiter.max_retries:
+            # no need to sleep here, acquire holds the next attempt back until the backoff is over
+            rate_limiter.on_throttled(attempt=attempt, retry_after=get_retry_after(headers=response.headers))
+            attempt += 1
+
+        elif response.status_code in RETRY_STATUSES and attempt < rate_limiter.max_retries:
+            time.sleep(rate_limiter.on_server_error(attempt=attempt))
+            attempt += 1
+
         else:
-            return (ApiResult(data=None, status=json_response.status_code, error=reqerr.response.json().get("error", {}).get("message", "No error message provided")), client)
-        
-    except json.decoder.JSONDecodeError as jsonerr:
-        return (ApiResult(data=None, status=json_response.status_code, error=""), client)
+            if response.status_code < 400:
+                rate_limiter.on_success()
+
+            return (to_result(response=response), client)
+    
+"""
+    Pulls the fields we care about out of a single playlist item into a Track. album is left empty here, it gets filled in by enrich_tracks once we know every album
+    the playlist needs. Everything that tracks on the same album or by the same artists have in common is interned so they share it.
+"""
+def read_track(item: dict) -> Track:
+
+    track = item["track"]
+    album = track["album"]
+
+    return Track(
+        track_id=track["id"],
+        title=track["name"],
+        isrc=track["external_ids"].get("isrc"),
+        duration_ms=track["duration_ms"],
+        release_artists=artist_names(artists=album["artists"]),
+        featured_artists=artist_names(artists=track["artists"]),
+        album_id=intern(value=album["id"]),
+        album_title=intern(value=album["name"]),
+        album_type=intern(value=album["album_type"]),
+        release_date=intern(value=album["release_date"]),
+        release_date_precision=intern(value=album.get("release_date_precision"))
+    )
+
+""" Makes the Album tracks get from the album data, or UNAVAILABLE_ALBUM if the album couldn't be loaded. """
+def read_album(album: dict | None) -> Album:
+
+    if album is None:
+        return UNAVAILABLE_ALBUM
+
+    return Album(
+        upc=album["external_ids"].get("upc"),
+        label=intern(value=album["label"]),
+        copy_rights=tuple((intern(value=copy_right["type"]), intern(value=copy_right["text"])) for copy_right in album["copyrights"])
+    )
+
+"""
+    Loads albums through the multi id /albums?ids= endpoint, ALBUM_BATCH_SIZE at a time (20 is the most spotify will take). Returns a dict of album id -> album data.
+    Spotify returns null for ids it can't find and a failed chunk returns nothing, either way those albums are just left out so the caller can fall back to UNAVAILABLE.
+    If the client has an album cache, albums already in it are used as they are and only the rest are requested (and then saved for next time). /albums doesn't
+    take a fields filter so every album comes with its whole track list, each one is cut down to what read_album reads as soon as it's decoded. With a crawl each
+    chunk is checkpointed as soon as it comes back.
+"""
+def load_albums(client: ClientDetails, album_ids: list[str], crawl: Crawl | None = None) -> tuple[dict[str, dict], ClientDetails]:
+
+    with METRICS.stage(name="enrich"):
+
+        albums = {}
+        if client.album_cache is not None:
+            albums = client.album_cache.get_many(album_ids=album_ids)
+            album_ids = [album_id for album_id in album_ids if album_id not in albums]
+
+        fetched_albums = {}
+        for start in range(0, len(album_ids), ALBUM_BATCH_SIZE):
+
+            chunk = album_ids[start:start + ALBUM_BATCH_SIZE]
+            response, client = make_request(client=client, url=f"{client.base_url}/albums?ids={','.join(chunk)}")
+
+            if response.data is not None:
+                chunk_albums = {album["id"]: slim_album(album=album) for album in response.data["albums"] if album is not None}
+                fetched_albums.update(chunk_albums)
+                if crawl is not None:
+                    crawl.save_albums(albums={album_id: read_album(album=album) for album_id, album in chunk_albums.items()})
+
+        if client.album_cache is not None:
+            client.album_cache.put_many(albums=fetched_albums)
+
+        albums.update(fetched_albums)
+
+    return (albums, client)
+
+"""
+    Collects the unique album ids across every track, loads them in batches and fills in each tracks album. Tracks on the same album share one lookup (and one
+    Album), so a playlist full of tracks from the same few albums only costs a handful of requests instead of one per track. known_albums (album id -> Album, like
+    the export index keeps) are used as they are, so only albums we haven't seen before get looked up.
+"""
+def enrich_tracks(client: ClientDetails, tracks: list[Track], known_albums: dict[str, Album] | None = None, crawl: Crawl | None = None) -> tuple[list[Track], ClientDetails]:
+
+    known_albums = known_albums or {}
+
+    # dict.fromkeys keeps the first seen order which makes the requests easier to follow when debugging
+    album_ids = list(dict.fromkeys(track.album_id for track in tracks if track.album_id is not None and track.album_id not in known_albums))
+    albums, client = load_albums(client=client, album_ids=album_ids, crawl=crawl)
+
+    album_records = {album_id: read_album(album=albums.get(album_id)) for album_id in album_ids}
+    album_records.update(known_albums)
+    for track in tracks:
+        track.album = album_records.get(track.album_id, UNAVAILABLE_ALBUM)
+
+    return (tracks, client)
+
+""" The playlist with its first page of tracks, cut down to PLAYLIST_FIELDS. """
+def playlist_url(base_url: str, playlist_id: str) -> str:
+
+    return f"{base_url}/playlists/{playlist_id}?{urlencode({'fields': PLAYLIST_FIELDS})}"
+
+"""
+    Builds the url for the page at offset by swapping the offset and limit on the first pages href, anything else in the query is kept as it is. The href spotify
+    gives back doesn't carry our fields filter over, so it's put back on every page.
+"""
+def page_url(href: str, offset: int, limit: int) -> str:
+
+    parts = urlsplit(href)
+    query = dict(parse_qsl(parts.query))
+    query["offset"] = str(offset)
+    query["limit"] = str(limit)
+    query["fields"] = PAGE_FIELDS
+
+    return urlunsplit(parts._replace(query=urlencode(query)))
+
+"""
+    The first page already tells us total and limit, so rather than following next one page at a time we work out every remaining offset up front and fetch them
+    on a pool of client.max_workers threads. Only max_workers pages are requested ahead of the one being handed out, so the pages come out in playlist order and a
+    slow consumer doesn't end up with the whole playlist sitting in memory. A page that fails is skipped rather than stopping the rest of the playlist from loading.
+    With a crawl every page is checkpointed as it comes back and pages saved by an earlier go aren't requested again, failed pages go on crawl.failures.
+"""
+def iter_pages(client: ClientDetails, first_page: dict, crawl: Crawl | None = None) -> Iterator[dict]:
+
+    yield first_page
+    if first_page["next"] is None:
+        return
+
+    limit = first_page["limit"]
+    offsets = range(first_page["offset"] + limit, first_page["total"], limit)
+    saved_pages = crawl.saved_pages() if crawl is not None else {}
+    urls = iter([page_url(href=first_page["href"], offset=offset, limit=limit) for offset in offsets if offset not in saved_pages])
+
+    with ThreadPoolExecutor(max_workers=client.max_workers) as executor:
+
+        pending = deque(executor.submit(make_request, client, url) for url in islice(urls, client.max_workers))
+        for offset in offsets:
+
+            # the saved pages are handed out in their place, so the pages still come out in playlist order
+            if offset in saved_pages:
+                yield {"offset": offset, "limit": limit, "items": saved_pages.pop(offset)}
+                continue
+
+            with METRICS.stage(name="fetch"):
+                page, client = pending.popleft().result()
+
+            next_url = next(urls, None)
+            if next_url is not None:
+                pending.append(executor.submit(make_request, client, next_url))
+
+            if page.data is not None:
+                if crawl is not None:
+                    crawl.save_page(offset=offset, items=page.data["items"])
+                yield page.data
+            elif crawl is not None:
+                crawl.failures.append(page)
+
+def load_pages(client: ClientDetails, first_page: dict, crawl: Crawl | None = None) -> tuple[list[dict], ClientDetails]:
+
+    return (list(iter_pages(client=client, first_page=first_page, crawl=crawl)), client)
+
+""" Returns a list of Tracks without their album data. """
+def load_page_tracks(client: ClientDetails, playlist_page: dict, crawl: Crawl | None = None) -> tuple[list[Track], ClientDetails]:
+
+    pages, client = load_pages(client=client, first_page=playlist_page, crawl=crawl)
+    tracks = [read_track(item=item) for page in pages for item in page["items"]]
     
+    return (tracks, client)
+
 """ 
-    - Returns a list of dictionaries, where each dictionary represents data about an individual track. 
+    - Returns a list of Tracks, one for each track in the playlist. 
     - It stores more than we would like to display but I feel that some of the extra information is useful. Could even store more information than i've currently got. 
-    Might get rid of the whole nested dictionary thing here. This is also including some external_url stuff which I don't need.
-    - In summary, it loads a pages information, checks if there are any nested pages, and if there are it calls itself on the nested page and appends the data. Once it hits
-    the deepest page it returns that pages data and at each unwind it just appends more data.
-"""
-def load_tracks(client: ClientDetails, playlist_page: dict) -> tuple[list[dict], ClientDetails]:
-
-    tracks = []
-    for item in playlist_page["items"]:
-
-        track_dict = {}
-        track_dict["trackRequest"] = {}
-        track_dict["albumRequest"] = {}
-
-        track_dict["trackRequest"]["releaseArtists"] = item["track"]["album"]["artists"]
-        track_dict["trackRequest"]["featuredArtists"] = item["track"]["artists"]
-        track_dict["trackRequest"]["trackTitle"] = item["track"]["name"]
-        track_dict["trackRequest"]["trackId"] = item["track"]["id"]
-        track_dict["trackRequest"]["trackDuration"] = item["track"]["duration_ms"]
-        track_dict["trackRequest"]["isrc"] = item["track"]["external_ids"]["isrc"]
-        track_dict["trackRequest"]["albumTitle"] = item["track"]["album"]["name"]
-        track_dict["trackRequest"]["albumId"] = item["track"]["album"]["id"]
-        track_dict["trackRequest"]["albumType"] = item["track"]["album"]["album_type"]
-        track_dict["trackRequest"]["releaseDate"] = item["track"]["album"]["release_date"]
-
-        item_album, client = make_request(client=client, url=f"{client.base_url}/albums/{track_dict["trackRequest"]["albumId"]}")
-
-        if item_album.data is not None:
-            track_dict["albumRequest"]["upc"] = item_album.data["external_ids"]["upc"]
-            track_dict["albumRequest"]["copyRights"] = item_album.data["copyrights"]
-            track_dict["albumRequest"]["label"] = item_album.data["label"]
-        else:
-            track_dict["albumRequest"]["upc"] = "UNAVAILABLE"
-            track_dict["albumRequest"]["copyRights"] = "UNAVAILABLE"
-            track_dict["albumRequest"]["label"] = "UNAVAILABLE"
+    - Loads every page first and then enriches the whole playlist in one go, so albums are only requested once each no matter how many pages they turn up on.
+"""
+def load_tracks(client: ClientDetails, playlist_page: dict, known_albums: dict[str, Album] | None = None, crawl: Crawl | None = None) -> tuple[list[Track], ClientDetails]:
 
-        tracks.append(track_dict)
-    
-    if playlist_page["next"] is not None:
-        new_page, client = make_request(client=client, url=playlist_page["next"])
-        if new_page.data is not None:
-            tracks.extend(load_tracks(client=client, playlist_page=new_page.data))
+    tracks, client = load_page_tracks(client=client, playlist_page=playlist_page, crawl=crawl)
+    if crawl is not None:
+        # albums an earlier go already enriched count as known, they're only missing the ones it didn't get to
+        known_albums = {**crawl.saved_albums(), **(known_albums or {})}
+    tracks, client = enrich_tracks(client=client, tracks=tracks, known_albums=known_albums, crawl=crawl)
     
     return (tracks, client)
     
+"""
+    Streaming version of load_tracks. Tracks are handed out a page at a time as soon as that pages albums are loaded, so the first rows can be written before the
+    last page has even been requested. Albums are still only requested once each, the Albums we've already seen are kept (shared between tracks on the same album)
+    and the playlist itself never is. A crawl is finished once the last track has been handed out, if any of its pages failed IncompleteCrawlError is raised
+    instead so whatever was writing the tracks knows it came up short.
+"""
+def iter_tracks(client: ClientDetails, playlist_page: dict, crawl: Crawl | None = None) -> Iterator[Track]:
+
+    album_records = crawl.saved_albums() if crawl is not None else {}
+    for page in iter_pages(client=client, first_page=playlist_page, crawl=crawl):
+
+        tracks = [read_track(item=item) for item in page["items"]]
+
+        new_album_ids = list(dict.fromkeys(track.album_id for track in tracks if track.album_id is not None and track.album_id not in album_records))
+        albums, client = load_albums(client=client, album_ids=new_album_ids, crawl=crawl)
+        for album_id in new_album_ids:
+            album_records[album_id] = read_album(album=albums.get(album_id))
+
+        for track in tracks:
+            track.album = album_records.get(track.album_id, UNAVAILABLE_ALBUM)
+            yield track
+
+    if crawl is not None and not crawl.finish():
+        raise IncompleteCrawlError(result=incomplete_crawl(crawl=crawl))
+
+"""
+    The checkpointed crawl of this snapshot of the playlist. If the client doesn't checkpoint (or spotify didn't give us a snapshot_id to key it on) the crawl
+    still counts the pages that fail, it just doesn't save anything.
+"""
+def start_crawl(client: ClientDetails, playlist_id: str, playlist: dict) -> Crawl:
+
+    if client.checkpoints is None or playlist.get("snapshot_id") is None:
+        return Crawl(checkpoints=None, playlist_id=playlist_id, snapshot_id=playlist.get("snapshot_id"))
+
+    return client.checkpoints.start(playlist_id=playlist_id, snapshot_id=playlist["snapshot_id"])
+
+"""
+    A crawl with pages missing is reported as failed rather than handed back short, if it's checkpointed the pages that did load are saved so trying again only
+    has to request the missing ones. The status is the last failed page's, so a retry loop treats it the same as any other error of that kind.
+"""
+def incomplete_crawl(crawl: Crawl) -> ApiResult:
+
+    failure = crawl.failures[-1]
+    error = f"{len(crawl.failures)} pages couldn't be loaded ({failure.error})"
+    if crawl.checkpoints is not None:
+        error += ", the rest are saved for next time"
+
+    return ApiResult(data=None, status=failure.status, error=error)
+
 """
     Calls load_playlist_data to get the track list data, packages the info up and sends it. This function is designed to keep main neat. Unfortunately we have to repeat
     an api call to get the name of the playlist, I think this is unavoidable as the info needs to be in two different places at once. I think decorating get_request with 
     functools.cache should mean that it won't call the api again it'll use the last call.
     Another useful one is functools.lru_cache
 """
-def get_playlist(client: ClientDetails, playlist_id: str) -> tuple[ApiResult, ClientDetails]:
+def get_playlist(client: ClientDetails, playlist_id: str, known_albums: dict[str, Album] | None = None) -> tuple[ApiResult, ClientDetails]:
 
-    playlist, client = make_request(client=client, url=f"{client.base_url}/playlists/{playlist_id}")
+    playlist, client = make_request(client=client, url=playlist_url(base_url=client.base_url, playlist_id=playlist_id))
     if playlist.data is not None:
 
-        items, client = load_tracks(client=client, playlist_page=playlist.data)
+        crawl = start_crawl(client=client, playlist_id=playlist_id, playlist=playlist.data)
+        items, client = load_tracks(client=client, playlist_page=playlist.data["tracks"], known_albums=known_albums, crawl=crawl)
+        if not crawl.finish():
+            return (incomplete_crawl(crawl=crawl), client)
+
         playlist_dict = {
             "name": playlist.data["name"],
+            "snapshot_id": playlist.data.get("snapshot_id"),
             "items": items
         }
         # error is expected to be none in the line below but just to be safe pass it from playlist.error
         return (ApiResult(data=playlist_dict, status=playlist.status, error=playlist.error), client)
     else:
-        return (playlist, client)
\ No newline at end of file
+        return (playlist, client)
+
+""" Same as get_playlist except items is a generator from iter_tracks, nothing past the first page is requested until something starts reading the items. """
+def stream_playlist(client: ClientDetails, playlist_id: str) -> tuple[ApiResult, ClientDetails]:
+
+    playlist, client = make_request(client=client, url=playlist_url(base_url=client.base_url, playlist_id=playlist_id))
+    if playlist.data is not None:
+
+        crawl = start_crawl(client=client, playlist_id=playlist_id, playlist=playlist.data)
+        playlist_dict = {
+            "name": playlist.data["name"],
+            "snapshot_id": playlist.data.get("snapshot_id"),
+            "items": iter_tracks(client=client, playlist_page=playlist.data["tracks"], crawl=crawl)
+        }
+        return (ApiResult(data=playlist_dict, status=playlist.status, error=playlist.error), client)
+    else:
+        return (playlist, client)
+
+""" Just the playlist's name and snapshot_id, one small request to find out whether it has changed since we last exported it. """
+def get_snapshot(client: ClientDetails, playlist_id: str) -> tuple[ApiResult, ClientDetails]:
+
+    return make_request(client=client, url=f"{client.base_url}/playlists/{playlist_id}?fields=name,snapshot_id")
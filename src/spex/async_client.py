@@ -0,0 +1,337 @@
+import asyncio
+from collections import deque
+from dataclasses import dataclass
+from itertools import islice
+import time
+from typing import AsyncIterator, Callable, Optional, Dict
+
+import httpx
+
+from spex.album_cache import AlbumCache
+from spex.album_cache import slim_album
+from spex.api_client import ALBUM_BATCH_SIZE
+from spex.api_client import ApiResult
+from spex.api_client import BASE_URL
+from spex.api_client import IncompleteCrawlError
+from spex.api_client import incomplete_crawl
+from spex.api_client import page_url
+from spex.api_client import playlist_url
+from spex.api_client import read_album
+from spex.api_client import read_track
+from spex.api_client import to_result
+from spex.cassette import Cassette
+from spex.cassette import missing_interaction
+from spex.checkpoints import Crawl
+from spex.metrics import METRICS
+from spex.rate_limiter import get_retry_after
+from spex.rate_limiter import RateLimiter
+from spex.rate_limiter import RETRY_STATUSES
+from spex.records import Track
+from spex.records import UNAVAILABLE_ALBUM
+from spex.token_provider import TokenProvider
+
+"""
+    asyncio version of api_client for the web app. The functions line up one to one with the ones in api_client, the difference is every request goes through a
+    shared httpx.AsyncClient (so connections are pooled) and a rate limiter that caps how many requests are in flight at once. Nothing in here blocks the event loop.
+"""
+
+@dataclass
+class AsyncClientDetails:
+
+    id: str
+    secret: str
+    base_url: Optional[str]
+    access_token: Optional[str]
+    headers: Optional[Dict]
+    http: httpx.AsyncClient
+    album_cache: Optional[AlbumCache] = None
+    token_provider: Optional[TokenProvider] = None
+    rate_limiter: Optional[RateLimiter] = None
+
+""" httpx's side of cassette.CassetteAdapter. Wraps the real transport when recording, answers from the cassette without using it when replaying. """
+class CassetteTransport(httpx.AsyncBaseTransport):
+
+    def __init__(self, cassette: Cassette, transport: httpx.AsyncBaseTransport):
+
+        self.cassette = cassette
+        self.transport = transport
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+
+        method = request.method
+        url = str(request.url)
+
+        if self.cassette.recording:
+            start = time.perf_counter()
+            response = await self.transport.handle_async_request(request)
+            # read (and decoded) here so the cassette keeps the same body the sync adapter would
+            body = await response.aread()
+            await response.aclose()
+            interaction = self.cassette.record(method=method, url=url, status=response.status_code, headers=dict(response.headers), body=body,
+                                               elapsed=time.perf_counter() - start)
+        else:
+            interaction = self.cassette.play(method=method, url=url) or missing_interaction(method=method, url=url)
+            await asyncio.sleep(self.cassette.delay(interaction=interaction))
+
+        return httpx.Response(status_code=interaction.status, headers=interaction.headers, content=interaction.body, request=request)
+
+    async def aclose(self) -> None:
+
+        await self.transport.aclose()
+        self.cassette.save()
+
+"""
+    Pooled connection used for every request. One of these should be made when the app starts and closed when it shuts down. The transport only retries connection
+    errors. A cassette records or replays every response the same way create_session's does.
+"""
+def create_http_client(max_connections: int = 20, connect_retries: int = 3, cassette: Cassette | None = None) -> httpx.AsyncClient:
+
+    limits = httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_connections, keepalive_expiry=60.0)
+    transport = httpx.AsyncHTTPTransport(limits=limits, retries=connect_retries)
+    if cassette is not None:
+        transport = CassetteTransport(cassette=cassette, transport=transport)
+
+    return httpx.AsyncClient(transport=transport, timeout=httpx.Timeout(30.0))
+
+""" Same as api_client.set_client, the web app passes in one shared token_provider so every request reuses the same token until it's about to expire. """
+async def set_client(http: httpx.AsyncClient, client_id: str, client_secret: str, album_cache: AlbumCache | None = None, token_provider: TokenProvider | None = None,
+                     rate_limiter: RateLimiter | None = None, base_url: str = BASE_URL) -> AsyncClientDetails:
+
+    if token_provider is None:
+        token_provider = TokenProvider(client_id=client_id, client_secret=client_secret)
+    if rate_limiter is None:
+        rate_limiter = RateLimiter()
+
+    access_token = await token_provider.get_token_async(http=http)
+    headers = {
+        "Authorization": "Bearer " + access_token
+    }
+
+    return AsyncClientDetails(id=client_id, secret=client_secret, base_url=base_url, access_token=access_token, headers=headers, http=http, album_cache=album_cache,
+                              token_provider=token_provider, rate_limiter=rate_limiter)
+
+async def use_current_token(client: AsyncClientDetails) -> AsyncClientDetails:
+
+    access_token = await client.token_provider.get_token_async(http=client.http)
+    if access_token != client.access_token:
+        client.access_token = access_token
+        client.headers = {
+            "Authorization": "Bearer " + client.access_token
+        }
+
+    return client
+
+async def update_client_tokens(client: AsyncClientDetails) -> AsyncClientDetails:
+
+    client.token_provider.invalidate(access_token=client.access_token)
+
+    return await use_current_token(client=client)
+
+""" Mirrors api_client.make_request, the rate limiter's slot is what caps how many requests are in flight at once. """
+async def make_request(client: AsyncClientDetails, url: str) -> tuple[ApiResult, AsyncClientDetails]:
+
+    rate_limiter = client.rate_limiter
+    refreshed = False
+    attempt = 0
+
+    while True:
+
+        async with rate_limiter.slot_async():
+            await rate_limiter.acquire_async()
+            client = await use_current_token(client=client)
+            start = time.perf_counter()
+            response = await client.http.get(url=url, headers=client.headers)
+            METRICS.observe_request(url=url, status=response.status_code, seconds=time.perf_counter() - start)
+
+        if response.status_code == 401 and not refreshed:
+            refreshed = True
+            METRICS.inc(name="spex_retries_total", reason="unauthorized")
+            client = await update_client_tokens(client=client)
+
+        elif response.status_code == 429 and attempt < rate_limiter.max_retries:
+            await rate_limiter.on_throttled_async(attempt=attempt, retry_after=get_retry_after(headers=response.headers))
+            attempt += 1
+
+        elif response.status_code in RETRY_STATUSES and attempt < rate_limiter.max_retries:
+            await asyncio.sleep(rate_limiter.on_server_error(attempt=attempt))
+            attempt += 1
+
+        else:
+            if response.status_code < 400:
+                await rate_limiter.on_success_async()
+
+            return (to_result(response=response), client)
+
+""" Same as api_client.load_albums except the chunks are requested together, the rate limiter keeps it from flooding spotify. """
+async def load_albums(client: AsyncClientDetails, album_ids: list[str]) -> tuple[dict[str, dict], AsyncClientDetails]:
+
+    with METRICS.stage(name="enrich"):
+
+        albums = {}
+        if client.album_cache is not None:
+            # the cache is a sqlite file, looking albums up on a thread keeps the event loop free while it reads
+            albums = await asyncio.to_thread(client.album_cache.get_many, album_ids=album_ids)
+            album_ids = [album_id for album_id in album_ids if album_id not in albums]
+
+        urls = [f"{client.base_url}/albums?ids={','.join(album_ids[start:start + ALBUM_BATCH_SIZE])}" for start in range(0, len(album_ids), ALBUM_BATCH_SIZE)]
+        responses = await asyncio.gather(*(make_request(client=client, url=url) for url in urls))
+
+        fetched_albums = {}
+        for response, client in responses:
+            if response.data is not None:
+                for album in response.data["albums"]:
+                    if album is not None:
+                        fetched_albums[album["id"]] = slim_album(album=album)
+
+        if client.album_cache is not None:
+            await asyncio.to_thread(client.album_cache.put_many, albums=fetched_albums)
+
+        albums.update(fetched_albums)
+
+    return (albums, client)
+
+async def enrich_tracks(client: AsyncClientDetails, tracks: list[Track]) -> tuple[list[Track], AsyncClientDetails]:
+
+    album_ids = list(dict.fromkeys(track.album_id for track in tracks if track.album_id is not None))
+    albums, client = await load_albums(client=client, album_ids=album_ids)
+
+    album_records = {album_id: read_album(album=albums.get(album_id)) for album_id in album_ids}
+    for track in tracks:
+        track.album = album_records.get(track.album_id, UNAVAILABLE_ALBUM)
+
+    return (tracks, client)
+
+"""
+    Same as api_client.load_pages, asyncio.gather returns results in the order they were passed in so playlist order is kept. Nothing is checkpointed here, the
+    crawl only collects the pages that failed.
+"""
+async def load_pages(client: AsyncClientDetails, first_page: dict, crawl: Crawl | None = None) -> tuple[list[dict], AsyncClientDetails]:
+
+    pages = [first_page]
+    if first_page["next"] is None:
+        return (pages, client)
+
+    limit = first_page["limit"]
+    offsets = range(first_page["offset"] + limit, first_page["total"], limit)
+    responses = await asyncio.gather(*(make_request(client=client, url=page_url(href=first_page["href"], offset=offset, limit=limit)) for offset in offsets))
+
+    for page, client in responses:
+        if page.data is not None:
+            pages.append(page.data)
+        elif crawl is not None:
+            crawl.failures.append(page)
+
+    return (pages, client)
+
+""" Same as api_client.iter_pages, at most max_concurrency pages are requested ahead of the one being handed out. Failed pages go on crawl.failures. """
+async def iter_pages(client: AsyncClientDetails, first_page: dict, crawl: Crawl | None = None) -> AsyncIterator[dict]:
+
+    yield first_page
+    if first_page["next"] is None:
+        return
+
+    limit = first_page["limit"]
+    offsets = range(first_page["offset"] + limit, first_page["total"], limit)
+    urls = iter([page_url(href=first_page["href"], offset=offset, limit=limit) for offset in offsets])
+
+    pending = deque(asyncio.create_task(make_request(client=client, url=url)) for url in islice(urls, client.rate_limiter.max_concurrency))
+    try:
+        while pending:
+
+            with METRICS.stage(name="fetch"):
+                page, client = await pending.popleft()
+
+            next_url = next(urls, None)
+            if next_url is not None:
+                pending.append(asyncio.create_task(make_request(client=client, url=next_url)))
+
+            if page.data is not None:
+                yield page.data
+            elif crawl is not None:
+                crawl.failures.append(page)
+    finally:
+        # if whoever is reading stops early (like a client disconnecting mid download) don't leave requests running
+        for task in pending:
+            task.cancel()
+
+async def load_tracks(client: AsyncClientDetails, playlist_page: dict, crawl: Crawl | None = None) -> tuple[list[Track], AsyncClientDetails]:
+
+    pages, client = await load_pages(client=client, first_page=playlist_page, crawl=crawl)
+    tracks = [read_track(item=item) for page in pages for item in page["items"]]
+    tracks, client = await enrich_tracks(client=client, tracks=tracks)
+
+    return (tracks, client)
+
+"""
+    Same as api_client.iter_tracks, IncompleteCrawlError is raised once the last track is out if any page failed. on_page is called with how many tracks and new
+    albums each page had once its albums are loaded, for reporting progress.
+"""
+async def iter_tracks(client: AsyncClientDetails, playlist_page: dict, on_page: Callable[[int, int], None] | None = None,
+                      crawl: Crawl | None = None) -> AsyncIterator[Track]:
+
+    album_records = {}
+    async for page in iter_pages(client=client, first_page=playlist_page, crawl=crawl):
+
+        tracks = [read_track(item=item) for item in page["items"]]
+
+        new_album_ids = list(dict.fromkeys(track.album_id for track in tracks if track.album_id is not None and track.album_id not in album_records))
+        albums, client = await load_albums(client=client, album_ids=new_album_ids)
+        for album_id in new_album_ids:
+            album_records[album_id] = read_album(album=albums.get(album_id))
+
+        if on_page is not None:
+            on_page(len(tracks), len(new_album_ids))
+
+        for track in tracks:
+            track.album = album_records.get(track.album_id, UNAVAILABLE_ALBUM)
+            yield track
+
+    if crawl is not None and not crawl.finish():
+        raise IncompleteCrawlError(result=incomplete_crawl(crawl=crawl))
+
+""" The web app doesn't checkpoint, its crawls are only there to catch pages going missing. """
+def start_crawl(playlist_id: str, playlist: dict) -> Crawl:
+
+    return Crawl(checkpoints=None, playlist_id=playlist_id, snapshot_id=playlist.get("snapshot_id"))
+
+""" Same as api_client.get_playlist, a playlist with pages missing comes back as an error rather than short. """
+async def get_playlist(client: AsyncClientDetails, playlist_id: str) -> tuple[ApiResult, AsyncClientDetails]:
+
+    playlist, client = await make_request(client=client, url=playlist_url(base_url=client.base_url, playlist_id=playlist_id))
+    if playlist.data is not None:
+
+        crawl = start_crawl(playlist_id=playlist_id, playlist=playlist.data)
+        items, client = await load_tracks(client=client, playlist_page=playlist.data["tracks"], crawl=crawl)
+        if not crawl.finish():
+            return (incomplete_crawl(crawl=crawl), client)
+
+        playlist_dict = {
+            "name": playlist.data["name"],
+            "snapshot_id": playlist.data.get("snapshot_id"),
+            "items": items
+        }
+        return (ApiResult(data=playlist_dict, status=playlist.status, error=playlist.error), client)
+    else:
+        return (playlist, client)
+
+""" Same as api_client.stream_playlist, items is an async generator from iter_tracks. total is how many tracks items will give, going by the first page. """
+async def stream_playlist(client: AsyncClientDetails, playlist_id: str, on_page: Callable[[int, int], None] | None = None) -> tuple[ApiResult, AsyncClientDetails]:
+
+    playlist, client = await make_request(client=client, url=playlist_url(base_url=client.base_url, playlist_id=playlist_id))
+    if playlist.data is not None:
+
+        playlist_dict = {
+            "name": playlist.data["name"],
+            "snapshot_id": playlist.data.get("snapshot_id"),
+            "total": playlist.data["tracks"]["total"],
+            "items": iter_tracks(client=client, playlist_page=playlist.data["tracks"], on_page=on_page,
+                                 crawl=start_crawl(playlist_id=playlist_id, playlist=playlist.data))
+        }
+        return (ApiResult(data=playlist_dict, status=playlist.status, error=playlist.error), client)
+    else:
+        return (playlist, client)
+
+""" Same as api_client.get_snapshot """
+async def get_snapshot(client: AsyncClientDetails, playlist_id: str) -> tuple[ApiResult, AsyncClientDetails]:
+
+    return await make_request(client=client, url=f"{client.base_url}/playlists/{playlist_id}?fields=name,snapshot_id")
@@ -0,0 +1,24 @@
+from contextlib import contextmanager
+import os
+from pathlib import Path
+
+"""
+    Writing a file that another process (or another of the web server's workers) might read at the same time: the token cache, the render cache's files, the
+    jobs' state and the cassettes. Everything is written to a temp name next to the file first and renamed over it once it's all there, a rename is atomic so
+    a reader either gets the old file or the new one and never half of one. If anything goes wrong part way the temp file is removed and the old file is left
+    alone. The file is handed over opened in binary mode, permissions are the ones it's created with (before the umask).
+"""
+
+@contextmanager
+def atomic_write(path: Path, permissions: int = 0o666):
+
+    path.parent.mkdir(parents=True, exist_ok=True)
+    temp_path = path.with_suffix(f".{os.getpid()}.tmp")
+    file_descriptor = os.open(temp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, permissions)
+    try:
+        with os.fdopen(file_descriptor, "wb") as file:
+            yield file
+        os.replace(temp_path, path)
+    except BaseException:
+        temp_path.unlink(missing_ok=True)
+        raise
@@ -0,0 +1,129 @@
+from concurrent.futures import ThreadPoolExecutor
+import re
+from typing import Iterable, TextIO
+
+from spex.api_client import ALBUM_BATCH_SIZE
+from spex.api_client import ApiResult
+from spex.api_client import ClientDetails
+from spex.api_client import get_snapshot
+from spex.api_client import incomplete_crawl
+from spex.api_client import load_albums
+from spex.api_client import load_page_tracks
+from spex.api_client import make_request
+from spex.api_client import playlist_url
+from spex.api_client import read_album
+from spex.api_client import start_crawl
+from spex.records import Album
+from spex.records import UNAVAILABLE_ALBUM
+
+"""
+    Loads a whole batch of playlists over one client, so there's one token, one rate budget and one connection pool for the lot. It's done in two passes:
+    - Every playlist's pages are fetched, jobs playlists at a time. Tracks come back without their album data.
+    - The album ids from every playlist are put together and each album is requested once, however many playlists it turns up in.
+    A playlist that fails is kept as a failed ApiResult rather than stopping the batch, so whoever called this can report on it and carry on with the rest.
+"""
+
+""" Pulls the playlist id out of an open.spotify.com link, a spotify:playlist: uri or a bare id. Returns None if it can't find one. """
+def parse_playlist_id(link: str) -> str | None:
+
+    link = link.strip()
+    match = re.search(pattern=r"open\.spotify\.com\/(?:[\w-]+\/)?playlist\/([A-Za-z0-9]+)", string=link)
+    if match is None:
+        match = re.fullmatch(pattern=r"(?:spotify:playlist:)?([A-Za-z0-9]+)", string=link)
+
+    return match.group(1) if match is not None else None
+
+""" One link or id per line, blank lines and lines starting with # are skipped. """
+def read_links(file: TextIO) -> list[str]:
+
+    return [line.strip() for line in file if line.strip() and not line.strip().startswith("#")]
+
+""" get_playlist without the album lookups, items are Tracks straight from read_track with no album yet. The crawl's checkpoint is left for load_batch to finish. """
+def load_playlist_pages(client: ClientDetails, playlist_id: str) -> tuple[ApiResult, ClientDetails]:
+
+    playlist, client = make_request(client=client, url=playlist_url(base_url=client.base_url, playlist_id=playlist_id))
+    if playlist.data is None:
+        return (playlist, client)
+
+    crawl = start_crawl(client=client, playlist_id=playlist_id, playlist=playlist.data)
+    tracks, client = load_page_tracks(client=client, playlist_page=playlist.data["tracks"], crawl=crawl)
+    if crawl.failures:
+        return (incomplete_crawl(crawl=crawl), client)
+
+    playlist_dict = {
+        "name": playlist.data["name"],
+        "snapshot_id": playlist.data.get("snapshot_id"),
+        "items": tracks
+    }
+
+    return (ApiResult(data=playlist_dict, status=playlist.status, error=playlist.error), client)
+
+def try_load_playlist_pages(client: ClientDetails, playlist_id: str) -> ApiResult:
+
+    try:
+        playlist, client = load_playlist_pages(client=client, playlist_id=playlist_id)
+    # a dropped connection that outlasts the adapter's retries, a page that isn't json or an item read_track can't make sense of shouldn't take the rest of the
+    # batch down with it, whatever it was goes in the summary
+    except Exception as error:
+        return ApiResult(data=None, status=None, error=f"{type(error).__name__}: {error}")
+
+    return playlist
+
+""" Loads one chunk of albums. A chunk that fails just leaves its albums out, those tracks get UNAVAILABLE like they would in enrich_tracks. """
+def try_load_albums(client: ClientDetails, album_ids: list[str]) -> dict[str, dict]:
+
+    try:
+        albums, client = load_albums(client=client, album_ids=album_ids)
+    except Exception:
+        return {}
+
+    return albums
+
+"""
+    Returns an ApiResult for every playlist id, in the same order they were passed in. Album chunks are spread over client.max_workers threads, the rate limiter
+    decides how many of them are actually in flight. Albums in known_albums (album id -> Album) aren't looked up again.
+"""
+def load_batch(client: ClientDetails, playlist_ids: Iterable[str], jobs: int = 4, known_albums: dict[str, Album] | None = None) -> tuple[list[ApiResult], ClientDetails]:
+
+    playlist_ids = list(playlist_ids)
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        results = list(executor.map(lambda playlist_id: try_load_playlist_pages(client=client, playlist_id=playlist_id), playlist_ids))
+
+    tracks = [track for result in results if result.data is not None for track in result.data["items"]]
+    known_albums = known_albums or {}
+    album_ids = list(dict.fromkeys(track.album_id for track in tracks if track.album_id is not None and track.album_id not in known_albums))
+    chunks = [album_ids[start:start + ALBUM_BATCH_SIZE] for start in range(0, len(album_ids), ALBUM_BATCH_SIZE)]
+
+    albums = {}
+    with ThreadPoolExecutor(max_workers=client.max_workers) as executor:
+        for chunk_albums in executor.map(lambda chunk: try_load_albums(client=client, album_ids=chunk), chunks):
+            albums.update(chunk_albums)
+
+    # tracks on the same album share one Album, the same way iter_tracks does it
+    album_records = {album_id: read_album(album=albums.get(album_id)) for album_id in album_ids}
+    album_records.update(known_albums)
+    for track in tracks:
+        track.album = album_records.get(track.album_id, UNAVAILABLE_ALBUM)
+
+    # only now is every playlist fully loaded, a batch killed while it was looking up albums still has its pages saved
+    if client.checkpoints is not None:
+        for playlist_id, result in zip(playlist_ids, results):
+            if result.data is not None and result.data.get("snapshot_id") is not None:
+                client.checkpoints.finish(playlist_id=playlist_id, snapshot_id=result.data["snapshot_id"])
+
+    return (results, client)
+
+def try_get_snapshot(client: ClientDetails, playlist_id: str) -> ApiResult:
+
+    try:
+        snapshot, client = get_snapshot(client=client, playlist_id=playlist_id)
+    except Exception as error:
+        return ApiResult(data=None, status=None, error=f"{type(error).__name__}: {error}")
+
+    return snapshot
+
+""" The name and snapshot_id of every playlist, jobs at a time, in the same order they were passed in. """
+def load_snapshots(client: ClientDetails, playlist_ids: Iterable[str], jobs: int = 4) -> list[ApiResult]:
+
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        return list(executor.map(lambda playlist_id: try_get_snapshot(client=client, playlist_id=playlist_id), playlist_ids))
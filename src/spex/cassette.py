@@ -0,0 +1,201 @@
+from collections import defaultdict
+from dataclasses import dataclass
+import gzip
+import json
+import os
+from pathlib import Path
+import re
+import threading
+import time
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+from requests.structures import CaseInsensitiveDict
+from requests.utils import get_encoding_from_headers
+
+from spex.atomic_file import atomic_write
+from spex.metrics import METRICS
+
+"""
+    Recorded spotify responses, so the client, the formatter and the exporters can be profiled on a real production sized playlist without hitting the real api
+    every run (which is noisy and eats into the rate limit). In record mode every response that comes back is kept (status, headers and body) and written to a
+    gzipped json lines file when the client is closed. In replay mode nothing goes over the network, each request is answered from the file in the order the
+    responses were recorded, after latency seconds (or however long the real request took, if latency is "recorded"). Replaying the same run twice gives exactly
+    the same responses, which is what makes a regression reproducible.
+
+    The cassette sits under the session (CassetteAdapter) or the httpx client (async_client.CassetteTransport), so make_request and everything above it run the
+    same code they always do, retries and rate limiting included.
+"""
+
+CASSETTE_MODES = ["record", "replay"]
+
+# what requests and httpx have already undone by the time we see the body, replaying them would have the body decoded twice
+DROPPED_HEADERS = {"content-encoding", "content-length", "transfer-encoding", "connection", "keep-alive"}
+
+@dataclass(slots=True)
+class Interaction:
+
+    status: int
+    headers: dict[str, str]
+    body: bytes
+    elapsed: float
+
+    def to_dict(self, method: str, url: str) -> dict:
+
+        # bodies are json text, escaping anything that isn't utf-8 keeps the rare binary body intact without base64 bloating the rest
+        return {"method": method, "url": url, "status": self.status, "headers": self.headers, "body": self.body.decode("utf-8", "surrogateescape"),
+                "elapsed": round(self.elapsed, 4)}
+
+    @classmethod
+    def from_dict(cls, interaction: dict) -> "Interaction":
+
+        return cls(status=interaction["status"], headers=interaction["headers"], body=interaction["body"].encode("utf-8", "surrogateescape"),
+                   elapsed=interaction["elapsed"])
+
+class Cassette:
+
+    def __init__(self, path: str | Path, mode: str = "replay", latency: float | str = 0.0):
+
+        if mode not in CASSETTE_MODES:
+            raise ValueError(f"mode has to be one of {', '.join(CASSETTE_MODES)}, not {mode}")
+
+        self.path = Path(path)
+        self.mode = mode
+        self.latency = latency
+        self.interactions = defaultdict(list)
+        self.played = defaultdict(int)
+        self.changed = False
+        self.lock = threading.Lock()
+
+        if mode == "replay":
+            self.load()
+
+    @property
+    def recording(self) -> bool:
+
+        return self.mode == "record"
+
+    def load(self) -> None:
+
+        with gzip.open(self.path, "rt", encoding="utf-8") as file:
+            for line in file:
+                interaction = json.loads(line)
+                self.interactions[(interaction["method"], interaction["url"])].append(Interaction.from_dict(interaction=interaction))
+
+    """ Keeps a response that's just come back. Live tokens are never written to disk, a replayed token only has to look like one. """
+    def record(self, method: str, url: str, status: int, headers: dict[str, str], body: bytes, elapsed: float) -> Interaction:
+
+        if b'"access_token"' in body:
+            body = re.sub(rb'"access_token"\s*:\s*"[^"]*"', b'"access_token": "recorded"', body)
+        headers = {name: value for name, value in headers.items() if name.lower() not in DROPPED_HEADERS}
+
+        interaction = Interaction(status=status, headers=headers, body=body, elapsed=elapsed)
+        with self.lock:
+            self.interactions[(method, url)].append(interaction)
+            self.changed = True
+
+        return interaction
+
+    """
+        The next recorded response for the request. Responses to the same request come back in the order they were recorded (a 429 and then the 200 that
+        followed it) and the last one keeps being given once they've all been played. None if the request was never recorded.
+    """
+    def play(self, method: str, url: str) -> Interaction | None:
+
+        key = (method, url)
+        with self.lock:
+            recorded = self.interactions.get(key)
+            if not recorded:
+                METRICS.inc(name="spex_cassette_misses_total")
+                return None
+
+            index = min(self.played[key], len(recorded) - 1)
+            self.played[key] += 1
+
+        METRICS.inc(name="spex_cassette_hits_total")
+        return recorded[index]
+
+    """ How long to hold a replayed response back for. """
+    def delay(self, interaction: Interaction) -> float:
+
+        return interaction.elapsed if self.latency == "recorded" else float(self.latency)
+
+    """ Writes everything recorded so far, a temp file and a rename so a run that's killed part way never leaves half a cassette. """
+    def save(self) -> None:
+
+        with self.lock:
+            if not self.recording or not self.changed:
+                return
+
+            with atomic_write(path=self.path) as raw_file, gzip.open(raw_file, "wt", encoding="utf-8") as file:
+                for (method, url), recorded in self.interactions.items():
+                    for interaction in recorded:
+                        file.write(json.dumps(interaction.to_dict(method=method, url=url)) + "\n")
+            self.changed = False
+
+"""
+    What a request the cassette doesn't have gets instead. A token request is given a made up token, a cassette recorded while the token was cached on disk has
+    no handshake in it and there's nothing real to replay anyway. Anything else gets the json spotify would send for a 404 so it fails the way any other missing
+    resource would.
+"""
+def missing_interaction(method: str, url: str) -> Interaction:
+
+    if method == "POST" and urlsplit(url).path.endswith("/token"):
+        body = json.dumps({"access_token": "recorded", "token_type": "Bearer", "expires_in": 3600}).encode()
+        return Interaction(status=200, headers={"Content-Type": "application/json"}, body=body, elapsed=0.0)
+
+    body = json.dumps({"error": {"status": 404, "message": f"Not in the cassette: {method} {url}"}}).encode()
+
+    return Interaction(status=404, headers={"Content-Type": "application/json"}, body=body, elapsed=0.0)
+
+""" Mounted on a session by create_session. Records what the real adapter gets back, or answers from the cassette without touching the network. """
+class CassetteAdapter(HTTPAdapter):
+
+    def __init__(self, cassette: Cassette, **kwargs):
+
+        super().__init__(**kwargs)
+        self.cassette = cassette
+
+    def send(self, request: requests.PreparedRequest, **kwargs) -> requests.Response:
+
+        if self.cassette.recording:
+            start = time.perf_counter()
+            response = super().send(request, **kwargs)
+            self.cassette.record(method=request.method, url=request.url, status=response.status_code, headers=dict(response.headers), body=response.content,
+                                 elapsed=time.perf_counter() - start)
+            return response
+
+        interaction = self.cassette.play(method=request.method, url=request.url) or missing_interaction(method=request.method, url=request.url)
+        time.sleep(self.cassette.delay(interaction=interaction))
+
+        response = requests.Response()
+        response.status_code = interaction.status
+        response.headers = CaseInsensitiveDict(interaction.headers)
+        response._content = interaction.body
+        response.url = request.url
+        response.request = request
+        response.encoding = get_encoding_from_headers(response.headers)
+
+        return response
+
+    def close(self) -> None:
+
+        super().close()
+        self.cassette.save()
+
+"""
+    SPEX_CASSETTE is the file to record to or replay from, unset means no cassette and requests go to spotify as normal. SPEX_CASSETTE_MODE is record or replay
+    (replay by default) and SPEX_CASSETTE_LATENCY is how many seconds a replayed response takes, or "recorded" to take as long as it did when it was recorded.
+"""
+def open_cassette() -> Cassette | None:
+
+    path = os.getenv("SPEX_CASSETTE")
+    if not path:
+        return None
+
+    latency = os.getenv("SPEX_CASSETTE_LATENCY", "0")
+    if latency != "recorded":
+        latency = float(latency)
+
+    return Cassette(path=path, mode=os.getenv("SPEX_CASSETTE_MODE", "replay"), latency=latency)
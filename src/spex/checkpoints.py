@@ -0,0 +1,168 @@
+from dataclasses import dataclass, field
+import json
+import os
+from pathlib import Path
+import threading
+import time
+import zlib
+
+from spex.metrics import METRICS
+from spex.records import Album
+from spex.sqlite_store import open_database
+
+"""
+    Checkpoints for crawls that don't finish. Without them a crawl that dies part way (a dropped connection, a run of 5xx errors, the process being killed) throws
+    away every page and album it had already loaded and the next go starts again from page one, which on a 20k track playlist is a couple of hundred requests
+    redone because of one late failure. Every page is saved here as soon as it's loaded, and every chunk of albums as soon as it's enriched, keyed on the playlist
+    id and its snapshot_id. The next crawl of the same snapshot only requests what's missing. A new snapshot_id means the playlist has changed since, so whatever
+    was saved for the old one is thrown away rather than mixed in. A crawl's checkpoint is deleted once the whole playlist has loaded.
+"""
+class CrawlCheckpoints:
+
+    def __init__(self, path: str | Path, max_age: float = 7 * 24 * 60 * 60):
+
+        self.path = Path(path)
+
+        self.lock = threading.Lock()
+        self.connection = open_database(path=self.path, schema=(
+            "CREATE TABLE IF NOT EXISTS pages (playlist_id TEXT NOT NULL, snapshot_id TEXT NOT NULL, page_offset INTEGER NOT NULL, items BLOB NOT NULL, "
+            "saved_at REAL NOT NULL, PRIMARY KEY (playlist_id, snapshot_id, page_offset))",
+            "CREATE TABLE IF NOT EXISTS albums (playlist_id TEXT NOT NULL, snapshot_id TEXT NOT NULL, album_id TEXT NOT NULL, album TEXT NOT NULL, "
+            "saved_at REAL NOT NULL, PRIMARY KEY (playlist_id, snapshot_id, album_id))"
+        ))
+        # crawls that were never picked up again shouldn't sit here forever
+        for table in ("pages", "albums"):
+            self.connection.execute(f"DELETE FROM {table} WHERE saved_at < ?", (time.time() - max_age,))
+        self.connection.commit()
+
+    """ Starts (or picks back up) the crawl of one snapshot of a playlist, anything saved for an older snapshot is deleted. """
+    def start(self, playlist_id: str, snapshot_id: str) -> "Crawl":
+
+        with self.lock:
+            for table in ("pages", "albums"):
+                self.connection.execute(f"DELETE FROM {table} WHERE playlist_id = ? AND snapshot_id != ?", (playlist_id, snapshot_id))
+            self.connection.commit()
+
+        return Crawl(checkpoints=self, playlist_id=playlist_id, snapshot_id=snapshot_id)
+
+    """ The items of every page saved so far, by offset. """
+    def get_pages(self, playlist_id: str, snapshot_id: str) -> dict[int, list[dict]]:
+
+        with self.lock:
+            rows = self.connection.execute(
+                "SELECT page_offset, items FROM pages WHERE playlist_id = ? AND snapshot_id = ?", (playlist_id, snapshot_id)
+            ).fetchall()
+
+        return {offset: json.loads(zlib.decompress(items)) for offset, items in rows}
+
+    """ Pages are json compressed with zlib, they're mostly the same few keys over and over so they shrink a lot. """
+    def put_page(self, playlist_id: str, snapshot_id: str, offset: int, items: list[dict]) -> None:
+
+        items = zlib.compress(json.dumps(items, separators=(",", ":")).encode("utf-8"))
+        with self.lock:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO pages (playlist_id, snapshot_id, page_offset, items, saved_at) VALUES (?, ?, ?, ?, ?)",
+                (playlist_id, snapshot_id, offset, items, time.time())
+            )
+            self.connection.commit()
+
+    def get_albums(self, playlist_id: str, snapshot_id: str) -> dict[str, Album]:
+
+        with self.lock:
+            rows = self.connection.execute(
+                "SELECT album_id, album FROM albums WHERE playlist_id = ? AND snapshot_id = ?", (playlist_id, snapshot_id)
+            ).fetchall()
+
+        return {album_id: Album.from_dict(album_dict=json.loads(album)) for album_id, album in rows}
+
+    """ Albums are stored the way Album.to_dict writes them, like the export index does. """
+    def put_albums(self, playlist_id: str, snapshot_id: str, albums: dict[str, Album]) -> None:
+
+        if not albums:
+            return
+
+        saved_at = time.time()
+        with self.lock:
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO albums (playlist_id, snapshot_id, album_id, album, saved_at) VALUES (?, ?, ?, ?, ?)",
+                [(playlist_id, snapshot_id, album_id, json.dumps(album.to_dict(), separators=(",", ":")), saved_at) for album_id, album in albums.items()]
+            )
+            self.connection.commit()
+
+    def finish(self, playlist_id: str, snapshot_id: str) -> None:
+
+        with self.lock:
+            for table in ("pages", "albums"):
+                self.connection.execute(f"DELETE FROM {table} WHERE playlist_id = ? AND snapshot_id = ?", (playlist_id, snapshot_id))
+            self.connection.commit()
+
+    def close(self) -> None:
+
+        with self.lock:
+            self.connection.close()
+
+"""
+    One crawl's view of the checkpoints, this is what gets passed down to iter_pages and load_albums. failures collects the pages that couldn't be loaded, a crawl
+    with any is left saved so the next go can fill them in. With checkpoints None nothing is saved or resumed, the crawl is only there to keep track of failures
+    so a playlist with pages missing is never mistaken for the whole thing.
+"""
+@dataclass
+class Crawl:
+
+    checkpoints: CrawlCheckpoints | None
+    playlist_id: str
+    snapshot_id: str | None
+    failures: list = field(default_factory=list)
+
+    def saved_pages(self) -> dict[int, list[dict]]:
+
+        if self.checkpoints is None:
+            return {}
+
+        pages = self.checkpoints.get_pages(playlist_id=self.playlist_id, snapshot_id=self.snapshot_id)
+        METRICS.inc(name="spex_checkpoint_pages_resumed_total", amount=len(pages))
+
+        return pages
+
+    def save_page(self, offset: int, items: list[dict]) -> None:
+
+        if self.checkpoints is not None:
+            self.checkpoints.put_page(playlist_id=self.playlist_id, snapshot_id=self.snapshot_id, offset=offset, items=items)
+
+    def saved_albums(self) -> dict[str, Album]:
+
+        if self.checkpoints is None:
+            return {}
+
+        albums = self.checkpoints.get_albums(playlist_id=self.playlist_id, snapshot_id=self.snapshot_id)
+        METRICS.inc(name="spex_checkpoint_albums_resumed_total", amount=len(albums))
+
+        return albums
+
+    def save_albums(self, albums: dict[str, Album]) -> None:
+
+        if self.checkpoints is not None:
+            self.checkpoints.put_albums(playlist_id=self.playlist_id, snapshot_id=self.snapshot_id, albums=albums)
+
+    """ Deletes the checkpoint, unless some pages are still missing. Returns whether the crawl was complete. """
+    def finish(self) -> bool:
+
+        if self.failures:
+            return False
+
+        if self.checkpoints is not None:
+            self.checkpoints.finish(playlist_id=self.playlist_id, snapshot_id=self.snapshot_id)
+        return True
+
+"""
+    Opens the checkpoints in SPEX_CACHE_DIR next to the album cache. SPEX_CHECKPOINT_MAX_AGE is how many seconds an unfinished crawl is kept for and setting
+    SPEX_CHECKPOINTS=0 turns checkpointing off and returns None.
+"""
+def open_crawl_checkpoints() -> CrawlCheckpoints | None:
+
+    if os.getenv("SPEX_CHECKPOINTS", "1") == "0":
+        return None
+
+    cache_dir = Path(os.getenv("SPEX_CACHE_DIR", Path.home() / ".cache" / "spex"))
+
+    return CrawlCheckpoints(path=cache_dir / "crawls.sqlite3", max_age=float(os.getenv("SPEX_CHECKPOINT_MAX_AGE", 7 * 24 * 60 * 60)))
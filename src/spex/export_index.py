@@ -0,0 +1,84 @@
+import json
+import os
+from pathlib import Path
+import threading
+import time
+from typing import Iterable, Iterator
+
+from spex.records import Album
+from spex.records import Track
+from spex.sqlite_store import open_database
+
+"""
+    Remembers the last export of each playlist so the next run can skip it if nothing changed. Spotify gives every version of a playlist a new snapshot_id, so if
+    it still matches the one we exported the file we already have is up to date. When it has changed the Albums from last time (stored the way Album.to_dict
+    writes them) let the next export only look up albums for the tracks that were added, and the path means the old file gets overwritten instead of a new
+    name(n) copy being made next to it. Entries are kept per playlist and format since each format is its own file.
+"""
+class ExportIndex:
+
+    def __init__(self, path: str | Path):
+
+        self.path = Path(path)
+
+        self.lock = threading.Lock()
+        self.connection = open_database(path=self.path, schema=(
+            "CREATE TABLE IF NOT EXISTS exports (playlist_id TEXT NOT NULL, format TEXT NOT NULL, snapshot_id TEXT NOT NULL, track_ids TEXT NOT NULL, "
+            "albums TEXT NOT NULL, path TEXT NOT NULL, exported_at REAL NOT NULL, PRIMARY KEY (playlist_id, format))",
+        ))
+
+    """ The last export of playlist_id to export_format, or None if it's never been exported (or the file has since been deleted). """
+    def get(self, playlist_id: str, export_format: str) -> dict | None:
+
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT snapshot_id, track_ids, albums, path, exported_at FROM exports WHERE playlist_id = ? AND format = ?", (playlist_id, export_format)
+            ).fetchone()
+
+        if row is None or not Path(row[3]).is_file():
+            return None
+
+        return {
+            "snapshot_id": row[0],
+            "track_ids": json.loads(row[1]),
+            "albums": {album_id: Album.from_dict(album_dict=album_dict) for album_id, album_dict in json.loads(row[2]).items()},
+            "path": Path(row[3]),
+            "exported_at": row[4]
+        }
+
+    def put(self, playlist_id: str, export_format: str, snapshot_id: str, track_ids: list[str], albums: dict[str, Album], path: str | Path) -> None:
+
+        albums = {album_id: album.to_dict() for album_id, album in albums.items()}
+        with self.lock:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO exports (playlist_id, format, snapshot_id, track_ids, albums, path, exported_at) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (playlist_id, export_format, snapshot_id, json.dumps(track_ids, separators=(",", ":")), json.dumps(albums, separators=(",", ":")), str(path), time.time())
+            )
+            self.connection.commit()
+
+    def close(self) -> None:
+
+        with self.lock:
+            self.connection.close()
+
+"""
+    Passes tracks straight through while noting down each track id and the album data it was enriched with, so the index can be updated after an export without
+    the tracks having to be kept around (which matters when they're streamed). Albums that couldn't be loaded aren't remembered so they get another go next time.
+"""
+def remember_tracks(tracks: Iterable[Track], track_ids: list[str], albums: dict[str, Album]) -> Iterator[Track]:
+
+    for track in tracks:
+        track_ids.append(track.track_id)
+        if track.album_id is not None and track.album is not None and track.album.upc != "UNAVAILABLE":
+            albums[track.album_id] = track.album
+        yield track
+
+""" Opens the index in SPEX_CACHE_DIR next to the album cache. Setting SPEX_EXPORT_INDEX=0 turns it off and returns None. """
+def open_export_index() -> ExportIndex | None:
+
+    if os.getenv("SPEX_EXPORT_INDEX", "1") == "0":
+        return None
+
+    cache_dir = Path(os.getenv("SPEX_CACHE_DIR", Path.home() / ".cache" / "spex"))
+
+    return ExportIndex(path=cache_dir / "exports.sqlite3")
@@ -1,7 +1,24 @@
+import csv
+from io import StringIO
+from itertools import islice
+import json
+import os
 from pathlib import Path
 import re
+from typing import BinaryIO, Callable, Iterable, Iterator, TextIO, TYPE_CHECKING
 
-import pandas as pd
+from spex.formatter import COLUMNS
+from spex.formatter import format_row
+from spex.formatter import playlist_typed_formatter
+from spex.formatter import RAW_COLUMNS
+from spex.formatter import raw_row
+from spex.formatter import typed_row
+from spex.metrics import METRICS
+from spex.records import Track
+
+# openpyxl is only imported by the xlsx exports and pandas is only here for a type hint, so a csv or ndjson export never pays for loading either
+if TYPE_CHECKING:
+    import pandas as pd
 
 
 """
@@ -9,15 +26,18 @@ import pandas as pd
     I think it opens the excel file and gives you a way to refer to it
 """
 
+""" Where exports get saved unless SPEX_EXPORT_DIR says otherwise """
+SAVE_LOCATION = "/Users/intern/Documents/Miles/spotify_playlist_exporter/test_exports"
 
 """
-    exports the data frame to an excel document. Eventually I'd like to export different sheets all at different stages of cleaning.
+    Works out where to save an export without overwriting an older one. If playlist_name.extension already exists it adds (n) on the end, where n is one more
+    than the biggest number already used. SPEX_EXPORT_DIR is read here rather than on import so a .env that main loads later still counts.
 """
-def export_to_excel(playlist_name: str, playlist_frame: pd.DataFrame) -> None:
+def get_save_path(playlist_name: str, extension: str) -> Path:
+
+    save_location = Path(os.getenv("SPEX_EXPORT_DIR", SAVE_LOCATION))
 
-    save_location = Path("/Users/intern/Documents/Miles/spotify_playlist_exporter/test_exports")
-    
-    files = [file.name for file in save_location.glob(f"{playlist_name}*.xlsx") if file.is_file]
+    files = [file.name for file in save_location.glob(f"{playlist_name}*.{extension}") if file.is_file]
 
     duplicate_found = False
     max = 1
@@ -25,7 +45,7 @@ def export_to_excel(playlist_name: str, playlist_frame: pd.DataFrame) -> None:
 
     for file_name in files:
 
-        pattern = re.escape(playlist_name) + r"(\((\d+)\)){0,1}.xlsx$"
+        pattern = re.escape(playlist_name) + r"(\((\d+)\)){0,1}\." + re.escape(extension) + "$"
         match = re.search(pattern=pattern, string=file_name)
 
         if match is not None:
@@ -41,4 +61,235 @@ def export_to_excel(playlist_name: str, playlist_frame: pd.DataFrame) -> None:
     if duplicate_found:
         new_name = playlist_name + f"({max})"
 
-    playlist_frame.to_excel(f"{save_location}/{new_name}.xlsx", index=False, engine="openpyxl")
\ No newline at end of file
+    return save_location / f"{new_name}.{extension}"
+
+""" The sheets a track export gets by default, sheet name -> (columns, function that turns a track into a row). Each one is a different stage of cleaning. """
+STAGES = {
+    "Playlist": (COLUMNS, format_row),
+    "Raw": (RAW_COLUMNS, raw_row)
+}
+
+""" The sheets an xlsx export gets, the raw data sheet roughly doubles the time it takes to save so it's only there if it was asked for. """
+def xlsx_stages(raw: bool) -> dict[str, tuple[list[str], Callable[[Track], dict]]]:
+
+    return STAGES if raw else {"Playlist": STAGES["Playlist"]}
+
+"""
+    Writes xlsx files using openpyxl's write only mode. Rows go straight out to temp files as they're appended rather than building every cell in memory the way
+    DataFrame.to_excel does, so memory stays about the same however many rows there are. Each track is appended to every sheet at once, which means a single
+    pass over a generator of tracks is enough to fill all of them.
+"""
+class XlsxWriter:
+
+    def __init__(self, stages: dict[str, tuple[list[str], Callable[[Track], dict]]] = STAGES):
+
+        from openpyxl import Workbook
+
+        self.workbook = Workbook(write_only=True)
+        self.sheets = []
+        self.row_count = 0
+
+        for sheet_name, (columns, to_row) in stages.items():
+            sheet = self.workbook.create_sheet(title=sheet_name)
+            sheet.append(columns)
+            self.sheets.append((sheet, columns, to_row))
+
+    def append(self, track: Track) -> None:
+
+        for sheet, columns, to_row in self.sheets:
+            row = to_row(track)
+            sheet.append([row[column] for column in columns])
+
+        self.row_count += 1
+
+    """ Can only be called once, write only workbooks can't be saved twice. """
+    def save(self, file: str | Path | BinaryIO) -> None:
+
+        self.workbook.save(file)
+
+""" Writes tracks to an xlsx file with a sheet for each stage, returns how many tracks were written. """
+def write_xlsx(tracks: Iterable[Track], file: str | Path | BinaryIO, stages: dict[str, tuple[list[str], Callable[[Track], dict]]] = STAGES) -> int:
+
+    with METRICS.stage(name="serialize"):
+
+        writer = XlsxWriter(stages=stages)
+        for track in tracks:
+            writer.append(track=track)
+        writer.save(file=file)
+
+    return writer.row_count
+
+"""
+    exports the data frame to an excel document. Written through XlsxWriter rather than to_excel so it doesn't build the whole workbook in memory. The sheet is
+    still called Sheet1 like to_excel would have called it.
+"""
+def export_to_excel(playlist_name: str, playlist_frame: "pd.DataFrame") -> None:
+
+    columns = list(playlist_frame.columns)
+    rows = (dict(zip(columns, values)) for values in playlist_frame.itertuples(index=False, name=None))
+
+    write_xlsx(tracks=rows, file=get_save_path(playlist_name=playlist_name, extension="xlsx"), stages={"Sheet1": (columns, lambda row: row)})
+
+"""
+    Exports tracks (a list or a generator) straight to an excel document with a sheet for each stage of cleaning. Returns where it was saved. Pass save_path to
+    overwrite an earlier export rather than saving a new copy next to it, the same goes for the other export_to functions.
+"""
+def export_tracks_to_excel(playlist_name: str, tracks: Iterable[Track], stages: dict[str, tuple[list[str], Callable[[Track], dict]]] = STAGES,
+                           save_path: Path | None = None) -> Path:
+
+    save_path = save_path or get_save_path(playlist_name=playlist_name, extension="xlsx")
+    write_xlsx(tracks=tracks, file=save_path, stages=stages)
+
+    return save_path
+
+""" Sheet names can't be over 31 characters, can't use []:*?/\\ and have to be unique within a workbook. """
+def sheet_title(name: str, used: set[str]) -> str:
+
+    title = re.sub(pattern=r"[\[\]:*?/\\]", repl="_", string=name).strip("'")[:31] or "Playlist"
+
+    number = 1
+    base_title = title
+    while title.lower() in used:
+        number += 1
+        suffix = f" ({number})"
+        title = base_title[:31 - len(suffix)] + suffix
+
+    used.add(title.lower())
+
+    return title
+
+""" One workbook for a whole batch, each playlist gets its own formatted sheet. Returns where it was saved. """
+def export_playlists_to_excel(workbook_name: str, playlists: Iterable[dict]) -> Path:
+
+    from openpyxl import Workbook
+
+    save_path = get_save_path(playlist_name=workbook_name, extension="xlsx")
+
+    with METRICS.stage(name="serialize"):
+
+        workbook = Workbook(write_only=True)
+        used = set()
+        for playlist in playlists:
+            sheet = workbook.create_sheet(title=sheet_title(name=playlist["name"], used=used))
+            sheet.append(COLUMNS)
+            for track in playlist["items"]:
+                row = format_row(item=track)
+                sheet.append([row[column] for column in COLUMNS])
+
+        workbook.save(save_path)
+
+    return save_path
+
+"""
+    Writes rows to file as they come in, nothing is held on to so this works just as well on a generator of a 50k track playlist as on a list. The output matches
+    what DataFrame.to_csv gives for the same rows.
+"""
+def write_csv(rows: Iterable[dict], file: TextIO) -> int:
+
+    with METRICS.stage(name="serialize"):
+
+        writer = csv.writer(file, lineterminator="\n")
+        writer.writerow(COLUMNS)
+
+        row_count = 0
+        for row in rows:
+            writer.writerow(row[column] for column in COLUMNS)
+            row_count += 1
+
+    return row_count
+
+""" Formats a batch of rows as csv text, for when the text is being sent somewhere (like a streaming response) rather than written to a file. """
+def csv_text(rows: Iterable[dict], header: bool = False) -> str:
+
+    buffer = StringIO()
+    writer = csv.writer(buffer, lineterminator="\n")
+    if header:
+        writer.writerow(COLUMNS)
+    writer.writerows([row[column] for column in COLUMNS] for row in rows)
+
+    return buffer.getvalue()
+
+""" Streams rows straight into a csv file next to the excel exports. Returns where it was saved. """
+def export_to_csv(playlist_name: str, rows: Iterable[dict], save_path: Path | None = None) -> Path:
+
+    save_path = save_path or get_save_path(playlist_name=playlist_name, extension="csv")
+    with open(save_path, "w", newline="", encoding="utf-8") as file:
+        write_csv(rows=rows, file=file)
+
+    return save_path
+
+"""
+    Parquet keeps the column types so analytics jobs don't have to parse text back into numbers and dates. Tracks are formatted chunk_size at a time with
+    playlist_typed_formatter and each chunk is handed to pyarrow as a whole frame and written as a row group, so a generator of tracks never has to be held in memory
+    all at once. pyarrow is optional (pip install spex[columnar]) so it's only imported here.
+"""
+def write_parquet(tracks: Iterable[Track], file: str | Path | BinaryIO, chunk_size: int = 10_000) -> int:
+
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    schema = pa.schema([
+        ("track_id", pa.string()),
+        ("track_title", pa.string()),
+        ("isrc", pa.string()),
+        ("release_artists", pa.list_(pa.string())),
+        ("featured_artists", pa.list_(pa.string())),
+        ("album_id", pa.string()),
+        ("album_title", pa.string()),
+        ("album_type", pa.dictionary(pa.int32(), pa.string())),
+        ("upc", pa.string()),
+        ("label", pa.string()),
+        ("duration_ms", pa.int64()),
+        ("release_date", pa.date32()),
+        ("release_date_precision", pa.dictionary(pa.int32(), pa.string())),
+        ("source", pa.string())
+    ])
+
+    with METRICS.stage(name="serialize"):
+
+        row_count = 0
+        with pq.ParquetWriter(file, schema=schema, compression="zstd") as writer:
+
+            tracks = iter(tracks)
+            while chunk := list(islice(tracks, chunk_size)):
+                frame = playlist_typed_formatter(playlist_raw=chunk)
+                writer.write_table(pa.Table.from_pandas(frame, schema=schema, preserve_index=False))
+                row_count += len(chunk)
+
+    return row_count
+
+def export_to_parquet(playlist_name: str, tracks: Iterable[Track], save_path: Path | None = None) -> Path:
+
+    save_path = save_path or get_save_path(playlist_name=playlist_name, extension="parquet")
+    write_parquet(tracks=tracks, file=save_path)
+
+    return save_path
+
+def ndjson_line(track: Track) -> str:
+
+    return json.dumps(typed_row(item=track), ensure_ascii=False, separators=(",", ":")) + "\n"
+
+""" One json object per line per track. Each line is made as it's asked for so this can be streamed straight out. """
+def ndjson_lines(tracks: Iterable[Track]) -> Iterator[str]:
+
+    for track in tracks:
+        yield ndjson_line(track=track)
+
+def write_ndjson(tracks: Iterable[Track], file: TextIO) -> int:
+
+    with METRICS.stage(name="serialize"):
+
+        row_count = 0
+        for line in ndjson_lines(tracks=tracks):
+            file.write(line)
+            row_count += 1
+
+    return row_count
+
+def export_to_ndjson(playlist_name: str, tracks: Iterable[Track], save_path: Path | None = None) -> Path:
+
+    save_path = save_path or get_save_path(playlist_name=playlist_name, extension="ndjson")
+    with open(save_path, "w", encoding="utf-8") as file:
+        write_ndjson(tracks=tracks, file=file)
+
+    return save_path
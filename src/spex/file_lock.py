@@ -0,0 +1,37 @@
+import asyncio
+from contextlib import asynccontextmanager, contextmanager
+import fcntl
+from pathlib import Path
+
+"""
+    An exclusive lock on a file, for the bits of state more than one process shares (the web server's workers all use the same token file). flock locks belong
+    to the open file so they're let go of when the process exits, a worker that dies holding one never leaves the rest stuck.
+"""
+
+@contextmanager
+def file_lock(path: str | Path):
+
+    Path(path).parent.mkdir(parents=True, exist_ok=True)
+    with open(path, "a") as file:
+        fcntl.flock(file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(file, fcntl.LOCK_UN)
+
+""" Same as file_lock for the event loop. It asks for the lock without blocking and sleeps between goes, so waiting on another process doesn't stall every request. """
+@asynccontextmanager
+async def file_lock_async(path: str | Path, poll: float = 0.02):
+
+    Path(path).parent.mkdir(parents=True, exist_ok=True)
+    with open(path, "a") as file:
+        while True:
+            try:
+                fcntl.flock(file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                break
+            except BlockingIOError:
+                await asyncio.sleep(poll)
+        try:
+            yield
+        finally:
+            fcntl.flock(file, fcntl.LOCK_UN)
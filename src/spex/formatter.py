@@ -1,16 +1,34 @@
-import re
+from functools import cache
+from typing import Iterable, Iterator, TYPE_CHECKING
 
-import pandas as pd
+from spex.metrics import METRICS
+from spex.records import Track
 
-""" Uses regex to convert the date from Spotify's YYYY-MM-DD format into Lime Blue's DD/MM/YY format. Spotify provides a precision value for the date. Lime Blue has a procedure 
-    for dates given to poor precision. add that functionality to my function, it's important.
+# numpy and pandas take most of a second to import, which is most of the runtime of a small csv export. Only the frame formatters need them so they're imported
+# inside those, the row formatters (which is all the csv, xlsx and ndjson exports use) get by on the standard library
+if TYPE_CHECKING:
+    import numpy as np
+    import pandas as pd
+
+"""
+    Spotify dates are YYYY-MM-DD, YYYY-MM or YYYY depending on release_date_precision, this gives DD/MM/YYYY, MM/YYYY or YYYY. When we don't have the precision
+    it's worked out from the length of the date. format_row and format_dates both go through here so a row and a frame always agree. Local files have no release
+    date at all, those get None.
 """
-def format_date(date: str) -> str:
+def format_release_date(date: str | None, precision: str | None) -> str | None:
+
+    if not date:
+        return None
+
+    if precision is None:
+        precision = {10: "day", 7: "month"}.get(len(date), "year")
 
-    split_list = re.split(pattern=r"-{1}", string=date)
-    split_list.reverse()
+    if precision == "day":
+        return f"{date[8:10]}/{date[5:7]}/{date[0:4]}"
+    elif precision == "month":
+        return f"{date[5:7]}/{date[0:4]}"
 
-    return "/".join(split_list)
+    return date[0:4]
 
 """ Uses regex to convert the time from Spotify's time format in ms into Lime Blues hh:mm:ss format. """
 def format_time(time: int) -> str:
@@ -22,34 +40,259 @@ def format_time(time: int) -> str:
     
     return f"{hours:02}:{minutes:02}:{seconds:02}"
 
+""" The columns Lime Blue wants, in order. Every formatter produces exactly these. """
+COLUMNS = [
+    "Release Artist",
+    "Track Band / Artist Name",
+    "Recording Title",
+    "ISRC",
+    "Album Title",
+    "Catalogue Number",
+    "Original Release Label",
+    "Duration (hh:mm:ss)",
+    "Release Date (DD/MM/YYYY)",
+    "Source"
+]
+
 """
     For this function we could do more work to keep everything clean, especially around None type values.
-    I need to decide if I want to include Album Type and I need to fix the bugs with Publishing and Copy. Might get rid of the nested dictionary structure in the api client
-    so bare that in mind as I would need to change some of this code
+    I need to decide if I want to include Album Type and I need to fix the bugs with Publishing and Copy.
 """
-def playlist_frame_formatter(playlist_raw: list[dict]) -> pd.DataFrame:
+def format_row(item: Track) -> dict:
+
+    item_dict_clean = {}
+
+    item_dict_clean["Release Artist"] = ", ".join(item.release_artists)
+    item_dict_clean["Track Band / Artist Name"] = ", ".join(item.featured_artists)
+    item_dict_clean["Recording Title"] = item.title
+    # item_dict_clean["Subtitle / Version / Mixname"]
+    item_dict_clean["ISRC"] = item.isrc
+    item_dict_clean["Album Title"] = item.album_title
+    item_dict_clean["Catalogue Number"] = item.album.upc
+    item_dict_clean["Original Release Label"] = item.album.label # Need to talk to mario about how relevant this bit is
+    item_dict_clean["Duration (hh:mm:ss)"] = format_time(item.duration_ms)
+    item_dict_clean["Release Date (DD/MM/YYYY)"] = format_release_date(date=item.release_date, precision=item.release_date_precision)
+    # item_dict_clean["Album Type"] # = item.album_type
+    # item_dict_clean["Publishing"] # This can be found in item.album.copy_rights
+    # item_dict_clean["Copy"] # This can be found in item.album.copy_rights
+    item_dict_clean["Source"] = "Spotify"
+
+    return item_dict_clean
 
-    playlist_clean = []
+""" Columns for the raw sheet, this is the data more or less as spotify gave it to us before any of Lime Blue's formatting. """
+RAW_COLUMNS = [
+    "Track ID",
+    "Release Artists",
+    "Featured Artists",
+    "Track Title",
+    "ISRC",
+    "Album ID",
+    "Album Title",
+    "Album Type",
+    "UPC",
+    "Label",
+    "Copyrights",
+    "Duration (ms)",
+    "Release Date",
+    "Release Date Precision"
+]
+
+""" One row of the raw sheet. Lists get joined so they fit in a cell but nothing else is changed. """
+def raw_row(item: Track) -> dict:
+
+    copy_rights = item.album.copy_rights
+    if not isinstance(copy_rights, str):
+        copy_rights = "; ".join(f"{copy_right_type}: {text}" for copy_right_type, text in copy_rights)
+
+    return {
+        "Track ID": item.track_id,
+        "Release Artists": ", ".join(item.release_artists),
+        "Featured Artists": ", ".join(item.featured_artists),
+        "Track Title": item.title,
+        "ISRC": item.isrc,
+        "Album ID": item.album_id,
+        "Album Title": item.album_title,
+        "Album Type": item.album_type,
+        "UPC": item.album.upc,
+        "Label": item.album.label,
+        "Copyrights": copy_rights,
+        "Duration (ms)": item.duration_ms,
+        "Release Date": item.release_date,
+        "Release Date Precision": item.release_date_precision
+    }
+
+""" Formats tracks one at a time as they're asked for, so it works on a generator of tracks without ever holding the whole playlist. """
+def iter_rows(playlist_raw: Iterable[Track]) -> Iterator[dict]:
 
     for item in playlist_raw:
+        yield format_row(item=item)
+
+""" Every mm:ss from 00:00 to 59:59, indexed by seconds. Looking the text up is far quicker than building it for each track. Made the first time it's needed. """
+@cache
+def minutes_seconds() -> "np.ndarray":
+
+    import numpy as np
+
+    return np.array([f"{minutes:02}:{seconds:02}" for minutes in range(60) for seconds in range(60)], dtype=object)
+
+"""
+    format_time for a whole column at once. np.round rounds halves to even the same way round() does so the two always agree. Anything under an hour (so nearly
+    every track) is a straight lookup in minutes_seconds(), the odd long track is formatted the normal way.
+"""
+def format_durations(durations: "np.ndarray") -> "np.ndarray":
+
+    import numpy as np
+
+    time_seconds = np.round(durations.astype("float64") / 1000).astype("int64")
+    hours, remainder = np.divmod(time_seconds, 3600)
+
+    formatted = "00:" + minutes_seconds()[remainder]
+    long_tracks = np.flatnonzero(hours != 0)
+    formatted[long_tracks] = [format_time(time=int(time_seconds[index]) * 1000) for index in long_tracks]
+
+    return formatted
+
+"""
+    format_release_date for a whole column at once. A playlist only has a handful of different release dates compared to how many tracks it has, so each distinct
+    date (and precision) is formatted once and then the results are spread back out over every track with a single take. Missing dates are swapped for "" first,
+    factorize would give None the code -1 and take(-1) would hand those tracks the last date in the list.
+"""
+def format_dates(dates: list[str | None], precisions: list[str | None]) -> "np.ndarray":
+
+    import numpy as np
+    import pandas as pd
+
+    codes, unique_dates = pd.factorize(np.array([date or "" for date in dates], dtype=object))
+    # a date string always has the same precision so the first track with each date can speak for the rest
+    first_seen = np.unique(codes, return_index=True)[1]
+
+    formatted_dates = [format_release_date(date=date, precision=precisions[index]) for date, index in zip(unique_dates, first_seen)]
+
+    return np.array(formatted_dates, dtype=object).take(codes)
+
+"""
+    Builds the frame a column at a time rather than a row at a time. The artist names still need joining per track since every track has its own tuple, everything
+    else goes straight from the records into a column and the duration and date formatting is done to the whole column in one go.
+"""
+def playlist_frame_formatter(playlist_raw: list[Track]) -> "pd.DataFrame":
+
+    import numpy as np
+    import pandas as pd
+
+    with METRICS.stage(name="format"):
+
+        columns = {
+            "Release Artist": [", ".join(track.release_artists) for track in playlist_raw],
+            "Track Band / Artist Name": [", ".join(track.featured_artists) for track in playlist_raw],
+            "Recording Title": [track.title for track in playlist_raw],
+            "ISRC": [track.isrc for track in playlist_raw],
+            "Album Title": [track.album_title for track in playlist_raw],
+            "Catalogue Number": [track.album.upc for track in playlist_raw],
+            "Original Release Label": [track.album.label for track in playlist_raw],
+            "Duration (hh:mm:ss)": format_durations(np.array([track.duration_ms for track in playlist_raw], dtype="float64")),
+            "Release Date (DD/MM/YYYY)": format_dates(
+                dates=[track.release_date for track in playlist_raw],
+                precisions=[track.release_date_precision for track in playlist_raw]
+            ),
+            "Source": "Spotify"
+        }
+
+        frame = pd.DataFrame(columns, columns=COLUMNS, index=pd.RangeIndex(len(playlist_raw)))
+
+    return frame
+
+
+""" Columns for the typed exports (parquet and ndjson). These keep the real types, durations stay as ms, dates are dates and artists stay as lists. """
+TYPED_COLUMNS = [
+    "track_id",
+    "track_title",
+    "isrc",
+    "release_artists",
+    "featured_artists",
+    "album_id",
+    "album_title",
+    "album_type",
+    "upc",
+    "label",
+    "duration_ms",
+    "release_date",
+    "release_date_precision",
+    "source"
+]
+
+"""
+    Spotify gives YYYY, YYYY-MM or YYYY-MM-DD, this fills in the missing month and day with 01 so it can be stored as a real date. The precision is kept next to it so
+    nobody mistakes a year only release for one that came out on the 1st of January. Returns None for dates that aren't real (spotify has some with year 0000).
+"""
+def to_iso_date(date: str | None) -> str | None:
+
+    if not date or date.startswith("0000"):
+        return None
+
+    if len(date) == 4:
+        return date + "-01-01"
+    elif len(date) == 7:
+        return date + "-01"
+
+    return date
+
+""" One typed record, ready to go straight into json.dumps. """
+def typed_row(item: Track) -> dict:
+
+    release_date = item.release_date
+
+    return {
+        "track_id": item.track_id,
+        "track_title": item.title,
+        "isrc": item.isrc,
+        "release_artists": list(item.release_artists),
+        "featured_artists": list(item.featured_artists),
+        "album_id": item.album_id,
+        "album_title": item.album_title,
+        "album_type": item.album_type,
+        "upc": item.album.upc,
+        "label": item.album.label,
+        "duration_ms": item.duration_ms,
+        "release_date": to_iso_date(date=release_date),
+        "release_date_precision": item.release_date_precision or {10: "day", 7: "month"}.get(len(release_date or ""), "year"),
+        "source": "Spotify"
+    }
+
+"""
+    Typed version of playlist_frame_formatter, built a column at a time the same way. duration_ms is a nullable integer, release_date is datetime64 (the exporter
+    narrows it to a plain date) and the artist columns hold lists of names.
+"""
+def playlist_typed_formatter(playlist_raw: list[Track]) -> "pd.DataFrame":
+
+    import numpy as np
+    import pandas as pd
+
+    with METRICS.stage(name="format"):
+
+        release_dates = [track.release_date for track in playlist_raw]
+        precisions = [track.release_date_precision or {10: "day", 7: "month"}.get(len(date or ""), "year") for track, date in zip(playlist_raw, release_dates)]
+
+        # like format_dates, only the distinct dates get parsed (and missing ones are "" so they don't get -1)
+        codes, unique_dates = pd.factorize(np.array([date or "" for date in release_dates], dtype=object))
+        parsed_dates = pd.to_datetime(pd.Series([to_iso_date(date=date) for date in unique_dates], dtype=object), format="%Y-%m-%d", errors="coerce")
+
+        columns = {
+            "track_id": [track.track_id for track in playlist_raw],
+            "track_title": [track.title for track in playlist_raw],
+            "isrc": [track.isrc for track in playlist_raw],
+            "release_artists": [list(track.release_artists) for track in playlist_raw],
+            "featured_artists": [list(track.featured_artists) for track in playlist_raw],
+            "album_id": [track.album_id for track in playlist_raw],
+            "album_title": [track.album_title for track in playlist_raw],
+            "album_type": pd.Categorical([track.album_type for track in playlist_raw]),
+            "upc": [track.album.upc for track in playlist_raw],
+            "label": [track.album.label for track in playlist_raw],
+            "duration_ms": pd.array([track.duration_ms for track in playlist_raw], dtype="Int64"),
+            "release_date": parsed_dates.to_numpy().take(codes) if len(codes) else np.array([], dtype="datetime64[ns]"),
+            "release_date_precision": pd.Categorical(precisions, categories=["day", "month", "year"]),
+            "source": "Spotify"
+        }
+
+        frame = pd.DataFrame(columns, columns=TYPED_COLUMNS, index=pd.RangeIndex(len(playlist_raw)))
 
-        item_dict_clean = {}
-
-        item_dict_clean["Release Artist"] = ", ".join(artist["name"] for artist in item["trackRequest"]["releaseArtists"])
-        item_dict_clean["Track Band / Artist Name"] = ", ".join(artist["name"] for artist in item["trackRequest"]["featuredArtists"])
-        item_dict_clean["Recording Title"] = item["trackRequest"]["trackTitle"]
-        # item_dict_clean["Subtitle / Version / Mixname"]
-        item_dict_clean["ISRC"] = item["trackRequest"]["isrc"]
-        item_dict_clean["Album Title"] = item["trackRequest"]["albumTitle"]
-        item_dict_clean["Catalogue Number"] = item["albumRequest"]["upc"]
-        item_dict_clean["Original Release Label"] = item["albumRequest"]["label"] # Need to talk to mario about how relevant this bit is
-        item_dict_clean["Duration (hh:mm:ss)"] = format_time(item["trackRequest"]["trackDuration"])
-        item_dict_clean["Release Date (DD/MM/YYYY)"] = format_date(item["trackRequest"]["releaseDate"])
-        # item_dict_clean["Album Type"] # = item["trackRequest"]["albumType"]
-        # item_dict_clean["Publishing"] # This can be found in albumRequest/copyRights
-        # item_dict_clean["Copy"] # This can be found in albumRequest/copyRights
-        item_dict_clean["Source"] = "Spotify"
-
-        playlist_clean.append(item_dict_clean)
-
-    return pd.DataFrame(playlist_clean)
\ No newline at end of file
+    return frame
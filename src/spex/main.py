@@ -1,13 +1,40 @@
 import argparse
 import os
-import re
+from pathlib import Path
+import sys
+import time
 
 from dotenv import load_dotenv
 
+from spex.album_cache import open_album_cache
+from spex.api_client import BASE_URL
+from spex.api_client import ClientDetails
+from spex.api_client import create_session
 from spex.api_client import get_playlist
+from spex.api_client import get_snapshot
+from spex.api_client import IncompleteCrawlError
 from spex.api_client import set_client
-from spex.exporter import export_to_excel
-from spex.formatter import playlist_frame_formatter
+from spex.api_client import stream_playlist
+from spex.batch import load_batch
+from spex.batch import load_snapshots
+from spex.batch import parse_playlist_id
+from spex.batch import read_links
+from spex.cassette import open_cassette
+from spex.checkpoints import open_crawl_checkpoints
+from spex.exporter import export_playlists_to_excel
+from spex.exporter import export_to_csv
+from spex.exporter import export_to_ndjson
+from spex.exporter import export_to_parquet
+from spex.exporter import export_tracks_to_excel
+from spex.exporter import get_save_path
+from spex.exporter import xlsx_stages
+from spex.export_index import ExportIndex
+from spex.export_index import open_export_index
+from spex.export_index import remember_tracks
+from spex.formatter import iter_rows
+from spex.metrics import METRICS
+from spex.rate_limiter import open_rate_limiter
+from spex.token_provider import open_token_provider
 
 """
     Handles command line input using argparse, extracts the playlist id from the playlist url using regex, loads secret information from .env using python-dotenv, finally
@@ -19,25 +46,120 @@ from spex.formatter import playlist_frame_formatter
 def main() -> None:
 
     parser = argparse.ArgumentParser(description="Read playlist url and launch program")
-    parser.add_argument("playlist_link", type=str, help="Link to Spotify Playlist")
+    parser.add_argument("playlist_link", type=str, nargs="*", help="Links to (or ids of) Spotify Playlists, more than one runs them as a batch")
+    parser.add_argument("--input", type=argparse.FileType("r", encoding="utf-8"), help="File with a playlist link or id on each line, - reads them from stdin")
+    parser.add_argument("--jobs", type=int, default=4, help="How many playlists in a batch are loaded at once")
+    parser.add_argument("--combined", metavar="NAME", help="Put every playlist in the batch into one xlsx workbook called NAME, a sheet each")
+    parser.add_argument("--stream", action="store_true", help="Write rows as each page arrives instead of loading the whole playlist first")
+    parser.add_argument("--format", choices=["xlsx", "csv", "parquet", "ndjson"], default="xlsx",
+                        help="What to export to, xlsx gets a formatted sheet, parquet and ndjson keep the real types for analytics")
+    parser.add_argument("--raw", action="store_true", help="Add a sheet of the unformatted spotify data to an xlsx export, it takes about twice as long to save")
+    parser.add_argument("--profile", action="store_true", help="Print request latencies, retries, cache hits and how long each stage took once the export is done")
+    parser.add_argument("--full", action="store_true", help="Export every playlist again even if it hasn't changed since the last export")
     args = parser.parse_args()
-    link = args.playlist_link
 
-    # error handle here to deal with bad url inputs
-    # give the option to enter a playlist_id manually
-    pattern = r"https:\/\/open.spotify.com\/playlist\/(.*)\?"
-    match = re.search(pattern=pattern, string=link)
-    playlist_id = match.group(1)
+    links = list(args.playlist_link)
+    if args.input is not None:
+        with args.input:
+            links.extend(read_links(file=args.input))
+
+    batch = len(links) > 1 or args.combined is not None
+    if not links:
+        parser.error("give at least one playlist link, or --input")
+    if batch and args.stream:
+        parser.error("--stream only works with a single playlist")
+    if args.combined is not None and args.format != "xlsx":
+        parser.error("--combined only makes xlsx workbooks")
+    if args.raw and (args.format != "xlsx" or args.combined is not None):
+        parser.error("--raw only works with --format xlsx, and not with --combined")
+
+    start = time.perf_counter()
+    failures = []
+    client = None
+    export_index = None
+    try:
+        client = open_client()
+        export_index = open_export_index()
+        if batch:
+            failures = export_batch(client=client, links=links, export_format=args.format, jobs=args.jobs, combined=args.combined, export_index=export_index,
+                                    full=args.full, raw=args.raw)
+        else:
+            failures = export_link(client=client, link=links[0], stream=args.stream, export_format=args.format, export_index=export_index, full=args.full,
+                                   raw=args.raw)
+    finally:
+        if export_index is not None:
+            export_index.close()
+        # closing the session is also what writes out a cassette that's being recorded
+        if client is not None:
+            client.session.close()
+        if args.profile:
+            print(METRICS.summary())
+            print(f"Total {time.perf_counter() - start:.3f}s (stages run side by side when streaming or in a batch, so they won't add up to this)")
+
+    # so a nightly job can tell something went wrong without reading the output
+    if failures:
+        sys.exit(1)
+
+""" One client for the whole run, a batch shares its token, rate budget, connections and album cache between every playlist. """
+def open_client() -> ClientDetails:
 
     load_dotenv()
     client_id = os.getenv("CLIENT_ID")
     client_secret = os.getenv("CLIENT_SECRET")
 
-    client = set_client(client_id=client_id, client_secret=client_secret)
+    token_provider = open_token_provider(client_id=client_id, client_secret=client_secret)
+    rate_limiter = open_rate_limiter()
+    session = create_session(pool_size=int(os.getenv("SPEX_POOL_SIZE", rate_limiter.max_concurrency)), connect_retries=int(os.getenv("SPEX_CONNECT_RETRIES", 3)),
+                             cassette=open_cassette())
+
+    # pages and albums are checkpointed as they load, so a crawl that fails part way picks up where it left off on the next go
+    return set_client(client_id=client_id, client_secret=client_secret, album_cache=open_album_cache(), token_provider=token_provider, rate_limiter=rate_limiter,
+                      session=session, base_url=os.getenv("SPEX_API_URL", BASE_URL), checkpoints=open_crawl_checkpoints())
+
+"""
+    If the playlist has been exported before and its snapshot_id hasn't changed since then, there's nothing to do and only the one small snapshot request is made.
+    Otherwise it's exported over the top of the last export, and the albums that were already looked up last time aren't looked up again. full skips both.
+    Returns the failure as a (link, reason) pair in a list the same way export_batch does, empty if it worked.
+"""
+def export_link(client: ClientDetails, link: str, stream: bool, export_format: str, export_index: ExportIndex | None = None,
+                full: bool = False, raw: bool = False) -> list[tuple[str, str]]:
+
+    # give the option to enter a playlist_id manually
+    playlist_id = parse_playlist_id(link=link)
+    if playlist_id is None:
+        print(f"Couldn't find a playlist id in {link}")
+        return [(link, "no playlist id in link")]
+
+    previous = export_index.get(playlist_id=playlist_id, export_format=index_format(export_format=export_format, raw=raw)) if export_index is not None else None
+    if previous is not None and not full:
+        snapshot, client = get_snapshot(client=client, playlist_id=playlist_id)
+        if snapshot.data is not None and snapshot.data.get("snapshot_id") == previous["snapshot_id"]:
+            print(f"{snapshot.data['name']} hasn't changed since it was exported to {previous['path']}")
+            return []
+    known_albums = previous["albums"] if previous is not None and not full else None
+
+    if stream:
+        # memory stays flat no matter how big the playlist is, rows are written as soon as their page has been enriched
+        playlist, client = stream_playlist(client=client, playlist_id=playlist_id)
+        if playlist.data is None:
+            print(f"Couldn't load playlist ({playlist.status}): {playlist.error}")
+            return [(link, f"couldn't load playlist ({playlist.status}): {playlist.error}")]
+
+        # pages that failed only come to light once the rest have been written, the half written file is thrown away and the pages that did load are
+        # checkpointed for the next go
+        try:
+            save_path = export_and_index(playlist_id=playlist_id, playlist=playlist.data, export_format=export_format, export_index=export_index,
+                                         previous=previous, raw=raw)
+        except IncompleteCrawlError as error:
+            print(f"Couldn't load playlist ({error.result.status}): {error.result.error}")
+            return [(link, f"couldn't load playlist ({error.result.status}): {error.result.error}")]
+
+        print(f"Saved to {save_path}")
+        return []
 
     for i in range(3):
 
-        playlist, client = get_playlist(client=client, playlist_id=playlist_id)
+        playlist, client = get_playlist(client=client, playlist_id=playlist_id, known_albums=known_albums)
 
         if playlist.data is not None:
             break
@@ -47,17 +169,158 @@ def main() -> None:
                     print("Time to redo the thing. This isn't over yet :-)")
                     playlist_id = "something new that we've updated"
                 else:
-                    return
+                    break
             elif playlist.status == 401 or playlist.status == 429:
                 # consider trying one more time. Maybe we've got unlucky
                 pass
             elif playlist.status >= 500:
                 print("Error with Spotify server")
             else:
-                return
+                break
+
+    if playlist.data is None:
+        print(f"Couldn't load playlist ({playlist.status}): {playlist.error}")
+        return [(link, f"couldn't load playlist ({playlist.status}): {playlist.error}")]
             
-    playlist_frame = playlist_frame_formatter(playlist_raw=playlist.data["items"])
-    export_to_excel(playlist_name=playlist.data["name"], playlist_frame=playlist_frame)
+    save_path = export_and_index(playlist_id=playlist_id, playlist=playlist.data, export_format=export_format, export_index=export_index, previous=previous,
+                                 raw=raw)
+    print(f"Saved to {save_path}")
+
+    return []
+
+"""
+    Loads every playlist in links over the one client and exports each as it's own file, or all of them into one workbook if combined is set. Links that can't be
+    read, playlists that fail to load and exports that fail are all collected up and printed at the end rather than stopping the rest. Returns the failures as
+    (link, reason) pairs. Playlists that haven't changed since their last export are skipped the same way export_link skips them, a combined workbook always has
+    every playlist in it so it doesn't use the index.
+"""
+def export_batch(client: ClientDetails, links: list[str], export_format: str, jobs: int, combined: str | None = None, export_index: ExportIndex | None = None,
+                 full: bool = False, raw: bool = False) -> list[tuple[str, str]]:
+
+    links = list(dict.fromkeys(links))
+    failures = []
+    playlist_ids = {}
+    for link in links:
+        playlist_id = parse_playlist_id(link=link)
+        if playlist_id is None:
+            failures.append((link, "no playlist id in link"))
+        else:
+            playlist_ids[link] = playlist_id
+
+    if combined is not None:
+        export_index = None
+
+    previous_exports = {}
+    if export_index is not None:
+        for link, playlist_id in playlist_ids.items():
+            previous = export_index.get(playlist_id=playlist_id, export_format=index_format(export_format=export_format, raw=raw))
+            if previous is not None:
+                previous_exports[link] = previous
+
+    unchanged = []
+    known_albums = {}
+    if previous_exports and not full:
+        snapshots = load_snapshots(client=client, playlist_ids=[playlist_ids[link] for link in previous_exports], jobs=jobs)
+        for link, snapshot in zip(previous_exports, snapshots):
+            if snapshot.data is not None and snapshot.data.get("snapshot_id") == previous_exports[link]["snapshot_id"]:
+                unchanged.append(link)
+                print(f"{snapshot.data['name']} hasn't changed since it was exported to {previous_exports[link]['path']}")
+            else:
+                known_albums.update(previous_exports[link]["albums"])
+
+        for link in unchanged:
+            del playlist_ids[link]
+
+    results, client = load_batch(client=client, playlist_ids=playlist_ids.values(), jobs=jobs, known_albums=known_albums)
+
+    loaded = []
+    for link, playlist in zip(playlist_ids, results):
+        if playlist.data is None:
+            failures.append((link, f"couldn't load playlist ({playlist.status}): {playlist.error}"))
+        else:
+            loaded.append((link, playlist.data))
+
+    exported = 0
+    if combined is not None:
+        if loaded:
+            try:
+                save_path = export_playlists_to_excel(workbook_name=combined, playlists=[playlist for link, playlist in loaded])
+                exported = len(loaded)
+                print(f"Saved to {save_path}")
+            # openpyxl's IllegalCharacterError and a missing optional dependency's ImportError aren't OSErrors, none of them should stop the summary
+            except Exception as error:
+                failures.append((combined, f"couldn't save workbook: {type(error).__name__}: {error}"))
+    else:
+        for link, playlist in loaded:
+            try:
+                save_path = export_and_index(playlist_id=playlist_ids[link], playlist=playlist, export_format=export_format, export_index=export_index,
+                                             previous=previous_exports.get(link), raw=raw)
+                exported += 1
+                print(f"Saved to {save_path}")
+            except Exception as error:
+                failures.append((link, f"couldn't export: {type(error).__name__}: {error}"))
+
+    print(f"Exported {exported} of {len(links)} playlists" + (f", {len(unchanged)} unchanged" if unchanged else ""))
+    if failures:
+        print(f"{len(failures)} failed:")
+        for link, reason in failures:
+            print(f"    {link}: {reason}")
+
+    return failures
+
+"""
+    Works the same whether items is a list or a generator from stream_playlist. save_path overwrites that file instead of saving a new copy. raw adds the raw
+    data sheet to an xlsx.
+"""
+def export_playlist(playlist: dict, export_format: str, save_path: Path | None = None, raw: bool = False) -> Path:
+
+    if export_format == "csv":
+        return export_to_csv(playlist_name=playlist["name"], rows=iter_rows(playlist_raw=playlist["items"]), save_path=save_path)
+    elif export_format == "parquet":
+        return export_to_parquet(playlist_name=playlist["name"], tracks=playlist["items"], save_path=save_path)
+    elif export_format == "ndjson":
+        return export_to_ndjson(playlist_name=playlist["name"], tracks=playlist["items"], save_path=save_path)
+    else:
+        return export_tracks_to_excel(playlist_name=playlist["name"], tracks=playlist["items"], stages=xlsx_stages(raw=raw), save_path=save_path)
+
+"""
+    Exports the playlist over the top of its last export (if there was one) and notes the new export down in the index. The track ids and album data are picked up
+    as the tracks go past so this works for streamed playlists too. It's written to a .part file first and only swapped in once every track has been written, so
+    a streamed export that fails part way leaves the last good export where it was and nothing goes in the index. Only complete crawls get this far (a playlist
+    with pages missing comes back as an error, or raises IncompleteCrawlError when streamed), if a short one was indexed it'd be skipped as unchanged from then on.
+"""
+def export_and_index(playlist_id: str, playlist: dict, export_format: str, export_index: ExportIndex | None, previous: dict | None, raw: bool = False) -> Path:
+
+    track_ids = []
+    albums = {}
+    items = playlist["items"]
+    if export_index is not None:
+        items = remember_tracks(tracks=items, track_ids=track_ids, albums=albums)
+
+    save_path = Path(previous["path"]) if previous is not None else get_save_path(playlist_name=playlist["name"], extension=export_format)
+    part_path = save_path.with_suffix(f".part{save_path.suffix}")
+    try:
+        export_playlist(playlist={**playlist, "items": items}, export_format=export_format, save_path=part_path, raw=raw)
+    except BaseException:
+        part_path.unlink(missing_ok=True)
+        raise
+    os.replace(part_path, save_path)
+
+    if export_index is not None and playlist.get("snapshot_id") is not None:
+        export_index.put(playlist_id=playlist_id, export_format=index_format(export_format=export_format, raw=raw), snapshot_id=playlist["snapshot_id"], track_ids=track_ids, albums=albums,
+                         path=save_path)
+
+        if previous is not None:
+            old_track_ids = set(previous["track_ids"])
+            new_track_ids = set(track_ids)
+            print(f"{len(new_track_ids - old_track_ids)} tracks added and {len(old_track_ids - new_track_ids)} removed since the last export")
+
+    return save_path
+
+""" An xlsx with the raw data sheet is indexed apart from one without, so asking for the raw sheet isn't skipped as unchanged. """
+def index_format(export_format: str, raw: bool) -> str:
+
+    return f"{export_format}-raw" if raw else export_format
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -0,0 +1,243 @@
+from bisect import bisect_left
+from contextlib import contextmanager
+import threading
+import time
+from urllib.parse import urlsplit
+
+"""
+    Counters and histograms for seeing where an export's time goes. Everything records into the one METRICS registry below so the sync client, the async client,
+    the formatter and the exporter all add to the same numbers without having to be handed anything. render() writes them out in prometheus' text format for the
+    web app's /metrics route and summary() turns them into the table --profile prints. Nothing outside the standard library is needed.
+"""
+
+REQUEST_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+STAGE_BUCKETS = (0.001, 0.01, 0.1, 0.5, 1.0, 5.0, 10.0, 30.0, 60.0, 300.0)
+
+class Histogram:
+
+    def __init__(self, buckets: tuple[float, ...]):
+
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1) # the last one is +Inf
+        self.sum = 0.0
+        self.count = 0
+        self.max = 0.0
+
+    def observe(self, value: float) -> None:
+
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+        self.max = max(self.max, value)
+
+    """ Estimates a quantile from the buckets the same way prometheus' histogram_quantile does, by assuming values are spread evenly inside a bucket. """
+    def quantile(self, q: float) -> float:
+
+        if self.count == 0:
+            return 0.0
+
+        rank = q * self.count
+        seen = 0
+        for index, count in enumerate(self.counts):
+            if seen + count >= rank and count > 0:
+                lower = self.buckets[index - 1] if index > 0 else 0.0
+                upper = self.buckets[index] if index < len(self.buckets) else self.max
+                # the buckets are coarse so the estimate can land past the biggest value actually seen
+                return min(self.max, lower + (upper - lower) * (rank - seen) / count)
+            seen += count
+
+        return self.max
+
+"""
+    Histograms and counters are kept by name and then by labels, labels being a tuple of (label, value) pairs so they can be used as dict keys. Help text is
+    registered up front in METRIC_HELP so render() can describe every metric even before it's been recorded.
+"""
+class Metrics:
+
+    def __init__(self):
+
+        self.lock = threading.Lock()
+        self.histograms = {}
+        self.counters = {}
+        self.gauges = {}
+
+    def observe(self, name: str, value: float, buckets: tuple[float, ...] = REQUEST_BUCKETS, **labels) -> None:
+
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            series = self.histograms.setdefault(name, {})
+            if key not in series:
+                series[key] = Histogram(buckets=buckets)
+            series[key].observe(value)
+
+    def inc(self, name: str, amount: float = 1, **labels) -> None:
+
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            series = self.counters.setdefault(name, {})
+            series[key] = series.get(key, 0) + amount
+
+    def set_gauge(self, name: str, value: float, **labels) -> None:
+
+        with self.lock:
+            self.gauges.setdefault(name, {})[tuple(sorted(labels.items()))] = value
+
+    def counter(self, name: str, **labels) -> float:
+
+        with self.lock:
+            series = self.counters.get(name, {})
+            if labels:
+                return series.get(tuple(sorted(labels.items())), 0)
+            return sum(series.values())
+
+    def reset(self) -> None:
+
+        with self.lock:
+            self.histograms.clear()
+            self.counters.clear()
+            self.gauges.clear()
+
+    """ Times a request attempt, endpoint is worked out from the url so it doesn't end up with one series per playlist id. """
+    def observe_request(self, url: str, status: int, seconds: float) -> None:
+
+        endpoint = endpoint_name(url=url)
+        self.observe(name="spex_request_seconds", value=seconds, endpoint=endpoint)
+        self.inc(name="spex_requests_total", endpoint=endpoint, status=str(status))
+
+    """ Times a stage of an export (fetch, enrich, format or serialize). Stages can overlap when streaming, so they don't add up to the wall time. """
+    @contextmanager
+    def stage(self, name: str):
+
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name="spex_stage_seconds", value=time.perf_counter() - start, buckets=STAGE_BUCKETS, stage=name)
+
+    def render(self) -> str:
+
+        lines = []
+        with self.lock:
+
+            for name, series in sorted(self.counters.items()):
+                lines.extend(metric_header(name=name, metric_type="counter"))
+                for key, value in sorted(series.items()):
+                    lines.append(f"{name}{format_labels(labels=key)} {format_value(value=value)}")
+
+            for name, series in sorted(self.gauges.items()):
+                lines.extend(metric_header(name=name, metric_type="gauge"))
+                for key, value in sorted(series.items()):
+                    lines.append(f"{name}{format_labels(labels=key)} {format_value(value=value)}")
+
+            for name, series in sorted(self.histograms.items()):
+                lines.extend(metric_header(name=name, metric_type="histogram"))
+                for key, histogram in sorted(series.items()):
+                    cumulative = 0
+                    for bound, count in zip(histogram.buckets + (float("inf"),), histogram.counts):
+                        cumulative += count
+                        bucket_labels = key + (("le", format_value(value=bound)),)
+                        lines.append(f"{name}_bucket{format_labels(labels=bucket_labels)} {cumulative}")
+                    lines.append(f"{name}_sum{format_labels(labels=key)} {format_value(value=histogram.sum)}")
+                    lines.append(f"{name}_count{format_labels(labels=key)} {histogram.count}")
+
+        return "\n".join(lines) + "\n"
+
+    """ The numbers --profile prints, as plain text. """
+    def summary(self) -> str:
+
+        with self.lock:
+            requests = dict(self.histograms.get("spex_request_seconds", {}))
+            stages = dict(self.histograms.get("spex_stage_seconds", {}))
+            counters = {name: dict(series) for name, series in self.counters.items()}
+
+        lines = ["Requests"]
+        lines.append(f"    {'endpoint':<16}{'count':>8}{'mean ms':>10}{'p50 ms':>10}{'p95 ms':>10}{'max ms':>10}")
+        for key, histogram in sorted(requests.items()):
+            mean = histogram.sum / histogram.count if histogram.count else 0.0
+            lines.append(f"    {dict(key)['endpoint']:<16}{histogram.count:>8}{mean * 1000:>10.1f}{histogram.quantile(q=0.5) * 1000:>10.1f}"
+                         f"{histogram.quantile(q=0.95) * 1000:>10.1f}{histogram.max * 1000:>10.1f}")
+
+        statuses = {}
+        for key, value in counters.get("spex_requests_total", {}).items():
+            status = dict(key)["status"]
+            statuses[status] = statuses.get(status, 0) + value
+        lines.append("    statuses: " + (", ".join(f"{status}: {int(count)}" for status, count in sorted(statuses.items())) or "none"))
+
+        retries = {dict(key)["reason"]: value for key, value in counters.get("spex_retries_total", {}).items()}
+        lines.append("    retries: " + (", ".join(f"{reason}: {int(count)}" for reason, count in sorted(retries.items())) or "none"))
+        lines.append(f"    token refreshes: {int(sum(counters.get('spex_token_refreshes_total', {}).values()))}")
+        lines.append(f"    backoff: {sum(counters.get('spex_backoff_seconds_total', {}).values()):.2f}s")
+
+        hits = sum(counters.get("spex_album_cache_hits_total", {}).values())
+        misses = sum(counters.get("spex_album_cache_misses_total", {}).values())
+        if hits or misses:
+            lines.append(f"    album cache: {int(hits)} hits, {int(misses)} misses ({hits / (hits + misses):.0%})")
+
+        lines.append("Stages")
+        for key, histogram in sorted(stages.items()):
+            lines.append(f"    {dict(key)['stage']:<16}{histogram.sum:>8.3f}s over {histogram.count} calls")
+
+        return "\n".join(lines)
+
+METRIC_HELP = {
+    "spex_request_seconds": "Time taken by each request attempt to the spotify api",
+    "spex_requests_total": "Request attempts to the spotify api by endpoint and status",
+    "spex_retries_total": "Requests retried, by reason",
+    "spex_token_refreshes_total": "Access tokens fetched from the accounts service",
+    "spex_backoff_seconds_total": "Seconds spent waiting on the rate limiter and backing off",
+    "spex_album_cache_hits_total": "Albums found in the album cache",
+    "spex_album_cache_misses_total": "Albums that had to be requested",
+    "spex_stage_seconds": "Time spent in each stage of an export",
+    "spex_rate_limiter_concurrency": "Requests the rate limiter currently lets in flight",
+    "spex_rate_limiter_in_flight": "Requests currently in flight",
+    "spex_jobs": "Background export jobs the web app knows about, by status",
+    "spex_jobs_total": "Background export jobs that have finished, by status",
+    "spex_jobs_rejected_total": "Background export jobs turned away because the queue was full",
+    "spex_render_cache_hits_total": "Exports served from the render cache, by tier",
+    "spex_render_cache_misses_total": "Exports that weren't in the render cache and had to be rendered",
+    "spex_not_modified_total": "Export requests answered with 304 Not Modified",
+    "spex_shared_renders_total": "Exports crawled and rendered for the web app, by route, each one shared by every request that asked for it meanwhile",
+    "spex_coalesced_requests_total": "Export requests that joined a render already in flight instead of starting their own, by route",
+    "spex_shared_renders_in_flight": "Exports currently being rendered by the web app",
+    "spex_cassette_hits_total": "Requests answered from a replayed cassette",
+    "spex_cassette_misses_total": "Requests a replayed cassette had no recording of",
+    "spex_checkpoint_pages_resumed_total": "Playlist pages read back from a checkpoint instead of being requested again",
+    "spex_checkpoint_albums_resumed_total": "Albums read back from a checkpoint instead of being requested again"
+}
+
+def metric_header(name: str, metric_type: str) -> list[str]:
+
+    return [f"# HELP {name} {METRIC_HELP.get(name, name)}", f"# TYPE {name} {metric_type}"]
+
+def format_labels(labels: tuple) -> str:
+
+    if not labels:
+        return ""
+
+    return "{" + ",".join(label + '="' + escape_label(value=str(value)) + '"' for label, value in labels) + "}"
+
+def escape_label(value: str) -> str:
+
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+def format_value(value: float) -> str:
+
+    if value == float("inf"):
+        return "+Inf"
+
+    return str(int(value)) if float(value).is_integer() else repr(float(value))
+
+""" Turns a request url into a short endpoint name (playlist, playlist_tracks, albums, token) so ids don't end up in the labels. """
+def endpoint_name(url: str) -> str:
+
+    path = urlsplit(url).path.rstrip("/").split("/")
+    if "token" in path:
+        return "token"
+    if "playlists" in path:
+        return "playlist_tracks" if path[-1] == "tracks" else "playlist"
+    if "albums" in path:
+        return "albums"
+
+    return path[-1] or "other"
+
+METRICS = Metrics()
@@ -0,0 +1,296 @@
+import asyncio
+from contextlib import asynccontextmanager, contextmanager
+from functools import partial
+import os
+from pathlib import Path
+import random
+import threading
+import time
+
+from spex.metrics import METRICS
+from spex.sqlite_store import open_database
+
+RETRY_STATUSES = {500, 502, 503, 504}
+
+"""
+    Keeps us under spotify's rate limit. Requests take a token from a bucket that refills at rate tokens a second and holds at most burst tokens, so short bursts
+    go straight through and anything faster than rate gets spaced out. When spotify does send a 429 everyone waits out its Retry-After (plus a bit of jitter so
+    the workers don't all come back at the same instant) and the number of requests allowed in flight is halved. Each run of successful requests lets it climb
+    back up by one until it's back at max_concurrency, so one throttle early on doesn't slow down the rest of a long export.
+"""
+class RateLimiter:
+
+    def __init__(self, rate: float = 20.0, burst: int = 20, max_retries: int = 5, max_concurrency: int = 8, min_concurrency: int = 1,
+                 base_backoff: float = 0.5, max_backoff: float = 30.0, jitter: float = 0.5):
+
+        self.rate = rate
+        self.burst = burst
+        self.max_retries = max_retries
+        self.max_concurrency = max_concurrency
+        self.min_concurrency = min_concurrency
+        self.base_backoff = base_backoff
+        self.max_backoff = max_backoff
+        self.jitter = jitter
+
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+        self.concurrency = max_concurrency
+        self.in_flight = 0
+        self.successes = 0
+        self.last_cut = 0.0
+
+        self.throttles = 0
+        self.retries = 0
+
+        self.lock = threading.Lock()
+        self.condition = threading.Condition(self.lock)
+        # only ever held for a counter, SharedRateLimiter's thread holds self.lock while it waits on the database and the event loop mustn't wait behind that
+        self.retries_lock = threading.Lock()
+        self.async_condition = None # made on first use so it belongs to the running event loop
+
+    """ The bucket and the throttle state, which for this limiter are just its own attributes behind the lock. """
+    def state(self):
+
+        return self.lock
+
+    def clock(self) -> float:
+
+        return time.monotonic()
+
+    """ Nothing to let go of here, SharedRateLimiter has its database to close. """
+    def close(self) -> None:
+
+        pass
+
+    """
+        Takes a token and returns how long the caller has to wait before it's allowed to send. The bucket is allowed to go negative, which means the token has
+        been borrowed from the future and the wait covers the time it takes to refill.
+    """
+    def reserve(self) -> float:
+
+        with self.state():
+            now = self.clock()
+            self.tokens = min(self.burst, self.tokens + max(0.0, now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= 1
+
+            return max(0.0, -self.tokens / self.rate, self.blocked_until - now)
+
+    def acquire(self) -> None:
+
+        wait = self.reserve()
+        if wait > 0:
+            METRICS.inc(name="spex_backoff_seconds_total", amount=wait, reason="rate_limit")
+            time.sleep(wait)
+
+    """ reserve for the event loop. Taking a token here never waits on anything, SharedRateLimiter moves it onto a thread. """
+    async def reserve_async(self) -> float:
+
+        return self.reserve()
+
+    async def acquire_async(self) -> None:
+
+        wait = await self.reserve_async()
+        if wait > 0:
+            METRICS.inc(name="spex_backoff_seconds_total", amount=wait, reason="rate_limit")
+            await asyncio.sleep(wait)
+
+    """ Holds one of the concurrency slots while a request is in flight. """
+    @contextmanager
+    def slot(self):
+
+        with self.condition:
+            while self.in_flight >= self.concurrency:
+                self.condition.wait()
+            self.in_flight += 1
+
+        try:
+            yield
+        finally:
+            with self.condition:
+                self.in_flight -= 1
+                self.condition.notify_all()
+
+    @asynccontextmanager
+    async def slot_async(self):
+
+        if self.async_condition is None:
+            self.async_condition = asyncio.Condition()
+
+        async with self.async_condition:
+            await self.async_condition.wait_for(lambda: self.in_flight < self.concurrency)
+            self.in_flight += 1
+
+        try:
+            yield
+        finally:
+            async with self.async_condition:
+                self.in_flight -= 1
+                self.async_condition.notify_all()
+
+    """ Retry-After plus jitter if spotify sent one, otherwise exponential backoff with jitter capped at max_backoff. """
+    def backoff_delay(self, attempt: int, retry_after: float | None = None) -> float:
+
+        if retry_after is not None:
+            return retry_after + random.uniform(0, self.jitter)
+
+        return min(self.max_backoff, self.base_backoff * 2 ** attempt) * random.uniform(0.5, 1.0)
+
+    """
+        Called on a 429. Blocks every request until the backoff is over and halves the concurrency, a burst of 429s that all come from the same overload only
+        counts as one cut. Returns the delay so the caller can log it.
+    """
+    def on_throttled(self, attempt: int, retry_after: float | None = None) -> float:
+
+        delay = self.backoff_delay(attempt=attempt, retry_after=retry_after)
+        with self.state():
+            now = self.clock()
+            self.throttles += 1
+            self.blocked_until = max(self.blocked_until, now + delay)
+            self.successes = 0
+
+            if now - self.last_cut > delay:
+                self.concurrency = max(self.min_concurrency, self.concurrency // 2)
+                self.last_cut = now
+
+        with self.retries_lock:
+            self.retries += 1
+        # the wait itself shows up as rate_limit backoff when the next attempt calls acquire
+        METRICS.inc(name="spex_retries_total", reason="throttled")
+
+        return delay
+
+    async def on_throttled_async(self, attempt: int, retry_after: float | None = None) -> float:
+
+        return self.on_throttled(attempt=attempt, retry_after=retry_after)
+
+    """ Called on a 5xx. Only the request that failed backs off, it's not a sign we're going too fast so everyone else carries on. """
+    def on_server_error(self, attempt: int) -> float:
+
+        with self.retries_lock:
+            self.retries += 1
+
+        delay = self.backoff_delay(attempt=attempt)
+        METRICS.inc(name="spex_retries_total", reason="server_error")
+        METRICS.inc(name="spex_backoff_seconds_total", amount=delay, reason="server_error")
+
+        return delay
+
+    """ Every concurrency * 4 successes in a row lets one more request in flight. The slot being released straight after wakes up anyone waiting for the space. """
+    def on_success(self) -> None:
+
+        with self.state():
+            self.successes += 1
+            if self.concurrency < self.max_concurrency and self.successes >= self.concurrency * 4:
+                self.concurrency += 1
+                self.successes = 0
+
+    async def on_success_async(self) -> None:
+
+        self.on_success()
+
+"""
+    A limiter whose bucket and throttle state are shared by every process that opens the same path, for the web server's workers. Each worker keeping its own
+    bucket would let n workers send n times the rate between them, and a 429 one of them got would mean nothing to the rest. Here the tokens, the Retry-After
+    block and the concurrency cut all live in one row of a SQLite file that's read and written back in a single write transaction whenever they change, so a
+    throttle seen by any worker holds back all of them. Times are wall clock since a monotonic clock isn't comparable between processes.
+
+    Requests in flight are still counted per process. The concurrency each worker is held to is the shared one, so n workers can have up to n times that in
+    flight between them, it's the rate that's global. The database can be kept waiting by another worker's transaction, so the async versions run it on a thread
+    rather than on the event loop. Once the concurrency is back at max_concurrency a success has nothing left to change, so it doesn't touch the database at all.
+"""
+class SharedRateLimiter(RateLimiter):
+
+    COLUMNS = ("tokens", "updated", "blocked_until", "concurrency", "successes", "last_cut")
+
+    def __init__(self, path: str | Path, **kwargs):
+
+        super().__init__(**kwargs)
+        self.path = Path(path)
+
+        # transactions are started by hand so the read and the write back happen under one lock on the file
+        self.connection = open_database(path=self.path, isolation_level=None, timeout=30, schema=(
+            "CREATE TABLE IF NOT EXISTS rate_limiter (id INTEGER PRIMARY KEY CHECK (id = 0), tokens REAL NOT NULL, updated REAL NOT NULL, "
+            "blocked_until REAL NOT NULL, concurrency INTEGER NOT NULL, successes INTEGER NOT NULL, last_cut REAL NOT NULL)",
+        ))
+        # whoever gets here first sets it up, anyone after picks up the state as it is (a block from a 429 a moment ago still counts)
+        self.connection.execute(
+            "INSERT OR IGNORE INTO rate_limiter (id, tokens, updated, blocked_until, concurrency, successes, last_cut) VALUES (0, ?, ?, 0, ?, 0, 0)",
+            (float(self.burst), self.clock(), self.max_concurrency)
+        )
+
+    """ Loads the shared row into the attributes RateLimiter works on and writes them back once it's done, all inside one write transaction. """
+    @contextmanager
+    def state(self):
+
+        with self.lock:
+            self.connection.execute("BEGIN IMMEDIATE")
+            try:
+                row = self.connection.execute(f"SELECT {', '.join(self.COLUMNS)} FROM rate_limiter WHERE id = 0").fetchone()
+                self.tokens, self.updated, self.blocked_until, self.concurrency, self.successes, self.last_cut = row
+                # another process's settings could allow more than ours
+                self.concurrency = min(self.concurrency, self.max_concurrency)
+                yield
+                self.connection.execute(
+                    f"UPDATE rate_limiter SET {', '.join(column + ' = ?' for column in self.COLUMNS)} WHERE id = 0",
+                    tuple(getattr(self, column) for column in self.COLUMNS)
+                )
+                self.connection.execute("COMMIT")
+            except BaseException:
+                self.connection.execute("ROLLBACK")
+                raise
+
+    def clock(self) -> float:
+
+        return time.time()
+
+    def on_success(self) -> None:
+
+        # self.concurrency is as of the last reserve, near enough to tell whether there's anything to climb back to
+        if self.concurrency < self.max_concurrency:
+            super().on_success()
+
+    async def reserve_async(self) -> float:
+
+        return await asyncio.to_thread(self.reserve)
+
+    async def on_throttled_async(self, attempt: int, retry_after: float | None = None) -> float:
+
+        return await asyncio.to_thread(self.on_throttled, attempt=attempt, retry_after=retry_after)
+
+    async def on_success_async(self) -> None:
+
+        if self.concurrency < self.max_concurrency:
+            await asyncio.to_thread(self.on_success)
+
+    def close(self) -> None:
+
+        with self.lock:
+            self.connection.close()
+
+""" Reads the Retry-After header in seconds. Spotify always sends seconds, anything else falls back to the normal backoff. """
+def get_retry_after(headers) -> float | None:
+
+    retry_after = headers.get("Retry-After")
+    try:
+        return float(retry_after) if retry_after is not None else None
+    except ValueError:
+        return None
+
+"""
+    Makes a limiter using the settings from the environment. SPEX_RATE_LIMIT is requests per second, SPEX_RATE_BURST is how many can go at once before that kicks in,
+    SPEX_MAX_RETRIES is how many times a throttled or 5xx request is retried and SPEX_MAX_CONCURRENCY is the most requests in flight at once. If SPEX_SHARED_STATE
+    is set to a folder the limiter is shared with every other process using that folder (see SharedRateLimiter), the rate is then the total for all of them.
+"""
+def open_rate_limiter(max_concurrency: int | None = None) -> RateLimiter:
+
+    shared_state = os.getenv("SPEX_SHARED_STATE")
+    limiter = partial(SharedRateLimiter, path=Path(shared_state) / "rate_limiter.sqlite3") if shared_state else RateLimiter
+
+    return limiter(
+        rate=float(os.getenv("SPEX_RATE_LIMIT", 20)),
+        burst=int(os.getenv("SPEX_RATE_BURST", 20)),
+        max_retries=int(os.getenv("SPEX_MAX_RETRIES", 5)),
+        max_concurrency=max_concurrency if max_concurrency is not None else int(os.getenv("SPEX_MAX_CONCURRENCY", 8))
+    )
@@ -0,0 +1,81 @@
+from dataclasses import dataclass
+import sys
+
+"""
+    What a track looks like once it's been read out of spotify's response. These used to be a dict of dicts (trackRequest and albumRequest) holding spotify's whole
+    artist objects, which on a big playlist or a batch took up far more memory than the tracks themselves. Slotted records don't carry a dict around with them, artists
+    are kept as just their names and anything that repeats from track to track (artist names, album titles, dates) is interned so every track shares the one string.
+    to_dict gives back the old nested shape for anything that still wants json (the web app's /playlists/raw and the export index).
+"""
+
+""" Only the album fields the exports use. Tracks on the same album all point at the same Album, which is why it's frozen. """
+@dataclass(frozen=True, slots=True)
+class Album:
+
+    upc: str | None
+    label: str | None
+    copy_rights: tuple[tuple[str, str], ...] | str # (type, text) pairs, or UNAVAILABLE
+
+    def to_dict(self) -> dict:
+
+        copy_rights = self.copy_rights
+        if not isinstance(copy_rights, str):
+            copy_rights = [{"text": text, "type": copy_right_type} for copy_right_type, text in copy_rights]
+
+        return {"upc": self.upc, "copyRights": copy_rights, "label": self.label}
+
+    @classmethod
+    def from_dict(cls, album_dict: dict) -> "Album":
+
+        copy_rights = album_dict["copyRights"]
+        if not isinstance(copy_rights, str):
+            copy_rights = tuple((copy_right["type"], copy_right["text"]) for copy_right in copy_rights)
+
+        return cls(upc=album_dict["upc"], label=album_dict["label"], copy_rights=copy_rights)
+
+UNAVAILABLE_ALBUM = Album(upc="UNAVAILABLE", label="UNAVAILABLE", copy_rights="UNAVAILABLE")
+
+""" album is None until the track has been enriched, after that it's the tracks Album (or UNAVAILABLE_ALBUM if spotify couldn't give us one). """
+@dataclass(slots=True)
+class Track:
+
+    track_id: str | None
+    title: str
+    isrc: str | None
+    duration_ms: int
+    release_artists: tuple[str, ...]
+    featured_artists: tuple[str, ...]
+    album_id: str | None
+    album_title: str
+    album_type: str | None
+    release_date: str | None
+    release_date_precision: str | None
+    album: Album | None = None
+
+    def to_dict(self) -> dict:
+
+        return {
+            "trackRequest": {
+                "releaseArtists": [{"name": name} for name in self.release_artists],
+                "featuredArtists": [{"name": name} for name in self.featured_artists],
+                "trackTitle": self.title,
+                "trackId": self.track_id,
+                "trackDuration": self.duration_ms,
+                "isrc": self.isrc,
+                "albumTitle": self.album_title,
+                "albumId": self.album_id,
+                "albumType": self.album_type,
+                "releaseDate": self.release_date,
+                "releaseDatePrecision": self.release_date_precision
+            },
+            "albumRequest": self.album.to_dict() if self.album is not None else {}
+        }
+
+""" sys.intern that lets None through, spotify leaves some fields empty. """
+def intern(value: str | None) -> str | None:
+
+    return sys.intern(value) if value is not None else None
+
+def artist_names(artists: list[dict]) -> tuple[str, ...]:
+
+    return tuple(sys.intern(artist["name"]) for artist in artists)
@@ -0,0 +1,21 @@
+from pathlib import Path
+import sqlite3
+
+"""
+    The setup every one of spex's sqlite files shares (the album cache, the export index, the crawl checkpoints and the shared rate limiter). The folder is made
+    if it isn't there yet and the database is put in WAL mode so readers don't wait on a writer, which matters once more than one process has the file open.
+
+    The connection is opened with check_same_thread=False because none of them stay on one thread: the sync client and batches crawl on a thread pool and the
+    async client hands its lookups to asyncio.to_thread. sqlite3 connections aren't safe to use from two threads at once, so whoever owns the connection keeps a
+    threading.Lock and holds it around every use. schema is run once the connection is open, it should only hold CREATE ... IF NOT EXISTS statements.
+"""
+def open_database(path: Path, schema: tuple[str, ...] = (), **connect_args) -> sqlite3.Connection:
+
+    path.parent.mkdir(parents=True, exist_ok=True)
+    connection = sqlite3.connect(path, check_same_thread=False, **connect_args)
+    connection.execute("PRAGMA journal_mode=WAL")
+    for statement in schema:
+        connection.execute(statement)
+    connection.commit()
+
+    return connection
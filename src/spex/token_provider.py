@@ -0,0 +1,184 @@
+import asyncio
+import base64
+from contextlib import nullcontext
+import json
+import os
+from pathlib import Path
+import threading
+import time
+
+import requests
+
+from spex.atomic_file import atomic_write
+from spex.file_lock import file_lock
+from spex.file_lock import file_lock_async
+from spex.metrics import METRICS
+
+TOKEN_URL = "https://accounts.spotify.com/api/token"
+
+""" Builds the headers and body for the client credentials flow from the spotify web api documentation. """
+def token_request(client_id: str, client_secret: str) -> tuple[dict, dict]:
+
+    auth_string = client_id + ":" + client_secret
+    auth_bytes = auth_string.encode("utf-8")
+    auth_base64 = str(base64.b64encode(auth_bytes), "utf-8")
+
+    auth_headers = {
+        "Authorization": "Basic " + auth_base64,
+        "Content-Type": "application/x-www-form-urlencoded"
+    }
+    auth_body = {"grant_type": "client_credentials"}
+
+    return (auth_headers, auth_body)
+
+"""
+    Hands out access tokens and keeps them until shortly before they expire. Spotify tells us how long a token lasts with expires_in (an hour at the moment), so
+    instead of waiting to be hit with a 401 we swap the token out refresh_margin seconds early. Only one refresh happens at a time, anyone else who wants a token
+    while it's refreshing waits for that refresh rather than starting their own. If cache_path is given the token is also saved there so the next run (or another
+    process) can pick it up instead of doing the handshake again. Processes sharing a cache_path (the web server's workers) also share the refresh, it's done
+    under a lock on the file and whoever gets the lock second finds the new token already saved. token_url is only changed to point at a stand in server, like
+    the one the benchmarks use.
+"""
+class TokenProvider:
+
+    def __init__(self, client_id: str, client_secret: str, cache_path: str | Path | None = None, refresh_margin: float = 60.0,
+                 token_url: str = TOKEN_URL):
+
+        self.client_id = client_id
+        self.client_secret = client_secret
+        self.cache_path = Path(cache_path) if cache_path is not None else None
+        self.refresh_margin = refresh_margin
+        self.token_url = token_url
+
+        self.access_token = None
+        self.expires_at = 0.0
+        self.refreshes = 0
+        self.rejected_token = None # the last token spotify turned down, so it isn't read back out of the cache file
+
+        self.lock = threading.Lock()
+        self.async_lock = None # made on first use so it belongs to the running event loop
+
+        self.load_cached_token()
+
+    def is_fresh(self) -> bool:
+
+        return self.access_token is not None and time.time() < self.expires_at - self.refresh_margin
+
+    """ Returns a token that is good for at least refresh_margin more seconds, doing the handshake first if it has to. Pass the client's session to reuse its connections. """
+    def get_token(self, session: requests.Session | None = None) -> str:
+
+        if self.is_fresh():
+            return self.access_token
+
+        with self.lock:
+            # someone else may have refreshed while we were waiting on the lock
+            if not self.is_fresh():
+                with self.cache_lock():
+                    # or another process sharing the cache file may have
+                    self.load_cached_token()
+                    if not self.is_fresh():
+                        auth_headers, auth_body = token_request(client_id=self.client_id, client_secret=self.client_secret)
+                        start = time.perf_counter()
+                        response = (session or requests).post(url=self.token_url, headers=auth_headers, data=auth_body)
+                        METRICS.observe_request(url=self.token_url, status=response.status_code, seconds=time.perf_counter() - start)
+                        response.raise_for_status()
+                        self.store_token(response=response.json())
+
+            return self.access_token
+
+    """ asyncio version of get_token for the web app, the handshake goes through the apps pooled http client. """
+    async def get_token_async(self, http) -> str:
+
+        if self.is_fresh():
+            return self.access_token
+
+        if self.async_lock is None:
+            self.async_lock = asyncio.Lock()
+
+        async with self.async_lock:
+            if not self.is_fresh():
+                async with self.cache_lock_async():
+                    self.load_cached_token()
+                    if not self.is_fresh():
+                        auth_headers, auth_body = token_request(client_id=self.client_id, client_secret=self.client_secret)
+                        start = time.perf_counter()
+                        response = await http.post(url=self.token_url, headers=auth_headers, data=auth_body)
+                        METRICS.observe_request(url=self.token_url, status=response.status_code, seconds=time.perf_counter() - start)
+                        response.raise_for_status()
+                        self.store_token(response=response.json())
+
+            return self.access_token
+
+    """ Locks the cache file while a refresh is worked out, there's nothing to lock if the token isn't cached. """
+    def cache_lock(self):
+
+        return file_lock(path=self.cache_path.with_suffix(".lock")) if self.cache_path is not None else nullcontext()
+
+    def cache_lock_async(self):
+
+        return file_lock_async(path=self.cache_path.with_suffix(".lock")) if self.cache_path is not None else nullcontext()
+
+    """
+        Called after a 401. The token is only thrown away if it's still the one that failed, so when lots of requests get a 401 at the same time only the first
+        one causes a refresh and the rest just pick up the new token.
+    """
+    def invalidate(self, access_token: str | None) -> None:
+
+        with self.lock:
+            if access_token == self.access_token:
+                self.access_token = None
+                self.expires_at = 0.0
+                self.rejected_token = access_token
+
+    def store_token(self, response: dict) -> None:
+
+        self.access_token = response["access_token"]
+        self.expires_at = time.time() + response.get("expires_in", 3600)
+        self.refreshes += 1
+        METRICS.inc(name="spex_token_refreshes_total")
+        self.save_cached_token()
+
+    def load_cached_token(self) -> None:
+
+        if self.cache_path is None or not self.cache_path.is_file():
+            return
+
+        try:
+            cached = json.loads(self.cache_path.read_text())
+        except (OSError, ValueError):
+            return
+
+        # the cache file could have been written for a different app, or still hold the token that just got a 401
+        if cached.get("client_id") == self.client_id and cached.get("access_token") != self.rejected_token:
+            self.access_token = cached["access_token"]
+            self.expires_at = cached["expires_at"]
+
+    """ Written to a temp file and swapped in so another process never reads half a file. Only the owner can read it since it holds a live token. """
+    def save_cached_token(self) -> None:
+
+        if self.cache_path is None:
+            return
+
+        with atomic_write(path=self.cache_path, permissions=0o600) as file:
+            file.write(json.dumps({"client_id": self.client_id, "access_token": self.access_token, "expires_at": self.expires_at}).encode())
+
+"""
+    Makes a provider using the settings from the environment. The token is cached on disk in SPEX_CACHE_DIR unless SPEX_TOKEN_CACHE=0, SPEX_TOKEN_REFRESH_MARGIN
+    sets how many seconds before expiry the token gets swapped and SPEX_TOKEN_URL swaps spotify's accounts server for another one. With SPEX_SHARED_STATE set the
+    token is kept in that folder instead (even with SPEX_TOKEN_CACHE=0), that's how the web server's workers end up on one token.
+"""
+def open_token_provider(client_id: str, client_secret: str) -> TokenProvider:
+
+    cache_path = None
+    if os.getenv("SPEX_SHARED_STATE"):
+        cache_path = Path(os.getenv("SPEX_SHARED_STATE")) / "token.json"
+    elif os.getenv("SPEX_TOKEN_CACHE", "1") != "0":
+        cache_path = Path(os.getenv("SPEX_CACHE_DIR", Path.home() / ".cache" / "spex")) / "token.json"
+
+    return TokenProvider(
+        client_id=client_id,
+        client_secret=client_secret,
+        cache_path=cache_path,
+        refresh_margin=float(os.getenv("SPEX_TOKEN_REFRESH_MARGIN", 60)),
+        token_url=os.getenv("SPEX_TOKEN_URL", TOKEN_URL)
+    )
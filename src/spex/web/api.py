@@ -1,72 +1,462 @@
-from io import BytesIO
-from io import StringIO
+from contextlib import asynccontextmanager
+from functools import partial
 import os
 import re
+from tempfile import SpooledTemporaryFile
+from typing import AsyncIterator, Awaitable, BinaryIO, Callable
 
 from dotenv import load_dotenv
 from fastapi import FastAPI
+from fastapi import HTTPException
+from fastapi import Request
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import FileResponse
+from fastapi.responses import JSONResponse
+from fastapi.responses import PlainTextResponse
+from fastapi.responses import Response
 from fastapi.responses import StreamingResponse
-import pandas as pd
 
-from spex.api_client import get_base_and_headers
-from spex.api_client import get_playlist
-from spex.formatter import playlist_frame_formatter
+from spex.album_cache import open_album_cache
+from spex.api_client import BASE_URL
+from spex.api_client import IncompleteCrawlError
+from spex.async_client import AsyncClientDetails
+from spex.async_client import create_http_client
+from spex.async_client import get_playlist
+from spex.async_client import get_snapshot
+from spex.async_client import set_client
+from spex.async_client import stream_playlist
+from spex.cassette import open_cassette
+from spex.exporter import csv_text
+from spex.exporter import ndjson_line
+from spex.exporter import write_parquet
+from spex.exporter import xlsx_stages
+from spex.exporter import XlsxWriter
+from spex.formatter import format_row
+from spex.metrics import METRICS
+from spex.rate_limiter import open_rate_limiter
+from spex.records import Track
+from spex.token_provider import open_token_provider
+from spex.web.jobs import Job
+from spex.web.jobs import open_job_manager
+from spex.web.render_cache import etag_matches
+from spex.web.render_cache import make_etag
+from spex.web.render_cache import open_render_cache
+from spex.web.single_flight import SharedExport
+from spex.web.single_flight import SingleFlight
 
-app = FastAPI()
-
-def get_playlist_dict(playlist_id: str) -> dict:
+""" One pooled http client and one token for the life of the app, every handler borrows its connections and token instead of making new ones. """
+@asynccontextmanager
+async def lifespan(app: FastAPI):
 
     load_dotenv()
-    client_id = os.getenv("CLIENT_ID")
-    client_secret = os.getenv("CLIENT_SECRET")
-    base_url, headers = get_base_and_headers(client_id=client_id, client_secret=client_secret)
+    app.state.client_id = os.getenv("CLIENT_ID")
+    app.state.client_secret = os.getenv("CLIENT_SECRET")
+    app.state.base_url = os.getenv("SPEX_API_URL", BASE_URL)
+    app.state.http = create_http_client(max_connections=int(os.getenv("SPEX_POOL_SIZE", 20)), connect_retries=int(os.getenv("SPEX_CONNECT_RETRIES", 3)),
+                                        cassette=open_cassette())
+    app.state.album_cache = open_album_cache()
+    app.state.token_provider = open_token_provider(client_id=app.state.client_id, client_secret=app.state.client_secret)
+    # shared by every request so the whole app stays inside one rate budget, and with every worker when there's more than one (see server.py)
+    app.state.rate_limiter = open_rate_limiter()
+    app.state.jobs = open_job_manager()
+    app.state.render_cache = open_render_cache()
+    # concurrent requests for the same export share one crawl and render
+    app.state.single_flight = SingleFlight()
+    yield
+    await app.state.single_flight.close()
+    await app.state.jobs.close()
+    await app.state.http.aclose()
+    app.state.rate_limiter.close()
+    if app.state.album_cache is not None:
+        app.state.album_cache.close()
+
+app = FastAPI(lifespan=lifespan)
+
+async def get_client() -> AsyncClientDetails:
+
+    return await set_client(http=app.state.http, client_id=app.state.client_id, client_secret=app.state.client_secret, album_cache=app.state.album_cache,
+                            token_provider=app.state.token_provider, rate_limiter=app.state.rate_limiter, base_url=app.state.base_url)
+
+""" Raises the spotify error as an HTTPException if the playlist couldn't be loaded so the handlers only have to deal with the happy path. """
+async def get_playlist_dict(playlist_id: str) -> dict:
+
+    playlist, client = await get_playlist(client=await get_client(), playlist_id=playlist_id)
+    if playlist.data is None:
+        raise HTTPException(status_code=playlist.status or 502, detail=playlist.error)
+
+    return playlist.data
+
+"""
+    Same as get_playlist_dict but items is an async generator, only the first request has happened by the time this returns. If pages went missing the items
+    raise an HTTPException once they run out, the same one get_playlist_dict would have raised.
+"""
+async def stream_playlist_dict(playlist_id: str) -> dict:
+
+    playlist, client = await stream_playlist(client=await get_client(), playlist_id=playlist_id)
+    if playlist.data is None:
+        raise HTTPException(status_code=playlist.status or 502, detail=playlist.error)
+
+    return {**playlist.data, "items": complete_tracks(tracks=playlist.data["items"])}
+
+async def complete_tracks(tracks: AsyncIterator[Track]) -> AsyncIterator[Track]:
+
+    try:
+        async for track in tracks:
+            yield track
+    except IncompleteCrawlError as error:
+        raise HTTPException(status_code=error.result.status or 502, detail=error.result.error)
+
+MEDIA_TYPES = {
+    "csv": "text/csv",
+    "xlsx": "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+    "parquet": "application/vnd.apache.parquet",
+    "ndjson": "application/x-ndjson"
+}
+
+""" What every export response carries. no-cache makes clients check back with If-None-Match each time, which is cheap when nothing has changed. """
+def export_headers(name: str, export_format: str, etag: str | None) -> dict:
+
+    headers = {"Content-Disposition": f"attachment; filename={name}.{export_format}", "Cache-Control": "no-cache"}
+    if etag is not None:
+        headers["ETag"] = etag
+
+    return headers
+
+"""
+    Answers from the render cache when it can. Returns a 304 if the client's copy is still current, the cached export if there is one, or None if the export has
+    to be rendered. Costs the one small snapshot request, and not even that when there's no cache and the client didn't send If-None-Match. variant is what tells
+    different renders of the same format apart (the xlsx with and without its raw sheet).
+"""
+async def cached_response(request: Request, playlist_id: str, export_format: str, variant: str) -> Response | None:
+
+    if_none_match = request.headers.get("if-none-match")
+    render_cache = app.state.render_cache
+    if render_cache is None and not if_none_match:
+        return None
+
+    snapshot, client = await get_snapshot(client=await get_client(), playlist_id=playlist_id)
+    # errors are left for the full export to raise, that way they're reported the same however the request came in
+    if snapshot.data is None or snapshot.data.get("snapshot_id") is None:
+        return None
+
+    snapshot_id = snapshot.data["snapshot_id"]
+    etag = make_etag(snapshot_id=snapshot_id, variant=variant)
+    if etag_matches(if_none_match=if_none_match, etag=etag):
+        METRICS.inc(name="spex_not_modified_total")
+        return Response(status_code=304, headers={"ETag": etag, "Cache-Control": "no-cache"})
+
+    cached = await render_cache.get_async(key=(playlist_id, snapshot_id, variant)) if render_cache is not None else None
+    if cached is None:
+        return None
+
+    name, body = cached
+    return Response(content=body, media_type=MEDIA_TYPES[export_format], headers=export_headers(name=name, export_format=export_format, etag=etag))
+
+""" The render cache key and ETag for a playlist that's just been loaded, both None if spotify didn't give us a snapshot_id. """
+def render_key(playlist_id: str, playlist: dict, variant: str) -> tuple[tuple[str, str, str] | None, str | None]:
+
+    snapshot_id = playlist.get("snapshot_id")
+    if snapshot_id is None:
+        return (None, None)
 
-    playlist = get_playlist(base_url=base_url, headers=headers, playlist_id=playlist_id)
+    return ((playlist_id, snapshot_id, variant), make_etag(snapshot_id=snapshot_id, variant=variant))
 
-    return playlist
+"""
+    Passes chunks on as they're sent and puts the whole export in the render cache once the last one has gone, unless it grew too big to keep. Once it has, what
+    was kept so far is let go of straight away rather than held until the end.
+"""
+async def cache_chunks(chunks: AsyncIterator[str], key: tuple[str, str, str] | None, name: str) -> AsyncIterator[bytes]:
+
+    render_cache = app.state.render_cache
+    keep = render_cache is not None and key is not None
+    body = []
+    size = 0
+
+    async for chunk in chunks:
+        data = chunk.encode("utf-8")
+        if keep:
+            size += len(data)
+            keep = render_cache.fits(size=size)
+            if keep:
+                body.append(data)
+            else:
+                body.clear()
+        yield data
+
+    # a render that's cancelled or breaks part way never gets here (a crawl with pages missing raises once the tracks run out), so half an export is never cached
+    if keep:
+        await render_cache.put_async(key=key, name=name, body=b"".join(body))
+
+"""
+    Hands a finished file to everyone waiting on the render, putting it in the render cache as well if it's small enough to keep. The renders only get here once
+    every track is in, a crawl that came up short has raised by then.
+"""
+async def send_file(shared: SharedExport, file: BinaryIO, key: tuple[str, str, str] | None, name: str, chunk_size: int = 64 * 1024) -> None:
+
+    render_cache = app.state.render_cache
+    size = file.tell()
+    file.seek(0)
+
+    with file:
+        if render_cache is not None and key is not None and render_cache.fits(size=size):
+            body = await run_in_threadpool(file.read)
+            await render_cache.put_async(key=key, name=name, body=body)
+            await shared.send(body)
+            return
+
+        while chunk := await run_in_threadpool(file.read, chunk_size):
+            await shared.send(chunk)
+
+"""
+    Joins the render already going for key or starts one, then waits until it's ready to answer. Anything that stopped the playlist loading (a 404 from spotify
+    say) comes out of here as an HTTPException, for every request that was waiting on it. A request that gives up before then leaves the render straight away.
+"""
+async def join_render(key: tuple[str, str], render: Callable[[SharedExport], Awaitable[None]]) -> SharedExport:
+
+    shared = app.state.single_flight.join(key=key, render=render)
+    try:
+        await shared.wait()
+    except BaseException:
+        shared.leave()
+        raise
+
+    return shared
+
+""" Sends the shared render's export, from the first byte, as it arrives. Reading it is what leaves the render once the response is done. """
+def shared_response(shared: SharedExport, export_format: str) -> StreamingResponse:
+
+    name, etag = shared.result.result()
+
+    return StreamingResponse(content=shared.read(), headers=export_headers(name=name, export_format=export_format, etag=etag), media_type=MEDIA_TYPES[export_format])
+
+""" Turns tracks into csv text as they arrive, sent on in chunks of chunk_size rows so we're not flushing a tiny write for every track. """
+async def csv_chunks(tracks: AsyncIterator[Track], chunk_size: int = 500) -> AsyncIterator[str]:
+
+    yield csv_text(rows=[], header=True)
+
+    rows = []
+    async for track in tracks:
+        rows.append(format_row(item=track))
+        if len(rows) >= chunk_size:
+            yield csv_text(rows=rows)
+            rows = []
+
+    if rows:
+        yield csv_text(rows=rows)
 
 @app.get("/")
 async def root() -> dict:
     
     return {"message": "Welcome to SPEX, visit /playlists and supply your desired playlist id as a query"}
 
+""" The tracks as they were read, in the same trackRequest/albumRequest shape the endpoint has always given back. """
+async def render_raw(shared: SharedExport, playlist_id: str) -> None:
+
+    playlist = await get_playlist_dict(playlist_id=playlist_id)
+    shared.ready({**playlist, "items": [track.to_dict() for track in playlist["items"]]})
+
 @app.get("/playlists/raw")
 async def playlist_raw(playlist_id: str) -> dict:
 
-    return get_playlist_dict(playlist_id=playlist_id)
+    shared = await join_render(key=("raw", playlist_id), render=partial(render_raw, playlist_id=playlist_id))
+    shared.leave()
+
+    return shared.result.result()
+
+"""
+    The first rows go out as soon as the first page is enriched. The render spools what it's sent so that a request joining late can be sent the export from the
+    start, the copy kept for the render cache is the same chunks.
+"""
+async def render_csv(shared: SharedExport, playlist_id: str) -> None:
+
+    playlist = await stream_playlist_dict(playlist_id=playlist_id)
+    key, etag = render_key(playlist_id=playlist_id, playlist=playlist, variant="csv")
+    shared.ready((playlist["name"], etag))
+
+    async for chunk in cache_chunks(chunks=csv_chunks(tracks=playlist["items"]), key=key, name=playlist["name"]):
+        await shared.send(chunk)
 
 @app.get("/playlists/csv")
-async def get_csv_data(playlist_id: str) -> StreamingResponse: # This one mash up some of my formatting, I think it's a csv to excel thing
+async def get_csv_data(request: Request, playlist_id: str) -> Response:
     
-    playlist = get_playlist_dict(playlist_id=playlist_id)
-    playlist_name = playlist["name"]
-    df = playlist_frame_formatter(playlist_raw=playlist["items"])
+    cached = await cached_response(request=request, playlist_id=playlist_id, export_format="csv", variant="csv")
+    if cached is not None:
+        return cached
 
-    # loads the csv into ram, this is better than storing on disc
-    buffer = StringIO()
-    df.to_csv(buffer, index=False)
-    buffer.seek(0)
+    shared = await join_render(key=("csv", playlist_id), render=partial(render_csv, playlist_id=playlist_id))
 
-    return StreamingResponse(
-        content=buffer,
-        headers={"Content-Disposition": f"attachment; filename={playlist_name}.csv"},
-        media_type="text/csv"
-    )
+    return shared_response(shared=shared, export_format="csv")
+
+"""
+    Rows are added to a write only workbook as the tracks arrive so the playlist is never held in memory all at once. The xlsx can't be sent until it's complete
+    (it's a zip file) so it's saved into a temp file that only goes to disk if it gets big, then sent from there. raw=true adds the raw data sheet as well.
+"""
+async def render_xlsx(shared: SharedExport, playlist_id: str, raw: bool) -> None:
+
+    playlist = await stream_playlist_dict(playlist_id=playlist_id)
+    key, etag = render_key(playlist_id=playlist_id, playlist=playlist, variant="xlsx-raw" if raw else "xlsx")
+
+    writer = XlsxWriter(stages=xlsx_stages(raw=raw))
+    async for track in playlist["items"]:
+        writer.append(track=track)
+
+    buffer = SpooledTemporaryFile(max_size=16 * 1024 * 1024)
+    # zipping the workbook up is the slow bit, doing it on a thread keeps the event loop free for other requests
+    with METRICS.stage(name="serialize"):
+        await run_in_threadpool(writer.save, buffer)
+
+    shared.ready((playlist["name"], etag))
+    await send_file(shared=shared, file=buffer, key=key, name=playlist["name"])
 
 @app.get("/playlists/xlsx")
-async def get_excel_data(playlist_id: str) -> StreamingResponse:
-
-    playlist = get_playlist_dict(playlist_id=playlist_id)
-    playlist_name = playlist["name"]
-    df = playlist_frame_formatter(playlist_raw=playlist["items"])
-
-    buffer = BytesIO()
-    with pd.ExcelWriter(path=buffer, engine="openpyxl") as writer: # ExcelWriter is apparently much better at dealing with complexities of excel than pd.to_excel
-        df.to_excel(excel_writer=writer, index=False)
-    buffer.seek(0)
-
-    return StreamingResponse(
-        content=buffer,
-        headers={"Content-Disposition": f"attachment; filename={playlist_name}.xlsx"},
-        media_type="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
-    )
\ No newline at end of file
+async def get_excel_data(request: Request, playlist_id: str, raw: bool = False) -> Response:
+
+    variant = "xlsx-raw" if raw else "xlsx"
+    cached = await cached_response(request=request, playlist_id=playlist_id, export_format="xlsx", variant=variant)
+    if cached is not None:
+        return cached
+
+    shared = await join_render(key=(variant, playlist_id), render=partial(render_xlsx, playlist_id=playlist_id, raw=raw))
+
+    return shared_response(shared=shared, export_format="xlsx")
+
+""" Typed parquet export. Row groups are written as the tracks arrive, then the finished file is sent the same way as the xlsx. """
+async def render_parquet(shared: SharedExport, playlist_id: str) -> None:
+
+    playlist = await get_playlist_dict(playlist_id=playlist_id)
+    key, etag = render_key(playlist_id=playlist_id, playlist=playlist, variant="parquet")
+
+    buffer = SpooledTemporaryFile(max_size=16 * 1024 * 1024)
+    await run_in_threadpool(write_parquet, playlist["items"], buffer)
+
+    shared.ready((playlist["name"], etag))
+    await send_file(shared=shared, file=buffer, key=key, name=playlist["name"])
+
+@app.get("/playlists/parquet")
+async def get_parquet_data(request: Request, playlist_id: str) -> Response:
+
+    cached = await cached_response(request=request, playlist_id=playlist_id, export_format="parquet", variant="parquet")
+    if cached is not None:
+        return cached
+
+    shared = await join_render(key=("parquet", playlist_id), render=partial(render_parquet, playlist_id=playlist_id))
+
+    return shared_response(shared=shared, export_format="parquet")
+
+""" Typed json lines, streamed a chunk at a time like the csv. """
+async def ndjson_chunks(tracks: AsyncIterator[Track], chunk_size: int = 500) -> AsyncIterator[str]:
+
+    lines = []
+    async for track in tracks:
+        lines.append(ndjson_line(track=track))
+        if len(lines) >= chunk_size:
+            yield "".join(lines)
+            lines = []
+
+    if lines:
+        yield "".join(lines)
+
+async def render_ndjson(shared: SharedExport, playlist_id: str) -> None:
+
+    playlist = await stream_playlist_dict(playlist_id=playlist_id)
+    key, etag = render_key(playlist_id=playlist_id, playlist=playlist, variant="ndjson")
+    shared.ready((playlist["name"], etag))
+
+    async for chunk in cache_chunks(chunks=ndjson_chunks(tracks=playlist["items"]), key=key, name=playlist["name"]):
+        await shared.send(chunk)
+
+@app.get("/playlists/ndjson")
+async def get_ndjson_data(request: Request, playlist_id: str) -> Response:
+
+    cached = await cached_response(request=request, playlist_id=playlist_id, export_format="ndjson", variant="ndjson")
+    if cached is not None:
+        return cached
+
+    shared = await join_render(key=("ndjson", playlist_id), render=partial(render_ndjson, playlist_id=playlist_id))
+
+    return shared_response(shared=shared, export_format="ndjson")
+
+"""
+    What a background job actually does, the same exports as the handlers above except the file is written into the job's path. csv and ndjson are written a
+    chunk at a time as the pages come in, xlsx is saved on a thread at the end and parquet needs every track before it can write its row groups. raw is the same
+    as it is for GET /playlists/xlsx.
+"""
+async def run_export_job(job: Job, raw: bool = False) -> None:
+
+    playlist, client = await stream_playlist(client=await get_client(), playlist_id=job.playlist_id, on_page=job.on_page)
+    if playlist.data is None:
+        raise RuntimeError(f"couldn't load playlist ({playlist.status}): {playlist.error}")
+
+    job.name = playlist.data["name"]
+    job.total_tracks = playlist.data["total"]
+    tracks = playlist.data["items"]
+
+    if job.export_format == "csv":
+        with open(job.path, "w", newline="", encoding="utf-8") as file:
+            async for text in csv_chunks(tracks=tracks):
+                file.write(text)
+
+    elif job.export_format == "ndjson":
+        with open(job.path, "w", encoding="utf-8") as file:
+            async for text in ndjson_chunks(tracks=tracks):
+                file.write(text)
+
+    elif job.export_format == "xlsx":
+        writer = XlsxWriter(stages=xlsx_stages(raw=raw))
+        async for track in tracks:
+            writer.append(track=track)
+        with METRICS.stage(name="serialize"):
+            await run_in_threadpool(writer.save, job.path)
+
+    else:
+        await run_in_threadpool(write_parquet, [track async for track in tracks], job.path)
+
+"""
+    Starts an export in the background and answers straight away with the job, poll GET /jobs/{id} for progress and fetch the file from /jobs/{id}/download once
+    its status is done. There's a limit on how many jobs can be waiting, past that this gives a 429 until some of them have run. raw=true adds the raw data sheet
+    to an xlsx, like it does for GET /playlists/xlsx.
+"""
+@app.post("/jobs", status_code=202)
+async def create_job(playlist_id: str, format: str = "csv", raw: bool = False) -> dict:
+
+    if format not in MEDIA_TYPES:
+        raise HTTPException(status_code=422, detail=f"format has to be one of {', '.join(MEDIA_TYPES)}")
+
+    job = app.state.jobs.submit(playlist_id=playlist_id, export_format=format, run=partial(run_export_job, raw=raw))
+    if job is None:
+        raise HTTPException(status_code=429, detail="Too many exports are queued, try again later", headers={"Retry-After": "30"})
+
+    return job.to_dict()
+
+@app.get("/jobs/{job_id}")
+async def get_job(job_id: str) -> dict:
+
+    job = app.state.jobs.get(job_id=job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="No such job, it may have expired")
+
+    return job.to_dict()
+
+@app.get("/jobs/{job_id}/download")
+async def download_job(job_id: str) -> FileResponse:
+
+    job = app.state.jobs.get(job_id=job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="No such job, it may have expired")
+    if job.status != "done":
+        # 409 so a poller can tell "not yet" (or "never") apart from a job that doesn't exist
+        return JSONResponse(status_code=409, content=job.to_dict())
+
+    return FileResponse(path=job.path, media_type=MEDIA_TYPES[job.export_format], filename=f"{job.name}.{job.export_format}")
+
+""" Prometheus scrape target. The rate limiter's gauges are read when the scrape happens, everything else is recorded as requests go through. """
+@app.get("/metrics")
+async def get_metrics() -> PlainTextResponse:
+
+    METRICS.set_gauge(name="spex_rate_limiter_concurrency", value=app.state.rate_limiter.concurrency)
+    METRICS.set_gauge(name="spex_rate_limiter_in_flight", value=app.state.rate_limiter.in_flight)
+    for status, count in app.state.jobs.counts().items():
+        METRICS.set_gauge(name="spex_jobs", value=count, status=status)
+    METRICS.set_gauge(name="spex_shared_renders_in_flight", value=app.state.single_flight.in_flight())
+
+    return PlainTextResponse(content=METRICS.render(), media_type="text/plain; version=0.0.4")
@@ -0,0 +1,236 @@
+import asyncio
+from dataclasses import dataclass, field
+import json
+import os
+from pathlib import Path
+import re
+import shutil
+import tempfile
+import time
+from typing import Awaitable, Callable
+from uuid import uuid4
+
+from spex.atomic_file import atomic_write
+from spex.metrics import METRICS
+
+"""
+    Exports that run in the background instead of inside the request that asked for them. A big playlist can take longer than a proxy will hold a request open
+    for, and if the client gives up half way the work is thrown away. A job is handed to the JobManager, which runs at most workers of them at a time and keeps
+    at most max_queued waiting behind those. The export is written to a file in the manager's own temp folder, progress is kept on the Job as it goes and the
+    finished file is kept for ttl seconds after the job ends so it can be downloaded.
+
+    When the web server runs more than one worker a job is run by whichever worker took the POST, but the GETs that follow can land on any of them. With shared
+    set the manager uses directory as it is (every worker is given the same one) and each job's state is also written next to its file as {id}.json whenever it
+    changes, so any worker can report on any job and hand over its file.
+"""
+
+JOB_STATUSES = ["queued", "running", "done", "failed", "cancelled"]
+
+@dataclass
+class Job:
+
+    id: str
+    playlist_id: str
+    export_format: str
+    path: Path
+    status: str = "queued"
+    name: str | None = None
+    total_tracks: int | None = None
+    tracks: int = 0
+    pages: int = 0
+    albums: int = 0
+    error: str | None = None
+    created_at: float = field(default_factory=time.time)
+    started_at: float | None = None
+    finished_at: float | None = None
+    task: asyncio.Task | None = field(default=None, repr=False)
+    state_path: Path | None = field(default=None, repr=False) # where the job is saved for the other workers, None if it isn't shared
+    saved_at: float = field(default=0.0, repr=False)
+
+    @property
+    def finished(self) -> bool:
+
+        return self.status in ("done", "failed", "cancelled")
+
+    """ Called by iter_tracks after every page. """
+    def on_page(self, tracks: int, albums: int) -> None:
+
+        self.pages += 1
+        self.tracks += tracks
+        self.albums += albums
+        # progress is only worth passing on about once a second, the status changes are always saved
+        if time.time() - self.saved_at >= 1.0:
+            self.save()
+
+    """ Writes the job out for the other workers, a temp file and a rename so nobody reads half of it. """
+    def save(self) -> None:
+
+        if self.state_path is None:
+            return
+
+        with atomic_write(path=self.state_path) as file:
+            file.write(json.dumps({**self.to_dict(), "path": str(self.path)}).encode())
+        self.saved_at = time.time()
+
+    """ A job another worker saved. It can be reported on and downloaded but there's no task, that's in the other worker. """
+    @classmethod
+    def load(cls, state_path: Path) -> "Job | None":
+
+        try:
+            state = json.loads(state_path.read_text())
+        except (OSError, ValueError):
+            return None
+
+        progress = state["progress"]
+
+        return cls(id=state["id"], playlist_id=state["playlist_id"], export_format=state["format"], path=Path(state["path"]), status=state["status"],
+                   name=state["name"], total_tracks=progress["total_tracks"], tracks=progress["tracks"], pages=progress["pages"], albums=progress["albums"],
+                   error=state["error"], created_at=state["created_at"], started_at=state["started_at"], finished_at=state["finished_at"])
+
+    def to_dict(self) -> dict:
+
+        return {
+            "id": self.id,
+            "playlist_id": self.playlist_id,
+            "format": self.export_format,
+            "status": self.status,
+            "name": self.name,
+            "progress": {"tracks": self.tracks, "total_tracks": self.total_tracks, "pages": self.pages, "albums": self.albums},
+            "error": self.error,
+            "created_at": self.created_at,
+            "started_at": self.started_at,
+            "finished_at": self.finished_at
+        }
+
+class JobManager:
+
+    def __init__(self, workers: int = 2, max_queued: int = 20, ttl: float = 60 * 60, directory: str | Path | None = None, shared: bool = False):
+
+        self.workers = workers
+        self.max_queued = max_queued
+        self.ttl = ttl
+        self.shared = shared
+        self.slots = asyncio.Semaphore(workers)
+        self.jobs = {}
+
+        if directory is not None:
+            Path(directory).mkdir(parents=True, exist_ok=True)
+        if shared:
+            self.directory = Path(directory)
+        else:
+            # a folder of our own so two apps never clean up each others files
+            self.directory = Path(tempfile.mkdtemp(prefix="spex-jobs-", dir=directory))
+
+    """ Queues an export, run does the work and fills in the Job as it goes. Returns None if the queue is already full. """
+    def submit(self, playlist_id: str, export_format: str, run: Callable[[Job], Awaitable[None]]) -> Job | None:
+
+        self.prune()
+        if sum(job.status == "queued" for job in self.jobs.values()) >= self.max_queued:
+            METRICS.inc(name="spex_jobs_rejected_total")
+            return None
+
+        job_id = uuid4().hex
+        job = Job(id=job_id, playlist_id=playlist_id, export_format=export_format, path=self.directory / f"{job_id}.{export_format}",
+                  state_path=self.directory / f"{job_id}.json" if self.shared else None)
+        self.jobs[job_id] = job
+        job.save()
+        job.task = asyncio.create_task(self.run(job=job, run=run))
+
+        return job
+
+    async def run(self, job: Job, run: Callable[[Job], Awaitable[None]]) -> None:
+
+        try:
+            async with self.slots:
+                job.status = "running"
+                job.started_at = time.time()
+                job.save()
+                await run(job)
+                job.status = "done"
+
+        except asyncio.CancelledError:
+            job.status = "cancelled"
+            job.path.unlink(missing_ok=True)
+            raise
+
+        # whatever went wrong is reported on the job rather than lost in a task nobody awaits
+        except Exception as error:
+            job.status = "failed"
+            job.error = f"{type(error).__name__}: {error}"
+            job.path.unlink(missing_ok=True)
+
+        finally:
+            job.finished_at = time.time()
+            job.save()
+            METRICS.inc(name="spex_jobs_total", status=job.status)
+
+    """ One of our jobs, or when shared one that another worker saved. job_id comes from the url so it has to look like one of ours before it's used as a path. """
+    def get(self, job_id: str) -> Job | None:
+
+        self.prune()
+
+        job = self.jobs.get(job_id)
+        if job is None and self.shared and re.fullmatch(r"[0-9a-f]{32}", job_id):
+            job = Job.load(state_path=self.directory / f"{job_id}.json")
+
+        return job
+
+    """ Forgets jobs that finished more than ttl seconds ago and deletes their files. When shared that includes expired jobs left behind by other workers. """
+    def prune(self) -> None:
+
+        expired = [job for job in self.jobs.values() if job.finished and time.time() - job.finished_at > self.ttl]
+        for job in expired:
+            self.remove(job=job)
+            del self.jobs[job.id]
+
+        if self.shared:
+            for state_path in self.directory.glob("*.json"):
+                job = Job.load(state_path=state_path) if state_path.stem not in self.jobs else None
+                if job is not None and job.finished and time.time() - job.finished_at > self.ttl:
+                    job.state_path = state_path
+                    self.remove(job=job)
+
+    def remove(self, job: Job) -> None:
+
+        job.path.unlink(missing_ok=True)
+        if job.state_path is not None:
+            job.state_path.unlink(missing_ok=True)
+
+    def counts(self) -> dict[str, int]:
+
+        counts = dict.fromkeys(JOB_STATUSES, 0)
+        for job in self.jobs.values():
+            counts[job.status] += 1
+
+        return counts
+
+    """ Cancels anything still running and removes every job's file. A shared folder belongs to every worker so only our own jobs are taken out of it. """
+    async def close(self) -> None:
+
+        tasks = [job.task for job in self.jobs.values() if job.task is not None and not job.task.done()]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+        if self.shared:
+            for job in self.jobs.values():
+                self.remove(job=job)
+        else:
+            shutil.rmtree(self.directory, ignore_errors=True)
+
+"""
+    SPEX_JOB_WORKERS is how many exports run at once, SPEX_JOB_QUEUE how many can wait behind them, SPEX_JOB_TTL how many seconds a finished export is kept and
+    SPEX_JOB_DIR where the files go (the system temp folder by default). With SPEX_SHARED_STATE set the jobs go in a jobs folder in there instead, shared with
+    every other worker.
+"""
+def open_job_manager() -> JobManager:
+
+    shared_state = os.getenv("SPEX_SHARED_STATE")
+
+    return JobManager(
+        workers=int(os.getenv("SPEX_JOB_WORKERS", 2)),
+        max_queued=int(os.getenv("SPEX_JOB_QUEUE", 20)),
+        ttl=float(os.getenv("SPEX_JOB_TTL", 60 * 60)),
+        directory=Path(shared_state) / "jobs" if shared_state else os.getenv("SPEX_JOB_DIR"),
+        shared=bool(shared_state)
+    )
@@ -0,0 +1,173 @@
+import asyncio
+from collections import OrderedDict
+import hashlib
+import json
+import os
+from pathlib import Path
+import threading
+
+from spex.atomic_file import atomic_write
+from spex.metrics import METRICS
+
+"""
+    Finished exports, kept so the same playlist in the same format doesn't have to be crawled and rendered again. A playlist's snapshot_id changes every time it's
+    edited, so an entry keyed on (playlist id, snapshot_id, variant) can never go stale, it just stops being asked for. Entries live in memory up to max_bytes with
+    the least recently used dropped first. If a directory is given every entry is written there as well, up to max_disk_bytes, so they survive a restart and can
+    be shared by every worker pointed at the same folder.
+"""
+class RenderCache:
+
+    def __init__(self, max_bytes: int = 64 * 1024 * 1024, directory: str | Path | None = None, max_disk_bytes: int = 1024 * 1024 * 1024):
+
+        self.max_bytes = max_bytes
+        self.max_disk_bytes = max_disk_bytes
+        self.entries = OrderedDict()
+        self.size = 0
+        self.lock = threading.Lock()
+
+        self.directory = Path(directory) if directory is not None else None
+        if self.directory is not None:
+            self.directory.mkdir(parents=True, exist_ok=True)
+
+    """ Whether an export of size bytes would be kept at all, so a handler knows if it's worth holding on to the bytes. """
+    def fits(self, size: int) -> bool:
+
+        return size <= self.max_bytes
+
+    """ Returns (file name, body) or None. A disk hit is moved back into memory. """
+    def get(self, key: tuple[str, str, str]) -> tuple[str, bytes] | None:
+
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                self.entries.move_to_end(key)
+        if entry is not None:
+            METRICS.inc(name="spex_render_cache_hits_total", tier="memory")
+            return entry
+
+        entry = self.read_file(key=key)
+        if entry is not None:
+            METRICS.inc(name="spex_render_cache_hits_total", tier="disk")
+            self.remember(key=key, name=entry[0], body=entry[1])
+            return entry
+
+        METRICS.inc(name="spex_render_cache_misses_total")
+        return None
+
+    """ get for the event loop. A memory hit is answered straight away, anything that might have to go to the disk tier is looked up on a thread. """
+    async def get_async(self, key: tuple[str, str, str]) -> tuple[str, bytes] | None:
+
+        if self.directory is None:
+            return self.get(key=key)
+
+        return await asyncio.to_thread(self.get, key=key)
+
+    def put(self, key: tuple[str, str, str], name: str, body: bytes) -> None:
+
+        if not self.fits(size=len(body)):
+            return
+
+        self.remember(key=key, name=name, body=body)
+        self.write_file(key=key, name=name, body=body)
+
+    async def put_async(self, key: tuple[str, str, str], name: str, body: bytes) -> None:
+
+        if self.directory is None:
+            self.put(key=key, name=name, body=body)
+        else:
+            await asyncio.to_thread(self.put, key=key, name=name, body=body)
+
+    def remember(self, key: tuple[str, str, str], name: str, body: bytes) -> None:
+
+        with self.lock:
+            previous = self.entries.pop(key, None)
+            if previous is not None:
+                self.size -= len(previous[1])
+
+            self.entries[key] = (name, body)
+            self.size += len(body)
+            while self.size > self.max_bytes:
+                _, (_, dropped) = self.entries.popitem(last=False)
+                self.size -= len(dropped)
+
+    def file_path(self, key: tuple[str, str, str]) -> Path:
+
+        return self.directory / (hashlib.sha256("\0".join(key).encode()).hexdigest() + ".bin")
+
+    """ The file name goes on the first line as json, the export follows it. """
+    def read_file(self, key: tuple[str, str, str]) -> tuple[str, bytes] | None:
+
+        if self.directory is None:
+            return None
+
+        path = self.file_path(key=key)
+        try:
+            with open(path, "rb") as file:
+                name = json.loads(file.readline())
+                body = file.read()
+            os.utime(path) # the disk tier drops the least recently used files first too
+        except (OSError, ValueError):
+            return None
+
+        return (name, body)
+
+    def write_file(self, key: tuple[str, str, str], name: str, body: bytes) -> None:
+
+        if self.directory is None:
+            return
+
+        # a reader in another worker never sees half a file
+        try:
+            with atomic_write(path=self.file_path(key=key)) as file:
+                file.write(json.dumps(name).encode() + b"\n")
+                file.write(body)
+        except OSError:
+            return
+
+        self.evict_files()
+
+    def evict_files(self) -> None:
+
+        files = []
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith(".bin"):
+                try:
+                    stat = entry.stat()
+                except OSError:
+                    continue
+                files.append((stat.st_mtime, stat.st_size, entry.path))
+
+        total = sum(size for _, size, _ in files)
+        for _, size, path in sorted(files):
+            if total <= self.max_disk_bytes:
+                break
+            Path(path).unlink(missing_ok=True)
+            total -= size
+
+""" The ETag for an export, weak since an xlsx rendered twice from the same snapshot isn't byte for byte the same (the zip has timestamps in it). """
+def make_etag(snapshot_id: str, variant: str) -> str:
+
+    return f'W/"{snapshot_id}-{variant}"'
+
+""" If-None-Match can hold a list of ETags or *, and compares weakly so the W/ prefix doesn't matter. """
+def etag_matches(if_none_match: str | None, etag: str) -> bool:
+
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+
+    return etag.removeprefix("W/") in (tag.strip().removeprefix("W/") for tag in if_none_match.split(","))
+
+"""
+    SPEX_RENDER_CACHE_BYTES caps the memory tier (0 turns the cache off and returns None), SPEX_RENDER_CACHE_DIR turns on the disk tier and
+    SPEX_RENDER_CACHE_DISK_BYTES caps it.
+"""
+def open_render_cache() -> RenderCache | None:
+
+    max_bytes = int(os.getenv("SPEX_RENDER_CACHE_BYTES", 64 * 1024 * 1024))
+    if max_bytes <= 0:
+        return None
+
+    return RenderCache(max_bytes=max_bytes, directory=os.getenv("SPEX_RENDER_CACHE_DIR"),
+                       max_disk_bytes=int(os.getenv("SPEX_RENDER_CACHE_DISK_BYTES", 1024 * 1024 * 1024)))
@@ -1,4 +1,42 @@
+import argparse
+import os
+from pathlib import Path
+
 import uvicorn
 
+"""
+    Serves the api with as many worker processes as asked for, one per core by default. Every worker is its own process with its own event loop, so without
+    anything shared each one would do its own token handshake and keep its own idea of spotify's rate limit, and between them they'd go over it. Before the
+    workers start SPEX_SHARED_STATE is pointed at a folder they all use (in SPEX_CACHE_DIR unless it's already set), which gives them one token (see
+    TokenProvider) and one rate budget and throttle state (see SharedRateLimiter). Requests in flight are still capped per worker, so --workers n allows up to n
+    times SPEX_MAX_CONCURRENCY in flight, the rate limit is what holds for all of them together. On SIGINT or SIGTERM the workers stop taking new connections and are given
+    graceful_timeout seconds to finish what they're answering before they're cut off. --reload is for development, it runs a single worker that restarts when
+    the code changes. Background jobs are run by whichever worker took the POST and saved in the shared folder too, so they can be polled and downloaded
+    through any of them.
+"""
+def main() -> None:
+
+    parser = argparse.ArgumentParser(description="Serve the spex api")
+    parser.add_argument("--host", default=os.getenv("SPEX_HOST", "127.0.0.1"), help="Address to listen on")
+    parser.add_argument("--port", type=int, default=int(os.getenv("SPEX_PORT", 8000)), help="Port to listen on")
+    parser.add_argument("--workers", type=int, default=int(os.getenv("SPEX_WORKERS", os.cpu_count() or 1)), help="How many worker processes to run, one per core by default")
+    parser.add_argument("--graceful-timeout", type=float, default=float(os.getenv("SPEX_GRACEFUL_TIMEOUT", 30)),
+                        help="Seconds requests in flight get to finish when the server is stopped")
+    parser.add_argument("--reload", action="store_true", help="Run a single worker that restarts whenever the code changes")
+    args = parser.parse_args()
+
+    # set before the workers start so they all inherit it
+    cache_dir = Path(os.getenv("SPEX_CACHE_DIR", Path.home() / ".cache" / "spex"))
+    os.environ.setdefault("SPEX_SHARED_STATE", str(cache_dir / "shared"))
+
+    uvicorn.run(
+        "spex.web.api:app",
+        host=args.host,
+        port=args.port,
+        workers=None if args.reload else args.workers,
+        reload=args.reload,
+        timeout_graceful_shutdown=args.graceful_timeout
+    )
+
 if __name__ == "__main__": # wonder if this line should be different since this file isn't called main. I think this just works when I call it from command line
-    uvicorn.run("api:app", host="127.0.0.1", port=8000, reload=True)
\ No newline at end of file
+    main()
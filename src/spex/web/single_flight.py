@@ -0,0 +1,173 @@
+import asyncio
+import os
+import tempfile
+from typing import AsyncIterator, Awaitable, Callable, Hashable
+
+from spex.metrics import METRICS
+
+"""
+    In-flight deduplication for the export endpoints. Without it, two people (or one client retrying) asking for the same playlist at the same time each run the
+    whole spotify crawl, which doubles the api calls and the pressure on the rate budget for no reason. The first request for a key starts one shared task, any
+    request for the same key that comes in while that task is still going joins it instead of starting its own, and every one of them gets the same answer.
+"""
+
+"""
+    One shared fetch-and-render. result is what a handler needs before it can answer (the file name and ETag, or the whole answer for the json endpoints) and the
+    export itself is spooled into a temp file as it's sent. A request that joins late still gets the export from the start by reading the file from the top and
+    then goes on reading as the rest arrive, and the export is never held in memory however big it gets. The task isn't tied to any one request, so the first
+    client hanging up doesn't cut off everybody else. listeners counts the requests still waiting on it, once the last of them has gone the render is cancelled.
+"""
+class SharedExport:
+
+    def __init__(self):
+
+        self.result = asyncio.get_running_loop().create_future()
+        self.file = None # made when the first chunk is sent, the json endpoints never need one
+        self.size = 0
+        self.finished = False
+        self.error = None
+        self.changed = asyncio.Event()
+        self.task = None
+        self.listeners = 0
+
+    """ Hands the handlers what they need to start answering, only the first call counts. """
+    def ready(self, value) -> None:
+
+        if not self.result.done():
+            self.result.set_result(value)
+
+    """ Spools a chunk for the readers. The file is only written on a thread so a slow disk never holds up the event loop. """
+    async def send(self, chunk: bytes) -> None:
+
+        if self.file is None:
+            self.file = tempfile.TemporaryFile(prefix="spex-render-")
+        await asyncio.to_thread(self.write, chunk)
+        self.size += len(chunk)
+        self.wake()
+
+    def write(self, chunk: bytes) -> None:
+
+        self.file.write(chunk)
+        # readers go straight to the file descriptor, so nothing can be left sitting in the buffer
+        self.file.flush()
+
+    """ Called once the render has ended, error is whatever stopped it. A render that fails before it's ready fails every request waiting on it. """
+    def finish(self, error: BaseException | None = None) -> None:
+
+        self.finished = True
+        self.error = error
+        if not self.result.done():
+            if isinstance(error, asyncio.CancelledError):
+                self.result.cancel()
+            else:
+                self.result.set_exception(error or RuntimeError("the export finished without anything to send"))
+        self.wake()
+        if self.listeners == 0:
+            self.close()
+
+    """ Called by each request that joined once it's done with the export. When nobody is left the render is cancelled, or its file let go of if it's done. """
+    def leave(self) -> None:
+
+        self.listeners -= 1
+        if self.listeners > 0:
+            return
+
+        if self.finished:
+            self.close()
+        elif self.task is not None:
+            self.task.cancel()
+
+    def close(self) -> None:
+
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+    def wake(self) -> None:
+
+        self.changed.set()
+        self.changed = asyncio.Event()
+
+    """ Waits for the result without letting a request that's given up cancel it for the others. """
+    async def wait(self):
+
+        return await asyncio.shield(self.result)
+
+    """
+        The export from the first byte, chunk_size at a time, waiting for more until the render is done. Raises the render's error if it broke part way. This is
+        the request's share of the render, so it leaves once it's done (or the client hangs up).
+    """
+    async def read(self, chunk_size: int = 64 * 1024) -> AsyncIterator[bytes]:
+
+        offset = 0
+        try:
+            while True:
+                while offset < self.size:
+                    chunk = await asyncio.to_thread(os.pread, self.file.fileno(), min(chunk_size, self.size - offset), offset)
+                    offset += len(chunk)
+                    yield chunk
+
+                if self.finished:
+                    if self.error is not None:
+                        raise self.error
+                    return
+
+                await self.changed.wait()
+        finally:
+            self.leave()
+
+class SingleFlight:
+
+    def __init__(self):
+
+        self.exports = {}
+
+    """
+        Returns the export in flight for key, or starts render on a new one if there isn't one. The first part of key is the route it's counted under. A key is
+        only shared while its render is running, once it's done the next request starts fresh (and by then it's usually a render cache hit anyway). Whoever
+        joins is counted as a listener and has to leave once it's done, read does that for the streamed exports.
+    """
+    def join(self, key: tuple[Hashable, ...], render: Callable[[SharedExport], Awaitable[None]]) -> SharedExport:
+
+        shared = self.exports.get(key)
+        if shared is not None:
+            METRICS.inc(name="spex_coalesced_requests_total", route=key[0])
+            shared.listeners += 1
+            return shared
+
+        METRICS.inc(name="spex_shared_renders_total", route=key[0])
+        shared = SharedExport()
+        shared.listeners += 1
+        self.exports[key] = shared
+        shared.task = asyncio.create_task(self.run(key=key, shared=shared, render=render))
+
+        return shared
+
+    async def run(self, key: tuple[Hashable, ...], shared: SharedExport, render: Callable[[SharedExport], Awaitable[None]]) -> None:
+
+        try:
+            await render(shared)
+            shared.finish()
+
+        except asyncio.CancelledError as error:
+            shared.finish(error=error)
+            raise
+
+        # handed to the requests waiting on it, they're the ones that report it
+        except Exception as error:
+            shared.finish(error=error)
+
+        finally:
+            del self.exports[key]
+
+    def in_flight(self) -> int:
+
+        return len(self.exports)
+
+    """ Cancels every render still going, for when the app shuts down. """
+    async def close(self) -> None:
+
+        tasks = [shared.task for shared in self.exports.values()]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
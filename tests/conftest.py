@@ -0,0 +1,11 @@
+import pytest
+
+from benchmarks.mock_spotify import MockSettings
+from benchmarks.mock_spotify import MockSpotify
+
+""" A stand in for spotify shared by every test in a module, its playlists are 250 tracks long (three pages) and nothing fails. """
+@pytest.fixture(scope="module")
+def spotify():
+
+    with MockSpotify(settings=MockSettings(tracks=250)) as mock:
+        yield mock
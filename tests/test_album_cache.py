@@ -0,0 +1,53 @@
+import time
+
+from benchmarks.mock_spotify import MockSettings
+from benchmarks.mock_spotify import make_full_album
+from spex.album_cache import AlbumCache
+from spex.album_cache import slim_album
+
+SETTINGS = MockSettings(tracks=100)
+
+def make_albums(count: int) -> dict[str, dict]:
+
+    return {f"album{n}": make_full_album(settings=SETTINGS, album_id=f"album{n}") for n in range(count)}
+
+def test_round_trip(tmp_path):
+
+    albums = make_albums(count=3)
+    cache = AlbumCache(path=tmp_path / "albums.sqlite3")
+    cache.put_many(albums=albums)
+
+    assert cache.get_many(album_ids=["album0", "album2", "album9"]) == {album_id: slim_album(album=albums[album_id]) for album_id in ("album0", "album2")}
+    assert cache.stats()["hits"] == 2
+    assert cache.stats()["misses"] == 1
+    cache.close()
+
+    # and it's still there for the next run
+    cache = AlbumCache(path=tmp_path / "albums.sqlite3")
+    assert cache.get_many(album_ids=list(albums)) == {album_id: slim_album(album=album) for album_id, album in albums.items()}
+    cache.close()
+
+def test_expired_albums_are_misses(tmp_path):
+
+    cache = AlbumCache(path=tmp_path / "albums.sqlite3", ttl=-1)
+    cache.put_many(albums=make_albums(count=2))
+
+    assert cache.get_many(album_ids=["album0", "album1"]) == {}
+    cache.close()
+
+def test_least_recently_used_is_evicted(tmp_path):
+
+    albums = make_albums(count=3)
+    cache = AlbumCache(path=tmp_path / "albums.sqlite3", max_entries=2)
+
+    cache.put_many(albums={"album0": albums["album0"]})
+    time.sleep(0.01)
+    cache.put_many(albums={"album1": albums["album1"]})
+    time.sleep(0.01)
+    cache.get_many(album_ids=["album0"])
+    time.sleep(0.01)
+    cache.put_many(albums={"album2": albums["album2"]})
+
+    assert set(cache.get_many(album_ids=list(albums))) == {"album0", "album2"}
+    assert cache.stats()["entries"] == 2
+    cache.close()
@@ -0,0 +1,85 @@
+import math
+
+import pytest
+
+from benchmarks.mock_spotify import MockSettings
+from benchmarks.mock_spotify import MockSpotify
+from spex.ApiClient import ApiClient
+from spex.api_client import ALBUM_BATCH_SIZE
+from spex.api_client import get_playlist
+from spex.api_client import set_client
+from spex.api_client import stream_playlist
+from spex.rate_limiter import RateLimiter
+from spex.records import Album
+from spex.token_provider import TokenProvider
+
+def test_class_client_get_playlist(spotify):
+
+    token_provider = TokenProvider(client_id="id", client_secret="secret", token_url=spotify.token_url)
+    client = ApiClient(client_id="id", client_secret="secret", token_provider=token_provider, base_url=spotify.base_url)
+
+    playlist = client.get_playlist(playlist_id="playlist")
+
+    assert playlist["name"] == "Benchmark 250"
+    assert len(playlist["items"]) == 250
+    assert all(track.album is not None for track in playlist["items"])
+
+def make_client(spotify, max_concurrency: int = 8):
+
+    token_provider = TokenProvider(client_id="id", client_secret="secret", token_url=spotify.token_url)
+    rate_limiter = RateLimiter(rate=1000, burst=1000, max_concurrency=max_concurrency)
+
+    return set_client(client_id="id", client_secret="secret", token_provider=token_provider, rate_limiter=rate_limiter, base_url=spotify.base_url)
+
+""" 250 tracks on 125 albums, each album is requested once and 20 go in every /albums request. """
+@pytest.mark.parametrize("load", [get_playlist, stream_playlist])
+def test_albums_are_requested_once_in_chunks(spotify, load):
+
+    client = make_client(spotify=spotify)
+    spotify.stats(reset=True)
+
+    playlist, client = load(client=client, playlist_id="playlist")
+    tracks = list(playlist.data["items"])
+
+    assert spotify.stats()["requests"]["albums"] == math.ceil(125 / ALBUM_BATCH_SIZE)
+    assert {track.album.upc for track in tracks} == {f"{album_number:012}" for album_number in range(125)}
+    # tracks on the same album share the one Album
+    assert tracks[0].album is tracks[125].album
+
+def test_known_albums_are_not_requested(spotify):
+
+    client = make_client(spotify=spotify)
+    known_albums = {f"album{n}": Album(upc="known", label=None, copy_rights=()) for n in range(100)}
+    spotify.stats(reset=True)
+
+    playlist, client = get_playlist(client=client, playlist_id="playlist", known_albums=known_albums)
+
+    assert spotify.stats()["requests"]["albums"] == math.ceil(25 / ALBUM_BATCH_SIZE)
+    assert playlist.data["items"][0].album.upc == "known"
+    assert playlist.data["items"][100].album.upc == f"{100:012}"
+
+""" The same playlist on pages of 10 that each take a little while, so there are plenty of pages in flight at once. """
+@pytest.fixture(scope="module")
+def small_pages():
+
+    with MockSpotify(settings=MockSettings(tracks=250, page_size=10, latency=0.01)) as mock:
+        yield mock
+
+""" Pages are fetched at the same time but handed out in playlist order, each page is requested once. """
+@pytest.mark.parametrize("load", [get_playlist, stream_playlist])
+def test_concurrent_pages_stay_in_order(small_pages, load):
+
+    client = make_client(spotify=small_pages)
+    small_pages.stats(reset=True)
+
+    playlist, client = load(client=client, playlist_id="playlist")
+
+    assert [track.track_id for track in playlist.data["items"]] == [f"track{n}" for n in range(250)]
+    assert small_pages.stats()["requests"]["tracks"] == 24
+
+def test_concurrent_pages_match_one_at_a_time(small_pages):
+
+    concurrent, client = get_playlist(client=make_client(spotify=small_pages), playlist_id="playlist")
+    sequential, client = get_playlist(client=make_client(spotify=small_pages, max_concurrency=1), playlist_id="playlist")
+
+    assert [track.to_dict() for track in concurrent.data["items"]] == [track.to_dict() for track in sequential.data["items"]]
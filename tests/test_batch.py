@@ -0,0 +1,48 @@
+import math
+
+import pytest
+
+from spex.api_client import ALBUM_BATCH_SIZE
+from spex.api_client import set_client
+from spex.batch import load_batch
+from spex.batch import parse_playlist_id
+from spex.rate_limiter import RateLimiter
+from spex.token_provider import TokenProvider
+
+def make_client(spotify):
+
+    token_provider = TokenProvider(client_id="id", client_secret="secret", token_url=spotify.token_url)
+
+    return set_client(client_id="id", client_secret="secret", token_provider=token_provider, rate_limiter=RateLimiter(rate=1000, burst=1000),
+                      base_url=spotify.base_url)
+
+@pytest.mark.parametrize("link, playlist_id", [
+    ("https://open.spotify.com/playlist/37i9dQZF1DXcBWIGoYBM5M?si=abc", "37i9dQZF1DXcBWIGoYBM5M"),
+    ("https://open.spotify.com/intl-de/playlist/37i9dQZF1DXcBWIGoYBM5M", "37i9dQZF1DXcBWIGoYBM5M"),
+    ("spotify:playlist:37i9dQZF1DXcBWIGoYBM5M", "37i9dQZF1DXcBWIGoYBM5M"),
+    (" 37i9dQZF1DXcBWIGoYBM5M\n", "37i9dQZF1DXcBWIGoYBM5M"),
+    ("https://open.spotify.com/album/37i9dQZF1DXcBWIGoYBM5M", None)
+])
+def test_parse_playlist_id(link, playlist_id):
+
+    assert parse_playlist_id(link=link) == playlist_id
+
+""" A playlist that can't be loaded is handed back as a failed result in its place, the rest of the batch still loads. """
+def test_failed_playlist_does_not_stop_the_batch(spotify):
+
+    results, client = load_batch(client=make_client(spotify=spotify), playlist_ids=["first", "missing", "second"])
+
+    assert [result.status for result in results] == [200, 404, 200]
+    assert results[1].data is None
+    assert [len(results[n].data["items"]) for n in (0, 2)] == [250, 250]
+    assert all(track.album.upc is not None for n in (0, 2) for track in results[n].data["items"])
+
+""" Every playlist on the stand in has the same 125 albums, across the batch each one is only requested once. """
+def test_albums_are_shared_across_the_batch(spotify):
+
+    spotify.stats(reset=True)
+
+    results, client = load_batch(client=make_client(spotify=spotify), playlist_ids=["first", "second", "third"])
+
+    assert spotify.stats()["requests"]["albums"] == math.ceil(125 / ALBUM_BATCH_SIZE)
+    assert results[0].data["items"][0].album is results[2].data["items"][0].album
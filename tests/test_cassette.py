@@ -0,0 +1,61 @@
+import gzip
+import json
+
+import pytest
+
+from benchmarks.mock_spotify import MockSettings
+from benchmarks.mock_spotify import MockSpotify
+from spex.api_client import create_session
+from spex.api_client import get_playlist
+from spex.api_client import set_client
+from spex.cassette import Cassette
+from spex.rate_limiter import RateLimiter
+from spex.token_provider import TokenProvider
+
+def load_playlist(base_url: str, token_url: str, cassette: Cassette) -> list[dict]:
+
+    session = create_session(cassette=cassette)
+    token_provider = TokenProvider(client_id="id", client_secret="secret", token_url=token_url)
+    client = set_client(client_id="id", client_secret="secret", token_provider=token_provider, rate_limiter=RateLimiter(rate=1000, burst=1000), session=session,
+                        base_url=base_url)
+
+    playlist, client = get_playlist(client=client, playlist_id="playlist")
+    session.close()
+
+    return [track.to_dict() for track in playlist.data["items"]]
+
+""" A playlist recorded from the stand in replays the same once the stand in has gone, and as many times as it's replayed. """
+def test_recorded_playlist_replays_offline(tmp_path):
+
+    path = tmp_path / "playlist.jsonl.gz"
+    with MockSpotify(settings=MockSettings(tracks=250)) as spotify:
+        base_url = spotify.base_url
+        token_url = spotify.token_url
+        recorded = load_playlist(base_url=base_url, token_url=token_url, cassette=Cassette(path=path, mode="record"))
+        requests = spotify.stats()["total"]
+
+    assert len(recorded) == 250
+    with gzip.open(path, "rt", encoding="utf-8") as file:
+        interactions = [json.loads(line) for line in file]
+    assert len(interactions) == requests
+    # live tokens are never written down
+    assert all("token1" not in interaction["body"] for interaction in interactions)
+
+    assert load_playlist(base_url=base_url, token_url=token_url, cassette=Cassette(path=path)) == recorded
+    assert load_playlist(base_url=base_url, token_url=token_url, cassette=Cassette(path=path)) == recorded
+
+def test_request_that_was_never_recorded_is_a_404(tmp_path):
+
+    path = tmp_path / "playlist.jsonl.gz"
+    with MockSpotify(settings=MockSettings(tracks=50)) as spotify:
+        load_playlist(base_url=spotify.base_url, token_url=spotify.token_url, cassette=Cassette(path=path, mode="record"))
+
+    session = create_session(cassette=Cassette(path=path))
+    response = session.get(f"{spotify.base_url}/playlists/other")
+    assert response.status_code == 404
+    assert "Not in the cassette" in response.json()["error"]["message"]
+
+def test_unknown_mode_is_refused(tmp_path):
+
+    with pytest.raises(ValueError):
+        Cassette(path=tmp_path / "playlist.jsonl.gz", mode="rewind")
@@ -0,0 +1,123 @@
+import pytest
+
+from benchmarks.mock_spotify import MockSettings
+from benchmarks.mock_spotify import MockSpotify
+from spex.api_client import IncompleteCrawlError
+from spex.api_client import get_playlist
+from spex.api_client import set_client
+from spex.api_client import stream_playlist
+from spex.checkpoints import CrawlCheckpoints
+from spex.rate_limiter import RateLimiter
+from spex.records import Album
+from spex.token_provider import TokenProvider
+
+ITEMS = [{"track": {"id": f"track{n}"}} for n in range(3)]
+ALBUM = Album(upc="upc", label="label", copy_rights=(("C", "2020 label"),))
+
+""" The same playlist as flaky_spotify, from a stand in where nothing fails. """
+@pytest.fixture(scope="module")
+def spotify():
+
+    with MockSpotify(settings=MockSettings(tracks=1000)) as mock:
+        yield mock
+
+""" A stand in where 30% of requests fail. The client only has one request in flight at once, so which ones fail is the same every run. """
+@pytest.fixture
+def flaky_spotify():
+
+    with MockSpotify(settings=MockSettings(tracks=1000, server_error_rate=0.3)) as mock:
+        yield mock
+
+def make_client(spotify, checkpoints: CrawlCheckpoints | None, max_retries: int = 0):
+
+    token_provider = TokenProvider(client_id="id", client_secret="secret", token_url=spotify.token_url)
+    rate_limiter = RateLimiter(rate=1000, burst=1000, max_retries=max_retries, max_concurrency=1)
+
+    return set_client(client_id="id", client_secret="secret", token_provider=token_provider, rate_limiter=rate_limiter, base_url=spotify.base_url,
+                      checkpoints=checkpoints)
+
+def test_round_trip(tmp_path):
+
+    checkpoints = CrawlCheckpoints(path=tmp_path / "crawls.sqlite3")
+    crawl = checkpoints.start(playlist_id="playlist", snapshot_id="snapshot1")
+    crawl.save_page(offset=100, items=ITEMS)
+    crawl.save_albums(albums={"album0": ALBUM})
+    checkpoints.close()
+
+    checkpoints = CrawlCheckpoints(path=tmp_path / "crawls.sqlite3")
+    crawl = checkpoints.start(playlist_id="playlist", snapshot_id="snapshot1")
+    assert crawl.saved_pages() == {100: ITEMS}
+    assert crawl.saved_albums() == {"album0": ALBUM}
+
+    assert crawl.finish()
+    assert crawl.saved_pages() == {}
+    assert crawl.saved_albums() == {}
+    checkpoints.close()
+
+def test_crawl_with_failures_is_kept(tmp_path):
+
+    checkpoints = CrawlCheckpoints(path=tmp_path / "crawls.sqlite3")
+    crawl = checkpoints.start(playlist_id="playlist", snapshot_id="snapshot1")
+    crawl.save_page(offset=100, items=ITEMS)
+    crawl.failures.append("page 200")
+
+    assert not crawl.finish()
+    assert checkpoints.get_pages(playlist_id="playlist", snapshot_id="snapshot1") == {100: ITEMS}
+    checkpoints.close()
+
+def test_new_snapshot_drops_the_old_crawl(tmp_path):
+
+    checkpoints = CrawlCheckpoints(path=tmp_path / "crawls.sqlite3")
+    checkpoints.start(playlist_id="playlist", snapshot_id="snapshot1").save_page(offset=100, items=ITEMS)
+    checkpoints.start(playlist_id="other", snapshot_id="snapshot1").save_page(offset=100, items=ITEMS)
+
+    assert checkpoints.start(playlist_id="playlist", snapshot_id="snapshot2").saved_pages() == {}
+    assert checkpoints.get_pages(playlist_id="playlist", snapshot_id="snapshot1") == {}
+    assert checkpoints.get_pages(playlist_id="other", snapshot_id="snapshot1") == {100: ITEMS}
+    checkpoints.close()
+
+def test_old_crawls_are_cleared_on_open(tmp_path):
+
+    checkpoints = CrawlCheckpoints(path=tmp_path / "crawls.sqlite3")
+    checkpoints.start(playlist_id="playlist", snapshot_id="snapshot1").save_page(offset=100, items=ITEMS)
+    checkpoints.close()
+
+    checkpoints = CrawlCheckpoints(path=tmp_path / "crawls.sqlite3", max_age=-1)
+    assert checkpoints.get_pages(playlist_id="playlist", snapshot_id="snapshot1") == {}
+    checkpoints.close()
+
+""" A crawl that comes up short is an error rather than a short playlist, the next go only requests the pages that are still missing. """
+def test_failed_crawl_resumes(tmp_path, spotify, flaky_spotify):
+
+    checkpoints = CrawlCheckpoints(path=tmp_path / "crawls.sqlite3")
+    spotify.stats(reset=True)
+
+    playlist, client = get_playlist(client=make_client(spotify=flaky_spotify, checkpoints=checkpoints), playlist_id="playlist")
+    assert playlist.data is None
+    assert playlist.status == 503
+    assert "saved for next time" in playlist.error
+
+    saved_pages = checkpoints.get_pages(playlist_id="playlist", snapshot_id="snapshot1000")
+    assert 0 < len(saved_pages) < 9
+
+    playlist, client = get_playlist(client=make_client(spotify=spotify, checkpoints=checkpoints), playlist_id="playlist")
+    assert playlist.error is None
+    assert len(playlist.data["items"]) == 1000
+    assert spotify.stats()["requests"]["tracks"] == 9 - len(saved_pages)
+    assert checkpoints.get_pages(playlist_id="playlist", snapshot_id="snapshot1000") == {}
+
+    expected, client = get_playlist(client=make_client(spotify=spotify, checkpoints=None), playlist_id="playlist")
+    assert [track.to_dict() for track in playlist.data["items"]] == [track.to_dict() for track in expected.data["items"]]
+    checkpoints.close()
+
+def test_failed_stream_raises(tmp_path, flaky_spotify):
+
+    checkpoints = CrawlCheckpoints(path=tmp_path / "crawls.sqlite3")
+
+    playlist, client = stream_playlist(client=make_client(spotify=flaky_spotify, checkpoints=checkpoints), playlist_id="playlist")
+    with pytest.raises(IncompleteCrawlError) as error:
+        list(playlist.data["items"])
+
+    assert error.value.result.status == 503
+    assert checkpoints.get_pages(playlist_id="playlist", snapshot_id="snapshot1000")
+    checkpoints.close()
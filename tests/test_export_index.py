@@ -0,0 +1,71 @@
+from spex.export_index import ExportIndex
+from spex.export_index import remember_tracks
+from spex.records import Album
+from spex.records import Track
+from spex.records import UNAVAILABLE_ALBUM
+
+ALBUMS = {
+    "album0": Album(upc="upc0", label="label", copy_rights=(("C", "2020 label"), ("P", "2020 label"))),
+    "album1": Album(upc="upc1", label=None, copy_rights=())
+}
+
+def test_round_trip(tmp_path):
+
+    export_path = tmp_path / "playlist.csv"
+    export_path.write_text("exported")
+    index = ExportIndex(path=tmp_path / "exports.sqlite3")
+
+    assert index.get(playlist_id="playlist", export_format="csv") is None
+
+    index.put(playlist_id="playlist", export_format="csv", snapshot_id="snapshot1", track_ids=["track0", "track1"], albums=ALBUMS, path=export_path)
+    index.close()
+
+    index = ExportIndex(path=tmp_path / "exports.sqlite3")
+    previous = index.get(playlist_id="playlist", export_format="csv")
+    assert previous["snapshot_id"] == "snapshot1"
+    assert previous["track_ids"] == ["track0", "track1"]
+    assert previous["albums"] == ALBUMS
+    assert previous["path"] == export_path
+
+    # each format is its own file
+    assert index.get(playlist_id="playlist", export_format="xlsx") is None
+    index.close()
+
+def test_newer_export_replaces_the_old_one(tmp_path):
+
+    export_path = tmp_path / "playlist.csv"
+    export_path.write_text("exported")
+    index = ExportIndex(path=tmp_path / "exports.sqlite3")
+
+    index.put(playlist_id="playlist", export_format="csv", snapshot_id="snapshot1", track_ids=["track0"], albums=ALBUMS, path=export_path)
+    index.put(playlist_id="playlist", export_format="csv", snapshot_id="snapshot2", track_ids=["track0", "track2"], albums={}, path=export_path)
+
+    previous = index.get(playlist_id="playlist", export_format="csv")
+    assert previous["snapshot_id"] == "snapshot2"
+    assert previous["albums"] == {}
+    index.close()
+
+def test_deleted_export_is_forgotten(tmp_path):
+
+    export_path = tmp_path / "playlist.csv"
+    export_path.write_text("exported")
+    index = ExportIndex(path=tmp_path / "exports.sqlite3")
+    index.put(playlist_id="playlist", export_format="csv", snapshot_id="snapshot1", track_ids=[], albums={}, path=export_path)
+
+    export_path.unlink()
+    assert index.get(playlist_id="playlist", export_format="csv") is None
+    index.close()
+
+def test_remember_tracks_skips_unavailable_albums():
+
+    tracks = [
+        Track(track_id=f"track{n}", title="title", isrc=None, duration_ms=1000, release_artists=(), featured_artists=(), album_id=f"album{n}", album_title="album",
+              album_type="album", release_date=None, release_date_precision=None, album=album)
+        for n, album in enumerate([ALBUMS["album0"], UNAVAILABLE_ALBUM])
+    ]
+    track_ids = []
+    albums = {}
+
+    assert list(remember_tracks(tracks=tracks, track_ids=track_ids, albums=albums)) == tracks
+    assert track_ids == ["track0", "track1"]
+    assert albums == {"album0": ALBUMS["album0"]}
@@ -0,0 +1,57 @@
+from datetime import date
+from io import StringIO
+import json
+
+import pytest
+
+from spex.exporter import write_csv
+from spex.exporter import write_ndjson
+from spex.exporter import write_parquet
+from spex.formatter import iter_rows
+from spex.formatter import playlist_frame_formatter
+from spex.formatter import typed_row
+from spex.formatter import TYPED_COLUMNS
+from tests.test_formatter import read_fixture_tracks
+
+""" The streamed csv is written a row at a time from a generator, it should come out the same as the whole playlist going through pandas. """
+def test_streamed_csv_matches_the_frame():
+
+    tracks = read_fixture_tracks()
+    file = StringIO()
+
+    row_count = write_csv(rows=iter_rows(playlist_raw=iter(tracks)), file=file)
+
+    assert row_count == len(tracks)
+    assert file.getvalue() == playlist_frame_formatter(playlist_raw=tracks).to_csv(index=False, lineterminator="\n")
+
+""" Parquet and ndjson keep the real types: durations as ms, dates as dates, artists as lists. """
+def test_parquet_keeps_the_types(tmp_path):
+
+    pyarrow = pytest.importorskip("pyarrow")
+    import pyarrow.parquet as pq
+
+    tracks = read_fixture_tracks()
+    assert write_parquet(tracks=iter(tracks), file=tmp_path / "playlist.parquet", chunk_size=7) == len(tracks)
+
+    table = pq.read_table(tmp_path / "playlist.parquet")
+    assert table.column_names == TYPED_COLUMNS
+    assert table.schema.field("duration_ms").type == pyarrow.int64()
+    assert table.schema.field("release_date").type == pyarrow.date32()
+    assert table.schema.field("release_artists").type == pyarrow.list_(pyarrow.string())
+
+    expected = [typed_row(item=track) for track in tracks]
+    for row in expected:
+        row["release_date"] = date.fromisoformat(row["release_date"]) if row["release_date"] is not None else None
+    assert table.to_pylist() == expected
+
+def test_ndjson_keeps_the_types():
+
+    tracks = read_fixture_tracks()
+    file = StringIO()
+
+    assert write_ndjson(tracks=iter(tracks), file=file) == len(tracks)
+
+    rows = [json.loads(line) for line in file.getvalue().splitlines()]
+    assert rows == [typed_row(item=track) for track in tracks]
+    assert all(isinstance(row["duration_ms"], int) and isinstance(row["release_artists"], list) for row in rows)
+    assert all(row["release_date"] is None or date.fromisoformat(row["release_date"]) for row in rows)
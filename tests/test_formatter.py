@@ -0,0 +1,109 @@
+import csv
+import json
+from pathlib import Path
+
+import pandas as pd
+import pytest
+
+from spex.formatter import COLUMNS
+from spex.formatter import format_dates
+from spex.formatter import format_release_date
+from spex.formatter import format_row
+from spex.formatter import iter_rows
+from spex.formatter import playlist_frame_formatter
+from spex.formatter import playlist_typed_formatter
+from spex.formatter import typed_row
+from spex.records import Album
+from spex.records import Track
+
+DATA = Path(__file__).parent / "data"
+
+""" client_playlist.json is in the old trackRequest/albumRequest shape, this turns it back into Tracks. """
+def read_fixture_tracks() -> list[Track]:
+
+    playlist = json.loads((DATA / "client_playlist.json").read_text(encoding="utf-8"))
+
+    tracks = []
+    for item in playlist["items"]:
+        track = item["trackRequest"]
+        tracks.append(Track(
+            track_id=track["trackId"],
+            title=track["trackTitle"],
+            isrc=track["isrc"],
+            duration_ms=track["trackDuration"],
+            release_artists=tuple(artist["name"] for artist in track["releaseArtists"]),
+            featured_artists=tuple(artist["name"] for artist in track["featuredArtists"]),
+            album_id=track["albumId"],
+            album_title=track["albumTitle"],
+            album_type=track["albumType"],
+            release_date=track["releaseDate"],
+            release_date_precision=track.get("releaseDatePrecision"),
+            album=Album.from_dict(album_dict=item["albumRequest"])
+        ))
+
+    return tracks
+
+def make_track(release_date: str | None, precision: str | None = None) -> Track:
+
+    return Track(track_id="id", title="title", isrc="isrc", duration_ms=200_000, release_artists=("artist",), featured_artists=("artist",), album_id="album",
+                 album_title="album", album_type="album", release_date=release_date, release_date_precision=precision,
+                 album=Album(upc="upc", label="label", copy_rights=()))
+
+""" Everything read back as text, the way it was written. """
+def read_expected_rows() -> list[dict]:
+
+    with open(DATA / "formatter_playlist.csv", newline="", encoding="utf-8") as file:
+        return list(csv.DictReader(file))
+
+def as_text(rows: list[dict]) -> list[dict]:
+
+    return [{column: "" if row[column] is None else str(row[column]) for column in COLUMNS} for row in rows]
+
+""" A frame's rows as dicts with missing values as None, pandas may have turned them into NaN. """
+def frame_rows(frame: pd.DataFrame) -> list[dict]:
+
+    return frame.astype(object).where(frame.notna(), None).to_dict(orient="records")
+
+def test_rows_match_fixture():
+
+    assert as_text(list(iter_rows(playlist_raw=read_fixture_tracks()))) == read_expected_rows()
+
+def test_frame_matches_rows():
+
+    tracks = read_fixture_tracks()
+    frame = playlist_frame_formatter(playlist_raw=tracks)
+
+    assert list(frame.columns) == COLUMNS
+    assert frame_rows(frame=frame) == [format_row(item=track) for track in tracks]
+
+@pytest.mark.parametrize("date, precision, expected", [
+    ("2021-02-08", "day", "08/02/2021"),
+    ("2021-02", "month", "02/2021"),
+    ("2021", "year", "2021"),
+    ("2021-02-08", None, "08/02/2021"),
+    ("1999", None, "1999"),
+    (None, None, None),
+    (None, "day", None)
+])
+def test_format_release_date(date, precision, expected):
+
+    assert format_release_date(date=date, precision=precision) == expected
+
+""" A missing date used to get factorize's -1 and pick up whichever date came last. """
+def test_missing_dates_keep_their_place():
+
+    assert list(format_dates(dates=["2020-01-15", None, "1999"], precisions=["day", None, "year"])) == ["15/01/2020", None, "1999"]
+
+    tracks = [make_track(release_date="2020-01-15", precision="day"), make_track(release_date=None), make_track(release_date="1999", precision="year")]
+    frame = playlist_frame_formatter(playlist_raw=tracks)
+
+    assert frame_rows(frame=frame) == [format_row(item=track) for track in tracks]
+    assert [row["Release Date (DD/MM/YYYY)"] for row in frame_rows(frame=frame)] == ["15/01/2020", None, "1999"]
+
+def test_typed_frame_missing_dates():
+
+    tracks = [make_track(release_date="2020-01-15", precision="day"), make_track(release_date=None), make_track(release_date="1999", precision="year")]
+    frame = playlist_typed_formatter(playlist_raw=tracks)
+
+    assert list(frame["release_date"]) == [pd.Timestamp("2020-01-15"), pd.NaT, pd.Timestamp("1999-01-01")]
+    assert [typed_row(item=track)["release_date"] for track in tracks] == ["2020-01-15", None, "1999-01-01"]
@@ -0,0 +1,96 @@
+import subprocess
+import sys
+
+import pytest
+
+from spex.api_client import set_client
+from spex.exporter import get_save_path
+from spex.main import export_batch
+from spex.main import export_link
+from spex.main import export_playlist
+from spex.rate_limiter import RateLimiter
+from spex.records import Album
+from spex.records import Track
+from spex.token_provider import TokenProvider
+
+# xlsx exports need openpyxl
+openpyxl = pytest.importorskip("openpyxl")
+
+def make_playlist(tracks: int) -> dict:
+
+    album = Album(upc="upc", label="label", copy_rights=(("C", "2020 label"),))
+    items = [Track(track_id=f"track{n}", title=f"title {n}", isrc=None, duration_ms=200_000, release_artists=("artist",), featured_artists=(), album_id="album",
+                   album_title="album", album_type="album", release_date="2020-01-15", release_date_precision="day", album=album) for n in range(tracks)]
+
+    return {"name": "playlist", "snapshot_id": "snapshot", "items": items}
+
+def make_client(spotify):
+
+    token_provider = TokenProvider(client_id="id", client_secret="secret", token_url=spotify.token_url)
+
+    return set_client(client_id="id", client_secret="secret", token_provider=token_provider, rate_limiter=RateLimiter(rate=1000, burst=1000),
+                      base_url=spotify.base_url)
+
+@pytest.mark.parametrize("raw, sheets", [(False, ["Playlist"]), (True, ["Playlist", "Raw"])])
+def test_raw_sheet_is_opt_in(tmp_path, raw, sheets):
+
+    save_path = export_playlist(playlist=make_playlist(tracks=3), export_format="xlsx", save_path=tmp_path / "playlist.xlsx", raw=raw)
+    workbook = openpyxl.load_workbook(save_path, read_only=True)
+
+    assert workbook.sheetnames == sheets
+    assert len(list(workbook["Playlist"].values)) == 4
+
+""" SPEX_EXPORT_DIR is read when a path is worked out, so setting it after the exporter was imported (like loading .env does) still counts. """
+def test_export_dir_is_read_when_saving(tmp_path, monkeypatch):
+
+    monkeypatch.setenv("SPEX_EXPORT_DIR", str(tmp_path))
+    assert get_save_path(playlist_name="playlist", extension="csv") == tmp_path / "playlist.csv"
+
+    (tmp_path / "playlist.csv").write_text("")
+    assert get_save_path(playlist_name="playlist", extension="csv") == tmp_path / "playlist(1).csv"
+
+""" --stream writes each page as it's enriched instead of loading the whole playlist first, the file it leaves should be the same. """
+@pytest.mark.parametrize("export_format", ["csv", "ndjson"])
+def test_streamed_export_matches_loaded(spotify, tmp_path, monkeypatch, export_format):
+
+    monkeypatch.setenv("SPEX_EXPORT_DIR", str(tmp_path))
+
+    assert export_link(client=make_client(spotify=spotify), link="playlist", stream=False, export_format=export_format) == []
+    assert export_link(client=make_client(spotify=spotify), link="playlist", stream=True, export_format=export_format) == []
+
+    loaded = tmp_path / f"Benchmark 250.{export_format}"
+    streamed = tmp_path / f"Benchmark 250(1).{export_format}"
+    assert len(loaded.read_text(encoding="utf-8").splitlines()) == 250 + (export_format == "csv")
+    assert streamed.read_bytes() == loaded.read_bytes()
+
+""" A csv or ndjson export never needs pandas, numpy, openpyxl or pyarrow, so a run that only writes those shouldn't pay for importing them. Run in a fresh
+interpreter since this one already has them loaded. """
+def test_csv_and_ndjson_exports_skip_the_heavy_imports(tmp_path):
+
+    script = f"""
+import sys
+from spex.main import export_playlist
+from spex.records import Album, Track
+album = Album(upc="upc", label="label", copy_rights=())
+items = [Track(track_id="track", title="title", isrc=None, duration_ms=200_000, release_artists=("artist",), featured_artists=(), album_id="album",
+               album_title="album", album_type="album", release_date="2020-01-15", release_date_precision="day", album=album)] * 3
+export_playlist(playlist={{"name": "playlist", "items": items}}, export_format="csv", save_path={str(tmp_path / "playlist.csv")!r})
+export_playlist(playlist={{"name": "playlist", "items": items}}, export_format="ndjson", save_path={str(tmp_path / "playlist.ndjson")!r})
+print(",".join(module for module in ("pandas", "numpy", "openpyxl", "pyarrow") if module in sys.modules))
+"""
+    result = subprocess.run([sys.executable, "-c", script], capture_output=True, text=True, check=True)
+
+    assert result.stdout.strip() == ""
+    assert len((tmp_path / "playlist.csv").read_text(encoding="utf-8").splitlines()) == 4
+
+""" The playlist that fails is reported at the end, the others are still exported. """
+def test_batch_carries_on_past_a_failure(spotify, tmp_path, monkeypatch, capsys):
+
+    monkeypatch.setenv("SPEX_EXPORT_DIR", str(tmp_path))
+
+    failures = export_batch(client=make_client(spotify=spotify), links=["first", "missing", "not a link", "second"], export_format="csv", jobs=2)
+
+    assert [link for link, reason in failures] == ["not a link", "missing"]
+    assert "404" in failures[1][1]
+    assert sorted(path.name for path in tmp_path.iterdir()) == ["Benchmark 250(1).csv", "Benchmark 250.csv"]
+    assert "Exported 2 of 4 playlists" in capsys.readouterr().out
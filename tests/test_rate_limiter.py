@@ -0,0 +1,128 @@
+import sqlite3
+import threading
+import time
+
+import pytest
+
+from spex.rate_limiter import RateLimiter
+from spex.rate_limiter import SharedRateLimiter
+
+@pytest.fixture
+def shared_path(tmp_path):
+
+    return tmp_path / "shared" / "rate_limiter.sqlite3"
+
+def test_bucket_spaces_out_requests_past_the_burst():
+
+    limiter = RateLimiter(rate=10, burst=2)
+
+    assert limiter.reserve() == 0
+    assert limiter.reserve() == 0
+    assert limiter.reserve() == pytest.approx(0.1, abs=0.01)
+
+def test_throttle_blocks_and_halves_concurrency_once():
+
+    limiter = RateLimiter(max_concurrency=8, jitter=0)
+
+    assert limiter.on_throttled(attempt=0, retry_after=2) == 2
+    assert limiter.concurrency == 4
+    assert limiter.reserve() == pytest.approx(2, abs=0.05)
+
+    # the rest of the same burst of 429s doesn't cut it again
+    limiter.on_throttled(attempt=0, retry_after=2)
+    assert limiter.concurrency == 4
+
+def test_concurrency_climbs_back_after_a_throttle():
+
+    limiter = RateLimiter(max_concurrency=8, jitter=0)
+    limiter.on_throttled(attempt=0, retry_after=0.1)
+
+    for _ in range(4 * 4 - 1):
+        limiter.on_success()
+    assert limiter.concurrency == 4
+    limiter.on_success()
+    assert limiter.concurrency == 5
+
+    for _ in range(1000):
+        limiter.on_success()
+    assert limiter.concurrency == 8
+
+def test_throttle_never_goes_below_min_concurrency():
+
+    limiter = RateLimiter(max_concurrency=2, min_concurrency=1, jitter=0)
+    for _ in range(5):
+        limiter.on_throttled(attempt=0, retry_after=0)
+        limiter.last_cut = 0.0
+
+    assert limiter.concurrency == 1
+
+def test_shared_limiters_share_the_bucket(shared_path):
+
+    first = SharedRateLimiter(path=shared_path, rate=10, burst=2)
+    second = SharedRateLimiter(path=shared_path, rate=10, burst=2)
+
+    assert first.reserve() == 0
+    assert second.reserve() == 0
+    assert first.reserve() == pytest.approx(0.1, abs=0.02)
+
+    first.close()
+    second.close()
+
+def test_shared_throttle_holds_back_every_limiter(shared_path):
+
+    first = SharedRateLimiter(path=shared_path, max_concurrency=8, jitter=0)
+    second = SharedRateLimiter(path=shared_path, max_concurrency=8, jitter=0)
+
+    first.on_throttled(attempt=0, retry_after=2)
+
+    assert second.reserve() == pytest.approx(2, abs=0.05)
+    assert second.concurrency == 4
+
+    # the recovery is shared too, successes seen by one let the other climb back
+    for _ in range(4 * 4):
+        second.on_success()
+    first.reserve()
+    assert first.concurrency == 5
+
+    first.close()
+    second.close()
+
+def test_shared_state_outlives_the_limiter(shared_path):
+
+    first = SharedRateLimiter(path=shared_path, max_concurrency=8, jitter=0)
+    first.on_throttled(attempt=0, retry_after=2)
+    first.close()
+
+    second = SharedRateLimiter(path=shared_path, max_concurrency=8, jitter=0)
+    assert second.reserve() > 1.5
+    second.close()
+
+def test_shared_concurrency_is_capped_by_our_own_max(shared_path):
+
+    SharedRateLimiter(path=shared_path, max_concurrency=16).close()
+    limiter = SharedRateLimiter(path=shared_path, max_concurrency=4)
+
+    limiter.reserve()
+    assert limiter.concurrency == 4
+    limiter.close()
+
+""" Another process holding the database can keep a thread waiting inside state(), a 5xx mustn't wait behind it (it's counted on the event loop). """
+def test_server_error_does_not_wait_on_the_database(shared_path):
+
+    limiter = SharedRateLimiter(path=shared_path)
+    other_process = sqlite3.connect(shared_path, isolation_level=None)
+    other_process.execute("BEGIN IMMEDIATE")
+
+    waiting = threading.Thread(target=limiter.reserve)
+    waiting.start()
+    time.sleep(0.2)
+
+    start = time.perf_counter()
+    limiter.on_server_error(attempt=0)
+    assert time.perf_counter() - start < 0.1
+    assert limiter.retries == 1
+
+    other_process.execute("COMMIT")
+    waiting.join()
+    other_process.close()
+    limiter.close()
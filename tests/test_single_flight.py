@@ -0,0 +1,100 @@
+import asyncio
+
+from spex.web.single_flight import SingleFlight
+
+""" A render that sends whatever it's given on chunks, so the test decides when each one goes out. """
+def make_render(chunks: asyncio.Queue, renders: list):
+
+    async def render(shared):
+
+        renders.append(shared)
+        shared.ready("playlist")
+        try:
+            while (chunk := await chunks.get()) is not None:
+                await shared.send(chunk)
+        except asyncio.CancelledError:
+            renders.append("cancelled")
+            raise
+
+    return render
+
+async def read_all(shared) -> bytes:
+
+    return b"".join([chunk async for chunk in shared.read()])
+
+""" Requests for the same key while it's rendering share the one render, one that joins late still gets the export from the first byte. """
+def test_concurrent_requests_share_one_render():
+
+    async def run():
+
+        single_flight = SingleFlight()
+        chunks = asyncio.Queue()
+        renders = []
+
+        first = single_flight.join(key=("csv", "playlist"), render=make_render(chunks=chunks, renders=renders))
+        assert await first.wait() == "playlist"
+        first_read = asyncio.create_task(read_all(first))
+
+        await chunks.put(b"header\n")
+        await asyncio.sleep(0.05)
+        second = single_flight.join(key=("csv", "playlist"), render=make_render(chunks=chunks, renders=renders))
+        other = single_flight.join(key=("csv", "other"), render=make_render(chunks=asyncio.Queue(), renders=[]))
+        assert second is first
+        assert other is not first
+        second_read = asyncio.create_task(read_all(second))
+
+        await chunks.put(b"row\n")
+        await chunks.put(None)
+        assert await first_read == await second_read == b"header\nrow\n"
+        assert len(renders) == 1
+        assert single_flight.in_flight() == 1
+
+        other.leave()
+        await asyncio.sleep(0)
+        assert single_flight.in_flight() == 0
+
+    asyncio.run(run())
+
+""" The render carries on while anyone is still reading it and is cancelled once the last of them has gone. """
+def test_render_is_cancelled_when_everyone_leaves():
+
+    async def run():
+
+        single_flight = SingleFlight()
+        chunks = asyncio.Queue()
+        renders = []
+
+        first = single_flight.join(key=("csv", "playlist"), render=make_render(chunks=chunks, renders=renders))
+        second = single_flight.join(key=("csv", "playlist"), render=make_render(chunks=chunks, renders=renders))
+        await first.wait()
+
+        first.leave()
+        await asyncio.sleep(0.05)
+        assert not first.task.done()
+
+        second.leave()
+        await asyncio.sleep(0.05)
+        assert first.task.cancelled()
+        assert renders[-1] == "cancelled"
+        assert single_flight.in_flight() == 0
+
+    asyncio.run(run())
+
+""" A render that fails before it's ready fails every request waiting on it. """
+def test_failed_render_fails_everyone_waiting():
+
+    async def run():
+
+        async def render(shared):
+
+            await asyncio.sleep(0.01)
+            raise LookupError("not found")
+
+        single_flight = SingleFlight()
+        waiting = [single_flight.join(key=("csv", "missing"), render=render) for _ in range(3)]
+
+        results = await asyncio.gather(*(shared.wait() for shared in waiting), return_exceptions=True)
+        assert all(isinstance(result, LookupError) for result in results)
+        assert single_flight.in_flight() == 0
+
+    asyncio.run(run())
@@ -0,0 +1,61 @@
+import time
+
+from spex.token_provider import TokenProvider
+
+def make_provider(spotify, **kwargs) -> TokenProvider:
+
+    return TokenProvider(client_id="id", client_secret="secret", token_url=spotify.token_url, **kwargs)
+
+def test_token_is_reused_until_it_is_close_to_expiring(spotify):
+
+    provider = make_provider(spotify=spotify)
+
+    access_token = provider.get_token()
+    assert provider.get_token() == access_token
+    assert provider.refreshes == 1
+
+    # inside refresh_margin of expiring, so it gets swapped before spotify turns it down
+    provider.expires_at = time.time() + provider.refresh_margin / 2
+    assert provider.get_token() != access_token
+    assert provider.refreshes == 2
+
+def test_invalidate_only_drops_the_token_that_failed(spotify):
+
+    provider = make_provider(spotify=spotify)
+    access_token = provider.get_token()
+
+    # a 401 for a token that's already been swapped out changes nothing
+    provider.invalidate(access_token="an older token")
+    assert provider.get_token() == access_token
+
+    provider.invalidate(access_token=access_token)
+    assert provider.get_token() != access_token
+    assert provider.refreshes == 2
+
+def test_cached_token_is_shared(spotify, tmp_path):
+
+    cache_path = tmp_path / "token.json"
+    first = make_provider(spotify=spotify, cache_path=cache_path)
+    access_token = first.get_token()
+
+    second = make_provider(spotify=spotify, cache_path=cache_path)
+    assert second.get_token() == access_token
+    assert second.refreshes == 0
+
+    # the first provider refreshes after a 401, the rejected token isn't read back out of the cache
+    first.invalidate(access_token=access_token)
+    new_token = first.get_token()
+    assert new_token != access_token
+
+    # the second one picks up the refresh from the cache instead of doing its own
+    second.invalidate(access_token=access_token)
+    assert second.get_token() == new_token
+    assert second.refreshes == 0
+
+def test_cached_token_for_another_app_is_ignored(spotify, tmp_path):
+
+    cache_path = tmp_path / "token.json"
+    make_provider(spotify=spotify, cache_path=cache_path).get_token()
+
+    provider = TokenProvider(client_id="other", client_secret="secret", cache_path=cache_path, token_url=spotify.token_url)
+    assert provider.access_token is None
@@ -0,0 +1,204 @@
+import time
+
+import pytest
+
+# the web app is an optional extra
+pytest.importorskip("fastapi")
+
+from fastapi import HTTPException
+from fastapi.testclient import TestClient
+
+from benchmarks.mock_spotify import MockSettings
+from benchmarks.mock_spotify import MockSpotify
+from spex.web import api
+from spex.web.jobs import JobManager
+
+""" Points the app at the stand in and keeps everything it saves inside tmp_path. """
+def use_stand_in(spotify, tmp_path, monkeypatch, **extra_settings) -> None:
+
+    settings = {
+        "CLIENT_ID": "id",
+        "CLIENT_SECRET": "secret",
+        "SPEX_API_URL": spotify.base_url,
+        "SPEX_TOKEN_URL": spotify.token_url,
+        "SPEX_CACHE_DIR": str(tmp_path / "cache"),
+        "SPEX_TOKEN_CACHE": "0",
+        "SPEX_ALBUM_CACHE": "0",
+        "SPEX_JOB_DIR": str(tmp_path / "jobs"),
+        **extra_settings
+    }
+    for name, value in settings.items():
+        monkeypatch.setenv(name, value)
+    monkeypatch.delenv("SPEX_SHARED_STATE", raising=False)
+
+@pytest.fixture
+def web_settings(spotify, tmp_path, monkeypatch):
+
+    use_stand_in(spotify=spotify, tmp_path=tmp_path, monkeypatch=monkeypatch)
+
+@pytest.fixture
+def web(web_settings):
+
+    with TestClient(api.app) as client:
+        yield client
+
+""" The app against a stand in where 30% of requests fail and nothing is retried, so nearly every crawl comes up short. """
+@pytest.fixture
+def flaky_web(tmp_path, monkeypatch):
+
+    with MockSpotify(settings=MockSettings(tracks=1000, server_error_rate=0.3)) as flaky_spotify:
+        use_stand_in(spotify=flaky_spotify, tmp_path=tmp_path, monkeypatch=monkeypatch, SPEX_MAX_RETRIES="0", SPEX_MAX_CONCURRENCY="1")
+        with TestClient(api.app) as client:
+            yield client
+
+def wait_for_job(web: TestClient, job_id: str) -> dict:
+
+    deadline = time.time() + 30
+    while time.time() < deadline:
+        job = web.get(f"/jobs/{job_id}").json()
+        if job["status"] not in ("queued", "running"):
+            return job
+        time.sleep(0.05)
+
+    raise TimeoutError(f"job {job_id} didn't finish")
+
+def test_export_has_etag(web):
+
+    response = web.get("/playlists/csv", params={"playlist_id": "playlist"})
+
+    assert response.status_code == 200
+    assert response.headers["etag"]
+    assert response.headers["cache-control"] == "no-cache"
+    assert len(response.text.splitlines()) == 251
+
+@pytest.mark.parametrize("route", ["csv", "xlsx", "parquet", "ndjson"])
+def test_unchanged_playlist_is_not_modified(web, route):
+
+    etag = web.get(f"/playlists/{route}", params={"playlist_id": "playlist"}).headers["etag"]
+
+    response = web.get(f"/playlists/{route}", params={"playlist_id": "playlist"}, headers={"If-None-Match": etag})
+    assert response.status_code == 304
+    assert response.content == b""
+    assert response.headers["etag"] == etag
+
+    # the W/ prefix doesn't count when comparing, a list of tags works too
+    response = web.get(f"/playlists/{route}", params={"playlist_id": "playlist"}, headers={"If-None-Match": f'"other", {etag.removeprefix("W/")}'})
+    assert response.status_code == 304
+
+def test_changed_playlist_is_sent_again(web):
+
+    response = web.get("/playlists/csv", params={"playlist_id": "playlist"}, headers={"If-None-Match": 'W/"an older snapshot"'})
+
+    assert response.status_code == 200
+    assert len(response.text.splitlines()) == 251
+
+def test_variants_have_their_own_etags(web):
+
+    etags = {route: web.get(f"/playlists/{route}", params={"playlist_id": "playlist"}).headers["etag"] for route in ("csv", "xlsx", "parquet")}
+    etags["xlsx-raw"] = web.get("/playlists/xlsx", params={"playlist_id": "playlist", "raw": True}).headers["etag"]
+
+    assert len(set(etags.values())) == 4
+
+""" A crawl with pages missing is an error, not a short export that the render cache and ETag would then keep handing out. """
+@pytest.mark.parametrize("route", ["xlsx", "parquet"])
+def test_short_crawl_is_an_error(flaky_web, route):
+
+    response = flaky_web.get(f"/playlists/{route}", params={"playlist_id": "playlist"})
+
+    assert response.status_code == 503
+    assert "couldn't be loaded" in response.json()["detail"]
+    assert not flaky_web.app.state.render_cache.entries
+
+""" The streamed exports have already started by the time the crawl comes up short, so they're cut off part way instead. """
+@pytest.mark.parametrize("route", ["csv", "ndjson"])
+def test_short_streamed_crawl_is_cut_off(flaky_web, route):
+
+    with pytest.raises(Exception) as error:
+        flaky_web.get(f"/playlists/{route}", params={"playlist_id": "playlist"})
+
+    causes = []
+    cause = error.value
+    while cause is not None:
+        causes.append(cause)
+        cause = cause.__cause__ or cause.__context__
+    assert any(isinstance(cause, HTTPException) and cause.status_code == 503 for cause in causes)
+    assert not flaky_web.app.state.render_cache.entries
+
+def test_missing_playlist(web):
+
+    response = web.get("/playlists/csv", params={"playlist_id": "missing"})
+
+    assert response.status_code == 404
+    assert response.json() == {"detail": "Resource not found"}
+
+def test_job_runs_in_the_background(web):
+
+    response = web.post("/jobs", params={"playlist_id": "playlist", "format": "csv"})
+    assert response.status_code == 202
+    job = response.json()
+    assert job["status"] in ("queued", "running")
+
+    job = wait_for_job(web=web, job_id=job["id"])
+    assert job["status"] == "done"
+    assert job["name"] == "Benchmark 250"
+    assert job["progress"]["tracks"] == 250
+    assert job["error"] is None
+
+    download = web.get(f"/jobs/{job['id']}/download")
+    assert download.status_code == 200
+    assert download.headers["content-type"].startswith("text/csv")
+    assert download.text == web.get("/playlists/csv", params={"playlist_id": "playlist"}).text
+
+def test_failed_job_reports_why(web):
+
+    job = wait_for_job(web=web, job_id=web.post("/jobs", params={"playlist_id": "missing"}).json()["id"])
+
+    assert job["status"] == "failed"
+    assert job["error"]
+
+    response = web.get(f"/jobs/{job['id']}/download")
+    assert response.status_code == 409
+    assert response.json()["status"] == "failed"
+
+""" A job whose crawl came up short fails rather than ending as done with some of the tracks missing. """
+def test_short_crawl_fails_the_job(flaky_web):
+
+    job = wait_for_job(web=flaky_web, job_id=flaky_web.post("/jobs", params={"playlist_id": "playlist", "format": "csv"}).json()["id"])
+
+    assert job["progress"]["tracks"] < job["progress"]["total_tracks"]
+    assert job["status"] == "failed"
+    assert "couldn't be loaded" in job["error"]
+    assert flaky_web.get(f"/jobs/{job['id']}/download").status_code == 409
+
+def test_unknown_jobs(web):
+
+    assert web.get("/jobs/0123456789abcdef0123456789abcdef").status_code == 404
+    assert web.get("/jobs/..%2Fjobs/download").status_code == 404
+    assert web.post("/jobs", params={"playlist_id": "playlist", "format": "pdf"}).status_code == 422
+
+def test_full_queue_is_refused(web):
+
+    web.app.state.jobs.max_queued = 0
+
+    response = web.post("/jobs", params={"playlist_id": "playlist"})
+    assert response.status_code == 429
+    assert response.headers["retry-after"] == "30"
+
+""" With SPEX_SHARED_STATE set a job is saved where every worker can see it, a manager that didn't run it can still report on it and hand over the file. """
+def test_shared_job_is_seen_by_other_workers(web_settings, tmp_path, monkeypatch):
+
+    shared_state = tmp_path / "shared"
+    monkeypatch.setenv("SPEX_SHARED_STATE", str(shared_state))
+
+    with TestClient(api.app) as shared_web:
+        job = shared_web.post("/jobs", params={"playlist_id": "playlist", "format": "csv"}).json()
+        wait_for_job(web=shared_web, job_id=job["id"])
+
+        other_worker = JobManager(directory=shared_state / "jobs", shared=True)
+        seen = other_worker.get(job_id=job["id"])
+        assert seen.status == "done"
+        assert seen.name == "Benchmark 250"
+        assert len(seen.path.read_text(encoding="utf-8").splitlines()) == 251
+
+    # the worker that ran it clears it up when it stops
+    assert list((shared_state / "jobs").iterdir()) == []